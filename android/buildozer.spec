@@ -7,7 +7,7 @@ package.domain = org.clinic
 
 # Source code
 source.dir = .
-source.include_exts = py,png,jpg,kv,atlas,db,html,css,js,md
+source.include_exts = py,png,jpg,kv,atlas,db,html,css,js,md,json
 
 # Version
 version = 1.0.0
@@ -4,11 +4,13 @@ Medical Records App - Android Version
 """
 
 from kivy.app import App
-from kivy.uix.widget import Widget
+from kivy.clock import Clock
+from kivy.uix.boxlayout import BoxLayout
+from kivy.uix.button import Button
+from kivy.uix.label import Label
 from android.runnable import run_on_ui_thread
-from jnius import autoclass, cast
+from jnius import autoclass
 import threading
-import time
 import os
 import sys
 
@@ -16,99 +18,95 @@ import sys
 PythonActivity = autoclass('org.kivy.android.PythonActivity')
 WebView = autoclass('android.webkit.WebView')
 WebViewClient = autoclass('android.webkit.WebViewClient')
-LayoutParams = autoclass('android.view.ViewGroup$LayoutParams')
 
 # Add Flask app directory to path
 app_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, app_dir)
 
-# Flask server thread
-flask_thread = None
-
-def start_flask_server():
-    """Start Flask server in background thread"""
-    try:
-        # Wait a bit for Android to initialize
-        time.sleep(2)
-        
-        # Import Flask app
-        from app import app, init_db
-        
-        # Initialize database
-        print("Initializing database...")
-        init_db()
-        
-        # Configure Flask for Android
-        app.config['DEBUG'] = False
-        app.config['TESTING'] = False
-        
-        # Start Flask server
-        print("Starting Flask server on http://127.0.0.1:5000")
-        app.run(
-            host='127.0.0.1',
-            port=5000,
-            threaded=True,
-            use_reloader=False,
-            debug=False
-        )
-    except Exception as e:
-        print(f"Error starting Flask: {e}")
-        import traceback
-        traceback.print_exc()
+# منطق التشغيل منفصل عن Kivy/jnius ويمكن تجربته على Linux
+from startup import READY_TIMEOUT, start_server, wait_for_health, HOST, PORT
+
+SERVER_URL = f'http://{HOST}:{PORT}'
 
 class MedicalRecordsApp(App):
     """Main Android application"""
-    
+
     def build(self):
         """Build the app interface"""
-        
-        # Start Flask server in background
-        global flask_thread
+
+        # حجز المنفذ فوراً؛ Flask وقاعدة البيانات تهيأ في خيط الخادم
         print("Starting Flask in background...")
-        flask_thread = threading.Thread(target=start_flask_server, daemon=True)
-        flask_thread.start()
-        
-        # Wait for Flask to start
-        print("Waiting for Flask to initialize...")
-        time.sleep(5)
-        
-        # Create and show WebView
-        self.setup_webview()
-        
-        # Return empty widget (WebView is added natively)
-        return Widget()
-    
+        self.server = start_server(HOST, PORT, app_dir)
+
+        self.root_layout = BoxLayout(orientation='vertical', padding=40, spacing=20)
+        self.show_status('Starting...')
+        self.wait_for_server()
+        return self.root_layout
+
+    def show_status(self, text, retry=False):
+        """شاشة التحميل أو شاشة الخطأ مع زر إعادة المحاولة"""
+        self.root_layout.clear_widgets()
+        self.root_layout.add_widget(Label(text=text, halign='center'))
+        if retry:
+            button = Button(text='Retry', size_hint=(1, 0.2))
+            button.bind(on_release=lambda *_: self.retry())
+            self.root_layout.add_widget(button)
+
+    def wait_for_server(self):
+        """انتظار /healthz في خيط خلفي ثم عرض WebView أو شاشة الخطأ"""
+        def wait():
+            try:
+                wait_for_health(SERVER_URL, READY_TIMEOUT)
+            except TimeoutError:
+                pass
+            else:
+                self.setup_webview()
+                return
+            error = self.server.error if self.server is not None else None
+            message = f'Server failed to start:\n{error}' if error else 'Server did not respond in time.'
+            Clock.schedule_once(lambda dt: self.show_status(message, retry=True))
+
+        threading.Thread(target=wait, daemon=True).start()
+
+    def retry(self):
+        """إعادة تشغيل الخادم إذا توقف بخطأ ثم الانتظار من جديد"""
+        if self.server is not None and self.server.error is not None:
+            self.server.shutdown()
+            self.server = start_server(HOST, PORT, app_dir)
+        self.show_status('Starting...')
+        self.wait_for_server()
+
     @run_on_ui_thread
     def setup_webview(self):
         """Setup Android WebView"""
         try:
             # Get current activity
             activity = PythonActivity.mActivity
-            
+
             # Create WebView
             webview = WebView(activity)
             webview.getSettings().setJavaScriptEnabled(True)
             webview.getSettings().setDomStorageEnabled(True)
             webview.getSettings().setDatabaseEnabled(True)
             webview.setWebViewClient(WebViewClient())
-            
+
             # Load Flask app
-            webview.loadUrl('http://127.0.0.1:5000')
-            
+            webview.loadUrl(SERVER_URL)
+
             # Add WebView to activity
             activity.setContentView(webview)
-            
+
             print("WebView loaded successfully!")
-            
+
         except Exception as e:
             print(f"Error setting up WebView: {e}")
             import traceback
             traceback.print_exc()
-    
+
     def on_pause(self):
         """Handle app pause"""
         return True
-    
+
     def on_resume(self):
         """Handle app resume"""
         pass
@@ -20,26 +20,21 @@ service = PythonService.mService
 
 def start_flask():
     """Start Flask server"""
-    try:
-        from app import app, init_db
-        
-        # Initialize database
-        init_db()
-        
-        print("Flask Service: Starting server on 127.0.0.1:5000")
-        
-        # Run Flask
-        app.run(
-            host='127.0.0.1',
-            port=5000,
-            threaded=True,
-            use_reloader=False,
-            debug=False
-        )
-    except Exception as e:
-        print(f"Flask Service Error: {e}")
-        import traceback
-        traceback.print_exc()
+    from startup import HOST, PORT, start_server
+    
+    # حجز المنفذ أولاً ثم تهيئة قاعدة البيانات في خيط الخادم
+    server = start_server(HOST, PORT, app_dir)
+    if server is None:
+        return
+    
+    print(f"Flask Service: Starting server on {HOST}:{PORT}")
+    if not server.wait():
+        print(f"Flask Service Error: {server.error}")
+        return
+    
+    # إبقاء الخدمة حية ما دام الخادم يعمل
+    while True:
+        sleep(60)
 
 if __name__ == '__main__':
     print("Flask Service: Starting...")
@@ -0,0 +1,146 @@
+"""
+Embedded server startup for the Android wrapper
+تشغيل الخادم المدمج: حجز المنفذ أولاً، ثم تهيئة قاعدة البيانات، ثم انتظار الجاهزية
+
+لا يعتمد على Kivy أو jnius، فيمكن تجربته على Linux مباشرة:
+    python android/startup.py
+"""
+
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+import urllib.error
+import urllib.request
+
+HOST = '127.0.0.1'
+PORT = 5000
+READY_TIMEOUT = 30.0        # ثوانٍ قبل إظهار شاشة الخطأ
+POLL_INITIAL_DELAY = 0.05   # أول انتظار بين محاولات /healthz
+POLL_MAX_DELAY = 1.0        # أقصى انتظار بين المحاولات
+
+class EmbeddedServer:
+    """خادم Flask داخل التطبيق يعمل في خيط خلفي
+
+    المنفذ يحجز فوراً في start()، فأي طلب مبكر من WebView ينتظر في قائمة
+    انتظار المقبس بدلاً من أن يفشل. استيراد Flask والتطبيق وتهيئة قاعدة
+    البيانات تتم بعد ذلك في خيط الخادم حتى لا تؤخر واجهة التطبيق.
+    """
+
+    def __init__(self, host=HOST, port=PORT, app_dir=None):
+        self.host = host
+        self.port = port
+        self.app_dir = app_dir or os.path.dirname(os.path.abspath(__file__))
+        self.ready = threading.Event()
+        self.error = None
+        self._socket = None
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}'
+
+    def bind(self):
+        """حجز المنفذ (يرفع OSError إذا كان محجوزاً، مثلاً من خدمة الخلفية)"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind((self.host, self.port))
+            sock.listen(128)
+        except OSError:
+            sock.close()
+            raise
+        # المنفذ 0 يعني أي منفذ متاح (للتجربة)
+        self.port = sock.getsockname()[1]
+        self._socket = sock
+
+    def start(self):
+        """حجز المنفذ وبدء خيط الخادم دون انتظار جاهزيته"""
+        if self._socket is None:
+            self.bind()
+        self._thread = threading.Thread(target=self._run, name='flask-server', daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        try:
+            if self.app_dir not in sys.path:
+                sys.path.insert(0, self.app_dir)
+            # الاستيراد الثقيل (Flask وبناء المسارات) بعد حجز المنفذ
+            from werkzeug.serving import make_server
+            # WebView على الجهاز نفسه: الضغط يكلف المعالج ولا يوفر شيئاً على الشبكة
+            os.environ.setdefault('MEDICAL_COMPRESS', '0')
+            import app as medical_app
+
+            # init_db لا يفعل شيئاً إذا كانت نسخة المخطط محدثة
+            medical_app.init_db()
+            medical_app.install_bytecode_cache()
+            if medical_app.DIGITS_INDEX_ENABLED:
+                medical_app.start_digits_index_loader()
+            self._server = make_server(self.host, self.port, medical_app.app,
+                                       threaded=True, fd=self._socket.fileno())
+        except Exception as e:
+            self.error = e
+            traceback.print_exc()
+            self.ready.set()
+            return
+        self.ready.set()
+        self._server.serve_forever()
+
+    def wait(self, timeout=READY_TIMEOUT):
+        """انتظار جاهزية الخادم في هذه العملية؛ يعيد False عند الخطأ أو انتهاء المهلة"""
+        return self.ready.wait(timeout) and self.error is None
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+def wait_for_health(url, timeout=READY_TIMEOUT, initial_delay=POLL_INITIAL_DELAY,
+                    max_delay=POLL_MAX_DELAY):
+    """انتظار استجابة /healthz مع مضاعفة فترة الانتظار؛ يرفع TimeoutError بعد انتهاء المهلة"""
+    deadline = time.monotonic() + timeout
+    delay = initial_delay
+    while True:
+        try:
+            with urllib.request.urlopen(url + '/healthz', timeout=max(delay, 0.5)) as response:
+                if response.status == 200:
+                    return True
+        except (urllib.error.URLError, ConnectionError, TimeoutError, OSError):
+            pass
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f'{url}/healthz did not respond within {timeout:g}s')
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
+
+def start_server(host=HOST, port=PORT, app_dir=None):
+    """تشغيل الخادم المدمج، أو لا شيء إذا كان المنفذ محجوزاً بخادم آخر (خدمة الخلفية)
+
+    يعيد الخادم أو None، وفي الحالتين يكفي انتظار wait_for_health على العنوان.
+    """
+    server = EmbeddedServer(host, port, app_dir)
+    try:
+        return server.start()
+    except OSError as e:
+        print(f"Port {port} already in use, waiting for the running server: {e}")
+        return None
+
+if __name__ == '__main__':
+    started = time.perf_counter()
+    server = EmbeddedServer(port=int(sys.argv[1]) if len(sys.argv) > 1 else 0,
+                            app_dir=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    server.start()
+    print(f"port bound after {(time.perf_counter() - started) * 1000:.1f}ms: {server.url}")
+    try:
+        wait_for_health(server.url)
+        print(f"ready after {(time.perf_counter() - started) * 1000:.1f}ms")
+    except TimeoutError as e:
+        print(f"not ready: {server.error or e}")
+    server.shutdown()
@@ -5,52 +5,790 @@
 Medical Records Management System
 """
 
-from flask import Flask, render_template, request, jsonify, redirect, url_for
+from flask import (Flask, render_template, request, jsonify, redirect, url_for, g, has_request_context,
+                   make_response, send_from_directory)
+from werkzeug.http import is_resource_modified
+from jinja2 import FileSystemBytecodeCache, pass_context
+from markupsafe import Markup
 import sqlite3
-from datetime import datetime
+import queue
+import re
+import json
+import base64
+import csv
+import io
+import gzip
+import zlib
+import hashlib
+import shutil
+import tempfile
+import threading
+import time
+import itertools
+import functools
+import bisect
+import array
+import collections
+import zipfile
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import click
+from datetime import datetime, timedelta, timezone
 import os
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'medical-records-2024'
+# JSON بالحروف العربية مباشرة (بايتان للحرف بدل \uXXXX بستة) ودون ترتيب المفاتيح
+app.json.ensure_ascii = False
+app.json.sort_keys = False
 
 # Database setup
 DATABASE = 'medical_records.db'
 
-def get_db():
-    """إنشاء اتصال بقاعدة البيانات"""
-    conn = sqlite3.connect(DATABASE)
+# إعدادات أداء SQLite لكل اتصال
+DB_BUSY_TIMEOUT = 5.0               # ثوانٍ قبل خطأ database is locked
+DB_CACHE_SIZE_KB = 16384            # ذاكرة صفحات 16MB لكل اتصال
+DB_MMAP_SIZE = 64 * 1024 * 1024     # قراءة الملف عبر mmap حتى 64MB
+DB_POOL_SIZE = 8                    # أقصى عدد اتصالات خاملة في كل مجمع
+
+# توحيد الحروف العربية للبحث: أشكال الألف، التاء المربوطة، الألف المقصورة
+_ARABIC_FOLD = {ord(src): dst for src, dst in {
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا',
+    'ة': 'ه',
+    'ى': 'ي',
+}.items()}
+# حذف التشكيل وعلامات القرآن والتطويل
+_ARABIC_FOLD.update({code: None for code in range(0x0610, 0x061B)})
+_ARABIC_FOLD.update({code: None for code in range(0x064B, 0x0660)})
+_ARABIC_FOLD.update({code: None for code in range(0x06D6, 0x06EE)})
+_ARABIC_FOLD[0x0670] = None
+_ARABIC_FOLD[0x0640] = None
+
+def normalize_arabic(text):
+    """توحيد النص العربي للبحث (مُحَمَّد → محمد، أحمد → احمد)"""
+    if text is None:
+        return None
+    return str(text).translate(_ARABIC_FOLD).casefold()
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """مؤشر يقيس زمن كل عبارة SQL وينسبها إلى الطلب الحالي"""
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_sql(self.connection, sql, parameters, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_sql(self.connection, sql, None, time.perf_counter() - started)
+
+    def executescript(self, sql_script):
+        started = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            record_sql(self.connection, sql_script, None, time.perf_counter() - started)
+
+class InstrumentedConnection(sqlite3.Connection):
+    """اتصال تمر كل عباراته عبر InstrumentedCursor، بما فيها conn.execute"""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+def register_functions(conn):
+    """تسجيل دوال SQL التي تستدعيها مشغلات جدول المرضى
+
+    مشغلات فهرس البحث النصي تستدعي normalize_arabic، ومشغلات فهرس المقاطع الثلاثية
+    تستدعي name_key، فأي اتصال يضيف مريضاً أو يعدله يحتاجهما وإلا فشل بـ no such
+    function. اتصالات التطبيق تسجلهما تلقائياً، وسكربتات الصيانة التي تفتح
+    sqlite3.connect بنفسها تستدعي هذه الدالة أولاً.
+    """
+    conn.create_function('normalize_arabic', 1, normalize_arabic, deterministic=True)
+    conn.create_function('name_key', 1, name_key, deterministic=True)
+    return conn
+
+def _connect(readonly=False):
+    """فتح اتصال جديد مضبوط بإعدادات الأداء"""
+    conn = sqlite3.connect(DATABASE, timeout=DB_BUSY_TIMEOUT, check_same_thread=False,
+                           factory=InstrumentedConnection)
     conn.row_factory = sqlite3.Row
+    register_functions(conn)
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA cache_size = -{DB_CACHE_SIZE_KB}')
+    conn.execute(f'PRAGMA mmap_size = {DB_MMAP_SIZE}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    if readonly:
+        # اتصالات القراءة لا تكتب أبداً، فلا تنتظر خلف عمليات الكتابة في وضع WAL
+        conn.execute('PRAGMA query_only = ON')
     return conn
 
-def init_db():
-    """إنشاء جداول قاعدة البيانات"""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    # حذف الجدول القديم إذا كان موجوداً وإعادة إنشائه
-    # هذا يحل مشكلة الأعمدة الناقصة
+class ConnectionPool:
+    """مجمع اتصالات يعيد استخدام الاتصالات المفتوحة بين الطلبات"""
+
+    def __init__(self, database, readonly=False, size=DB_POOL_SIZE):
+        self.database = database
+        self.readonly = readonly
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def acquire(self):
+        """أخذ اتصال خامل أو فتح اتصال جديد"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return _connect(self.readonly)
+
+    def release(self, conn):
+        """إرجاع الاتصال إلى المجمع بعد إلغاء أي معاملة معلقة"""
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close_all(self):
+        """إغلاق جميع الاتصالات الخاملة"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+_pools = {}
+
+def _get_pool(readonly):
+    """مجمع الاتصالات الخاص بقاعدة البيانات الحالية"""
+    key = (DATABASE, readonly)
+    pool = _pools.get(key)
+    if pool is None:
+        pool = _pools.setdefault(key, ConnectionPool(DATABASE, readonly))
+    return pool
+
+def close_pools():
+    """إغلاق جميع الاتصالات المجمعة (عند الاستعادة أو الإيقاف)"""
+    for pool in list(_pools.values()):
+        pool.close_all()
+    _pools.clear()
+
+def get_db(readonly=None):
+    """الحصول على اتصال قاعدة البيانات الخاص بالطلب الحالي
+
+    طلبات GET/HEAD تحصل على اتصال للقراءة فقط، وبقية الطلبات على اتصال كتابة.
+    الاتصال يبقى نفسه طوال الطلب ويعاد إلى المجمع عند انتهائه.
+    """
+    if readonly is None:
+        readonly = has_request_context() and request.method in ('GET', 'HEAD')
+    key = '_db_ro' if readonly else '_db_rw'
+    held = g.get(key)
+    if held is None:
+        pool = _get_pool(readonly)
+        held = (pool, pool.acquire())
+        setattr(g, key, held)
+    return held[1]
+
+@app.teardown_appcontext
+def release_db(exception):
+    """إرجاع اتصالات الطلب إلى المجمع"""
+    for key in ('_db_ro', '_db_rw'):
+        held = g.pop(key, None)
+        if held is not None:
+            pool, conn = held
+            pool.release(conn)
+
+# ===== مراقبة الأداء =====
+# لكل مسار: عدد الطلبات، توزيع زمن الاستجابة، حجم الاستجابات، وعدد وزمن عبارات SQL
+
+METRICS_ENABLED = os.environ.get('MEDICAL_METRICS', '1') != '0'
+# حدود مدرج زمن الاستجابة بالثواني (مثل Prometheus)
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def record_sql(conn, sql, parameters, elapsed):
+    """إضافة عبارة SQL منفذة إلى إحصاءات الطلب الحالي وسجل الاستعلامات البطيئة"""
+    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+        slow_queries.capture(conn, sql, parameters, elapsed)
+    if not METRICS_ENABLED:
+        return
+    # عبارات خيط الكتابة تنسب إلى الطلب الذي أرسل المهمة
+    stats = g.get('_sql_stats') if has_request_context() else getattr(_sql_target, 'stats', None)
+    if stats is not None:
+        stats[0] += 1
+        stats[1] += elapsed
+
+_sql_target = threading.local()
+
+class RouteMetrics:
+    """إحصاءات مسار واحد"""
+
+    __slots__ = ('requests', 'errors', 'buckets', 'duration_sum', 'response_bytes',
+                 'sql_statements', 'sql_seconds', 'not_modified', 'not_modified_seconds',
+                 'not_modified_sql_statements', 'uncompressed_bytes')
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.buckets = [0] * (len(METRICS_BUCKETS) + 1)
+        self.duration_sum = 0.0
+        self.response_bytes = 0
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.not_modified = 0
+        self.not_modified_seconds = 0.0
+        self.not_modified_sql_statements = 0
+        self.uncompressed_bytes = 0
+
+    def observe(self, duration, status, size, sql_statements, sql_seconds, uncompressed=None):
+        self.requests += 1
+        if status >= 500:
+            self.errors += 1
+        self.buckets[bisect.bisect_left(METRICS_BUCKETS, duration)] += 1
+        self.duration_sum += duration
+        self.response_bytes += size
+        self.uncompressed_bytes += size if uncompressed is None else uncompressed
+        self.sql_statements += sql_statements
+        self.sql_seconds += sql_seconds
+        if status == 304:
+            self.not_modified += 1
+            self.not_modified_seconds += duration
+            self.not_modified_sql_statements += sql_statements
+
+    def saved_by_not_modified(self):
+        """تقدير ما وفرته استجابات 304: (الزمن، البايتات، عبارات SQL) مقارنة بمتوسط الاستجابات الكاملة"""
+        full = self.requests - self.not_modified
+        if not full or not self.not_modified:
+            return 0.0, 0, 0
+        full_seconds = (self.duration_sum - self.not_modified_seconds) / full
+        full_statements = (self.sql_statements - self.not_modified_sql_statements) / full
+        return (max(full_seconds * self.not_modified - self.not_modified_seconds, 0.0),
+                self.response_bytes // full * self.not_modified,
+                max(round(full_statements * self.not_modified) - self.not_modified_sql_statements, 0))
+
+    def quantile(self, fraction):
+        """تقدير النسبة المئوية من المدرج: الحد الأعلى للخانة التي تقع فيها، أو None فوق آخر حد"""
+        target = self.requests * fraction
+        seen = 0
+        for bound, count in zip(METRICS_BUCKETS, self.buckets):
+            seen += count
+            if seen >= target:
+                return bound
+        return None
+
+    def as_dict(self):
+        cumulative = list(itertools.accumulate(self.buckets))
+        saved_seconds, saved_bytes, saved_statements = self.saved_by_not_modified()
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'latency_avg_ms': round(self.duration_sum * 1000 / self.requests, 3),
+            'latency_p50_ms': _bound_ms(self.quantile(0.50)),
+            'latency_p95_ms': _bound_ms(self.quantile(0.95)),
+            'latency_p99_ms': _bound_ms(self.quantile(0.99)),
+            # أزواج [الحد الأعلى بالثواني، العدد التراكمي] بترتيب الحدود
+            'latency_histogram': [[str(bound), count] for bound, count in
+                                  zip(METRICS_BUCKETS + ('+Inf',), cumulative)],
+            'response_bytes_total': self.response_bytes,
+            'response_bytes_avg': self.response_bytes // self.requests,
+            # الفرق بين حجم الاستجابات قبل الضغط وما أرسل فعلاً
+            'compression_saved_bytes': self.uncompressed_bytes - self.response_bytes,
+            'sql_statements_total': self.sql_statements,
+            'sql_statements_avg': round(self.sql_statements / self.requests, 2),
+            'sql_seconds_total': round(self.sql_seconds, 6),
+            'not_modified': self.not_modified,
+            'not_modified_saved_ms': round(saved_seconds * 1000, 3),
+            'not_modified_saved_bytes': saved_bytes,
+            'not_modified_saved_sql_statements': saved_statements,
+        }
+
+def _bound_ms(bound):
+    return None if bound is None else round(bound * 1000, 3)
+
+class MetricsRegistry:
+    """سجل الإحصاءات لكل المسارات، آمن للاستخدام من عدة خيوط"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+        self.started = time.time()
+
+    def observe(self, endpoint, duration, status, size, sql_statements, sql_seconds, uncompressed=None):
+        with self._lock:
+            route = self._routes.get(endpoint)
+            if route is None:
+                route = self._routes[endpoint] = RouteMetrics()
+            route.observe(duration, status, size, sql_statements, sql_seconds, uncompressed)
+
+    def snapshot(self):
+        with self._lock:
+            return {endpoint: route.as_dict() for endpoint, route in sorted(self._routes.items())}
+
+    def prometheus(self):
+        """الإحصاءات بصيغة Prometheus النصية"""
+        with self._lock:
+            routes = [(endpoint, route.as_dict(), route.duration_sum)
+                      for endpoint, route in sorted(self._routes.items())]
+        lines = []
+
+        def emit(name, kind, help_text, field):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for endpoint, data, _ in routes:
+                lines.append(f'{name}{{endpoint="{endpoint}"}} {data[field]}')
+
+        emit('medical_http_requests_total', 'counter', 'Requests handled per endpoint.', 'requests')
+        emit('medical_http_errors_total', 'counter', 'Responses with a 5xx status.', 'errors')
+
+        name = 'medical_http_request_duration_seconds'
+        lines.append(f'# HELP {name} Request latency.')
+        lines.append(f'# TYPE {name} histogram')
+        for endpoint, data, duration_sum in routes:
+            for bound, count in data['latency_histogram']:
+                lines.append(f'{name}_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+            lines.append(f'{name}_sum{{endpoint="{endpoint}"}} {duration_sum:.6f}')
+            lines.append(f'{name}_count{{endpoint="{endpoint}"}} {data["requests"]}')
+
+        emit('medical_http_response_bytes_total', 'counter', 'Response body bytes sent.',
+             'response_bytes_total')
+        emit('medical_http_compression_saved_bytes_total', 'counter',
+             'Response body bytes saved by compression.', 'compression_saved_bytes')
+        emit('medical_sql_statements_total', 'counter', 'SQL statements executed.',
+             'sql_statements_total')
+        emit('medical_sql_duration_seconds_total', 'counter', 'Time spent executing SQL.',
+             'sql_seconds_total')
+        emit('medical_http_not_modified_total', 'counter', 'Conditional requests answered with 304.',
+             'not_modified')
+        emit('medical_http_not_modified_saved_bytes_total', 'counter',
+             'Estimated body bytes not sent thanks to 304 responses.', 'not_modified_saved_bytes')
+        lines.append('# HELP medical_uptime_seconds Seconds since the process started.')
+        lines.append('# TYPE medical_uptime_seconds gauge')
+        lines.append(f'medical_uptime_seconds {time.time() - self.started:.0f}')
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+
+@app.before_request
+def start_request_metrics():
+    """بدء قياس الطلب"""
+    if METRICS_ENABLED:
+        g._request_started = time.perf_counter()
+        g._sql_stats = [0, 0.0]
+
+@app.after_request
+def record_request_metrics(response):
+    """تسجيل زمن الطلب وحجم الاستجابة وإحصاءات SQL للمسار"""
+    started = g.pop('_request_started', None)
+    if started is not None:
+        sql_statements, sql_seconds = g.pop('_sql_stats', (0, 0.0))
+        # الاستجابات المتدفقة (ZIP، النسخ الاحتياطية) لا يعرف حجمها مسبقاً
+        size = 0 if response.is_streamed else (response.content_length or 0)
+        metrics.observe(request.endpoint or 'unmatched', time.perf_counter() - started,
+                        response.status_code, size, sql_statements, sql_seconds,
+                        g.pop('_uncompressed_bytes', None))
+    return response
+
+@app.route('/api/metrics')
+def metrics_endpoint():
+    """إحصاءات الأداء لكل مسار بصيغة JSON أو Prometheus (format=prometheus)"""
+    if request.args.get('format') == 'prometheus' or (
+            'text/plain' in request.headers.get('Accept', '')
+            and 'application/json' not in request.headers.get('Accept', '')):
+        return app.response_class(metrics.prometheus(),
+                                  mimetype='text/plain; version=0.0.4; charset=utf-8')
+    return jsonify({
+        'enabled': METRICS_ENABLED,
+        'uptime_seconds': round(time.time() - metrics.started),
+        'routes': metrics.snapshot(),
+        'fragment_cache': fragment_cache.snapshot(),
+        'digits_index': digits_index.snapshot(),
+    })
+
+# ===== سجل الاستعلامات البطيئة =====
+# اختياري: MEDICAL_SLOW_QUERY_MS=50 يسجل كل عبارة تستغرق 50ms أو أكثر مع خطة تنفيذها
+
+SLOW_QUERY_MS = float(os.environ.get('MEDICAL_SLOW_QUERY_MS', '0'))
+SLOW_QUERY_LOG_SIZE = 200
+
+_SQL_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+def _redact_sql(sql):
+    """إخفاء القيم النصية المكتوبة داخل العبارة وتوحيد المسافات"""
+    return ' '.join(_SQL_STRING_LITERAL.sub("'?'", sql).split())
+
+def _redact_parameters(parameters):
+    """استبدال قيم المعاملات بأنواعها فقط (لا تسجل بيانات المرضى)"""
+    if parameters is None:
+        return None
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in parameters.items()}
+    return [type(value).__name__ for value in parameters]
+
+class SlowQueryLog:
+    """حلقة محدودة من آخر الاستعلامات البطيئة مع خطط تنفيذها"""
+
+    def __init__(self, size=SLOW_QUERY_LOG_SIZE):
+        self._lock = threading.Lock()
+        self._entries = collections.deque(maxlen=size)
+        self.captured = 0
+
+    def capture(self, conn, sql, parameters, elapsed):
+        plan = self._explain(conn, sql, parameters)
+        # SCAN تعني المرور على كل صفوف الجدول (ولو بترتيب فهرس)، بخلاف SEARCH
+        full_scans = [row['detail'] for row in plan
+                      if row['detail'].startswith('SCAN ') and 'VIRTUAL TABLE' not in row['detail']
+                      and row['detail'] != 'SCAN CONSTANT ROW']
+        entry = {
+            'at': datetime.now().isoformat(timespec='milliseconds'),
+            'duration_ms': round(elapsed * 1000, 3),
+            'endpoint': request.endpoint if has_request_context() else threading.current_thread().name,
+            'path': request.path if has_request_context() else None,
+            'sql': _redact_sql(sql),
+            'parameters': _redact_parameters(parameters),
+            'plan': plan,
+            'full_scans': full_scans,
+        }
+        with self._lock:
+            self._entries.append(entry)
+            self.captured += 1
+        app.logger.warning('slow query %.1fms in %s%s: %s', entry['duration_ms'], entry['endpoint'],
+                           ' [FULL SCAN: %s]' % ', '.join(full_scans) if full_scans else '', entry['sql'])
+
+    @staticmethod
+    def _explain(conn, sql, parameters):
+        """خطة التنفيذ عبر EXPLAIN QUERY PLAN على الاتصال نفسه وبالمعاملات نفسها"""
+        # executemany و executescript لا تحفظ معاملاتها، فلا تشرح خطتها
+        if parameters is None or not sql.lstrip().upper().startswith(_EXPLAINABLE):
+            return []
+        try:
+            # الصنف الأساسي مباشرة حتى لا يقاس EXPLAIN نفسه أو يسجل
+            rows = sqlite3.Connection.execute(conn, 'EXPLAIN QUERY PLAN ' + sql, parameters).fetchall()
+        except sqlite3.Error:
+            return []
+        return [{'id': row[0], 'parent': row[1], 'detail': row[3]} for row in rows]
+
+    def entries(self):
+        with self._lock:
+            return list(reversed(self._entries))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+slow_queries = SlowQueryLog()
+
+@app.route('/admin/slow-queries', methods=['GET', 'DELETE'])
+def slow_queries_view():
+    """آخر الاستعلامات البطيئة (الأحدث أولاً)، أو مسح السجل بطلب DELETE"""
+    if request.method == 'DELETE':
+        slow_queries.clear()
+        return jsonify({'success': True})
+    entries = slow_queries.entries()
+    if request.args.get('full_scans_only') in ('1', 'true'):
+        entries = [entry for entry in entries if entry['full_scans']]
+    return jsonify({
+        'enabled': bool(SLOW_QUERY_MS),
+        'threshold_ms': SLOW_QUERY_MS,
+        'captured_total': slow_queries.captured,
+        'entries': entries,
+    })
+
+# ===== طابور الكتابة =====
+# كل عمليات الكتابة من الطلبات تنفذ في خيط واحد يملك اتصال الكتابة، فلا تتنافس
+# الطلبات على قفل SQLite. المهام المتراكمة تنفذ معاً في معاملة واحدة (group commit)
+# وكل مهمة داخل SAVEPOINT خاص بها حتى لا يلغي فشل إحداها بقية المجموعة.
+
+WRITE_QUEUE_ENABLED = os.environ.get('MEDICAL_WRITE_QUEUE', '1') != '0'
+WRITE_BATCH_SIZE = 64
+
+class _WriteJob:
+    __slots__ = ('fn', 'sql_stats', 'exclusive', 'done', 'result', 'error')
+
+    def __init__(self, fn, sql_stats, exclusive=False):
+        self.fn = fn
+        self.sql_stats = sql_stats
+        self.exclusive = exclusive
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class WriteQueue:
+    """خيط كتابة واحد ينفذ المهام بالترتيب ويثبتها على دفعات"""
+
+    def __init__(self, batch_size=WRITE_BATCH_SIZE):
+        self.batch_size = batch_size
+        self._jobs = queue.Queue()
+        self._pending = None        # مهمة منفردة وصلت أثناء جمع دفعة
+        self._thread = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.jobs = 0
+
+    def submit(self, fn, exclusive=False):
+        """تنفيذ fn(cursor) في خيط الكتابة وانتظار نتيجتها (أو إعادة رفع خطئها)
+
+        exclusive: تنفذ fn(conn) وحدها خارج أي دفعة وتدير معاملتها بنفسها (الاستيراد
+        الجماعي)، والكتابات الأخرى تنتظر في الطابور حتى تنتهي.
+        """
+        self._ensure_started()
+        job = _WriteJob(fn, g.get('_sql_stats') if has_request_context() else None, exclusive)
+        self._jobs.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='sqlite-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            job, self._pending = self._pending or self._jobs.get(), None
+            if job.exclusive:
+                self._run_exclusive(job)
+                continue
+            batch = [job]
+            while len(batch) < self.batch_size:
+                try:
+                    job = self._jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job.exclusive:
+                    self._pending = job
+                    break
+                batch.append(job)
+            self._commit_batch(batch)
+
+    def _run_exclusive(self, job):
+        pool = _get_pool(False)
+        conn = pool.acquire()
+        try:
+            _sql_target.stats = job.sql_stats
+            job.result = job.fn(conn)
+        except Exception as e:
+            job.error = e
+        finally:
+            _sql_target.stats = None
+            if conn.in_transaction:
+                conn.rollback()
+            pool.release(conn)
+            job.done.set()
+
+    def _commit_batch(self, batch):
+        # الاتصال يؤخذ من المجمع لكل دفعة، فيتبع تغيير DATABASE أو close_pools
+        pool = _get_pool(False)
+        conn = pool.acquire()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            cursor = conn.cursor()
+            for job in batch:
+                _sql_target.stats = job.sql_stats
+                conn.execute('SAVEPOINT write_job')
+                try:
+                    job.result = job.fn(cursor)
+                    conn.execute('RELEASE write_job')
+                except Exception as e:
+                    conn.execute('ROLLBACK TO write_job')
+                    conn.execute('RELEASE write_job')
+                    job.error = e
+            _sql_target.stats = None
+            conn.commit()
+            self.batches += 1
+            self.jobs += len(batch)
+        except Exception as e:
+            _sql_target.stats = None
+            if conn.in_transaction:
+                conn.rollback()
+            for job in batch:
+                if job.error is None:
+                    job.error = e
+        finally:
+            pool.release(conn)
+            for job in batch:
+                job.done.set()
+
+write_queue = WriteQueue()
+
+def run_write(fn):
+    """تنفيذ fn(cursor) كمعاملة كتابة وإرجاع نتيجتها
+
+    عبر خيط الكتابة افتراضياً، أو مباشرة على اتصال الطلب إذا كان
+    MEDICAL_WRITE_QUEUE=0 (للمقارنة في قياسات الأداء). إذا حمل الطلب مفتاح
+    منع التكرار تنفذ fn مرة واحدة فقط لهذا المفتاح (انظر idempotent_job).
+    """
+    job = idempotent_job(fn)
+    if WRITE_QUEUE_ENABLED:
+        return finish_idempotent_job(write_queue.submit(job))
+    conn = get_db(readonly=False)
     try:
-        # التحقق من وجود الجدول القديم
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='patients'")
-        if cursor.fetchone():
-            # الجدول موجود، نتحقق من الأعمدة
-            cursor.execute("PRAGMA table_info(patients)")
-            columns = [col[1] for col in cursor.fetchall()]
-            
-            # إذا كانت الأعمدة ناقصة، نعيد إنشاء الجدول
-            required_columns = ['email', 'national_id', 'blood_type', 'allergies']
-            if not all(col in columns for col in required_columns):
-                print("تحديث جدول المرضى...")
-                # نسخ البيانات القديمة
-                cursor.execute('''
-                    CREATE TABLE patients_backup AS 
-                    SELECT * FROM patients
-                ''')
-                # حذف الجدول القديم
-                cursor.execute('DROP TABLE patients')
-    except:
-        pass
-    
+        result = job(conn.cursor())
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return finish_idempotent_job(result)
+
+def run_exclusive_write(fn):
+    """تنفيذ fn(conn) التي تدير معاملتها بنفسها، وحدها في خيط الكتابة"""
+    if WRITE_QUEUE_ENABLED:
+        return write_queue.submit(fn, exclusive=True)
+    return fn(get_db(readonly=False))
+
+# ===== مفاتيح منع التكرار =====
+# طلب الكتابة الذي يحمل ترويسة Idempotency-Key ينفذ مرة واحدة فقط: المفتاح ونتيجة
+# الكتابة يحفظان في معاملة الكتابة نفسها، فإعادة إرسال الطلب (من طابور عامل الخدمة
+# بعد انقطاع الشبكة مثلاً) تعيد النتيجة المحفوظة ولا تنشئ زيارة أو دفعة مكررة.
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+IDEMPOTENCY_KEY_MAX_LENGTH = 128
+IDEMPOTENCY_TTL_DAYS = 30
+
+class IdempotencyKeyReused(Exception):
+    """المفتاح استخدم من قبل لطلب مختلف"""
+
+class _Replayed:
+    """نتيجة محفوظة أعيدت لطلب مكرر"""
+    __slots__ = ('result',)
+
+    def __init__(self, result):
+        self.result = result
+
+@app.before_request
+def read_idempotency_key():
+    """قراءة مفتاح منع التكرار من طلبات الكتابة والتحقق من صيغته"""
+    if request.method != 'POST':
+        return None
+    key = request.headers.get(IDEMPOTENCY_HEADER, '').strip()
+    if not key:
+        return None
+    if len(key) > IDEMPOTENCY_KEY_MAX_LENGTH or not (key.isascii() and key.isprintable()):
+        return jsonify({'success': False, 'error': 'مفتاح منع التكرار غير صالح'}), 400
+    g.idempotency_key = key
+    return None
+
+def idempotent_job(fn):
+    """تغليف مهمة الكتابة بحيث تنفذ مرة واحدة لكل مفتاح
+
+    المفتاح يحجز أولاً في المعاملة نفسها، فالطلب المكرر المتزامن ينتظر قفل الكتابة
+    ثم يجد المفتاح محجوزاً ويقرأ النتيجة المحفوظة. إذا فشلت الكتابة يلغى الحجز معها
+    ويمكن إعادة المحاولة بالمفتاح نفسه. النتيجة تحفظ بصيغة JSON.
+    """
+    # المفتاح يخص أول كتابة في الطلب فقط
+    key = g.pop('idempotency_key', None) if has_request_context() else None
+    if key is None:
+        return fn
+    request_hash = hashlib.sha256(request.path.encode('utf-8') + b'\0' + request.get_data()).hexdigest()
+
+    def job(cursor):
+        cursor.execute('''
+            INSERT INTO idempotency_keys (key, request_hash) VALUES (?, ?)
+            ON CONFLICT (key) DO NOTHING
+        ''', (key, request_hash))
+        if cursor.rowcount == 0:
+            cursor.execute('SELECT request_hash, result FROM idempotency_keys WHERE key = ?', (key,))
+            stored_hash, stored_result = cursor.fetchone()
+            if stored_hash != request_hash:
+                raise IdempotencyKeyReused(key)
+            return _Replayed(json.loads(stored_result))
+
+        result = fn(cursor)
+        cursor.execute('UPDATE idempotency_keys SET result = ? WHERE key = ?',
+                       (json.dumps(result, ensure_ascii=False), key))
+        cursor.execute('''
+            DELETE FROM idempotency_keys
+            WHERE created_at < strftime('%Y-%m-%dT%H:%M:%fZ', 'now', ?)
+        ''', (f'-{IDEMPOTENCY_TTL_DAYS} days',))
+        return result
+
+    return job
+
+def finish_idempotent_job(result):
+    """إرجاع نتيجة الكتابة، مع تعليم الاستجابة إذا كانت نتيجة محفوظة لطلب مكرر"""
+    if isinstance(result, _Replayed):
+        g.idempotent_replay = True
+        return result.result
+    return result
+
+@app.after_request
+def mark_idempotent_replay(response):
+    """ترويسة Idempotent-Replayed على استجابات الطلبات المكررة"""
+    if g.pop('idempotent_replay', False):
+        response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+@app.errorhandler(IdempotencyKeyReused)
+def idempotency_key_reused(error):
+    """الطلب أعاد استخدام مفتاح طلب آخر"""
+    return jsonify({'success': False, 'error': 'مفتاح منع التكرار مستخدم لطلب مختلف'}), 422
+
+# ===== ترحيلات قاعدة البيانات =====
+# كل خطوة تنفذ مرة واحدة فقط، ورقم آخر خطوة منفذة محفوظ في PRAGMA user_version
+
+# أعمدة أضيفت بعد النسخ الأولى من الجداول، تضاف في مكانها بـ ALTER TABLE
+LEGACY_COLUMNS = {
+    'patients': [
+        ('email', 'TEXT'),
+        ('national_id', 'TEXT'),
+        ('blood_type', 'TEXT'),
+        ('allergies', 'TEXT'),
+        ('chronic_diseases', 'TEXT'),
+        ('current_medications', 'TEXT'),
+        ('emergency_contact', 'TEXT'),
+        ('emergency_phone', 'TEXT'),
+        ('insurance_company', 'TEXT'),
+        ('insurance_number', 'TEXT'),
+        ('notes', 'TEXT'),
+    ],
+    'visits': [
+        ('doctor_id', 'INTEGER'),
+        ('symptoms', 'TEXT'),
+        ('prescriptions', 'TEXT'),
+        ('lab_tests', 'TEXT'),
+        ('vital_signs', 'TEXT'),
+        ('next_visit_date', 'TEXT'),
+    ],
+}
+
+def _table_columns(cursor, table):
+    """أسماء أعمدة الجدول"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    return [col[1] for col in cursor.fetchall()]
+
+def _table_exists(cursor, table):
+    """التحقق من وجود جدول"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,))
+    return cursor.fetchone() is not None
+
+def _restore_backup_table(cursor, table):
+    """استعادة صفوف جدول نسخ احتياطي تركته الترقيات القديمة (حذف ونسخ)"""
+    backup = f'{table}_backup'
+    if not _table_exists(cursor, backup):
+        return
+    columns = set(_table_columns(cursor, table))
+    common = [col for col in _table_columns(cursor, backup) if col in columns]
+    column_list = ', '.join(common)
+    cursor.execute(f'INSERT OR IGNORE INTO {table} ({column_list}) SELECT {column_list} FROM {backup}')
+    cursor.execute(f'DROP TABLE {backup}')
+    print(f"تم استعادة بيانات {table} القديمة بنجاح!")
+
+def _migration_1_base_schema(cursor):
+    """المخطط الأساسي، مع إضافة الأعمدة الناقصة في قواعد البيانات القديمة"""
     # جدول المرضى - موسع بمعلومات طبية
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS patients (
@@ -75,21 +813,6 @@ def init_db():
         )
     ''')
     
-    # استعادة البيانات القديمة إذا كانت موجودة
-    try:
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='patients_backup'")
-        if cursor.fetchone():
-            cursor.execute('''
-                INSERT INTO patients (id, name, age, gender, phone, address, created_date)
-                SELECT id, name, age, gender, phone, address, created_date
-                FROM patients_backup
-            ''')
-            cursor.execute('DROP TABLE patients_backup')
-            print("تم استعادة البيانات القديمة بنجاح!")
-    except:
-        pass
-    
-    
     # جدول الأطباء
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS doctors (
@@ -135,21 +858,6 @@ def init_db():
     # إضافة إعدادات افتراضية إذا لم تكن موجودة
     cursor.execute('INSERT OR IGNORE INTO clinic_settings (id) VALUES (1)')
     
-    # التحقق من جدول الزيارات وتحديثه
-    try:
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='visits'")
-        if cursor.fetchone():
-            cursor.execute("PRAGMA table_info(visits)")
-            columns = [col[1] for col in cursor.fetchall()]
-            
-            required_columns = ['symptoms', 'vital_signs', 'prescriptions', 'lab_tests', 'doctor_id']
-            if not all(col in columns for col in required_columns):
-                print("تحديث جدول الزيارات...")
-                cursor.execute('CREATE TABLE visits_backup AS SELECT * FROM visits')
-                cursor.execute('DROP TABLE visits')
-    except:
-        pass
-    
     # جدول الزيارات الطبية
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS visits (
@@ -172,22 +880,6 @@ def init_db():
         )
     ''')
     
-    # استعادة بيانات الزيارات القديمة
-    try:
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='visits_backup'")
-        if cursor.fetchone():
-            cursor.execute('''
-                INSERT INTO visits (id, patient_id, visit_date, diagnosis, treatment, 
-                                  notes, total_cost, paid_amount)
-                SELECT id, patient_id, visit_date, diagnosis, treatment, 
-                       notes, total_cost, paid_amount
-                FROM visits_backup
-            ''')
-            cursor.execute('DROP TABLE visits_backup')
-            print("تم استعادة بيانات الزيارات بنجاح!")
-    except:
-        pass
-    
     # جدول المواعيد
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS appointments (
@@ -216,8 +908,1804 @@ def init_db():
         )
     ''')
     
+    # إضافة الأعمدة الناقصة في مكانها بدلاً من حذف الجدول ونسخه
+    for table, columns in LEGACY_COLUMNS.items():
+        existing = _table_columns(cursor, table)
+        for name, column_type in columns:
+            if name not in existing:
+                print(f"تحديث جدول {table}: إضافة العمود {name}")
+                cursor.execute(f'ALTER TABLE {table} ADD COLUMN {name} {column_type}')
+        _restore_backup_table(cursor, table)
+
+def _migration_2_indexes(cursor):
+    """الفهارس التي تحتاجها الاستعلامات"""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_visits_patient ON visits (patient_id, visit_date)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_visits_date ON visits (visit_date)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_payments_visit ON payments (visit_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_appointments_date ON appointments (appointment_date, appointment_time)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_appointments_patient ON appointments (patient_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_visit_doctors_doctor ON visit_doctors (doctor_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_patients_name ON patients (name)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_patients_phone ON patients (phone)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_patients_national_id ON patients (national_id)')
+
+def _migration_3_patient_balances(cursor):
+    """جدول أرصدة المرضى المحدث تلقائياً بالمشغلات"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS patient_balances (
+            patient_id INTEGER PRIMARY KEY,
+            total_charges REAL NOT NULL DEFAULT 0,
+            total_paid REAL NOT NULL DEFAULT 0,
+            total_debt REAL NOT NULL DEFAULT 0,
+            visit_count INTEGER NOT NULL DEFAULT 0,
+            last_visit_date TIMESTAMP,
+            FOREIGN KEY (patient_id) REFERENCES patients (id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_patient_balances_debt ON patient_balances (total_debt DESC)')
+    
+    # كل مريض له صف رصيد واحد
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_balances_patient_insert
+        AFTER INSERT ON patients
+        BEGIN
+            INSERT OR IGNORE INTO patient_balances (patient_id) VALUES (new.id);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_balances_patient_delete
+        AFTER DELETE ON patients
+        BEGIN
+            DELETE FROM patient_balances WHERE patient_id = old.id;
+        END
+    ''')
+    
+    # المبالغ تقرب لخانتين عشريتين حتى لا تتراكم أخطاء الكسور العشرية
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_balances_visit_insert
+        AFTER INSERT ON visits
+        BEGIN
+            INSERT OR IGNORE INTO patient_balances (patient_id) VALUES (new.patient_id);
+            UPDATE patient_balances
+            SET total_charges = ROUND(total_charges + COALESCE(new.total_cost, 0), 2),
+                total_paid = ROUND(total_paid + COALESCE(new.paid_amount, 0), 2),
+                total_debt = ROUND(total_charges + COALESCE(new.total_cost, 0)
+                                   - total_paid - COALESCE(new.paid_amount, 0), 2),
+                visit_count = visit_count + 1,
+                last_visit_date = CASE
+                    WHEN last_visit_date IS NULL OR new.visit_date > last_visit_date
+                    THEN new.visit_date ELSE last_visit_date END
+            WHERE patient_id = new.patient_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_balances_visit_delete
+        AFTER DELETE ON visits
+        BEGIN
+            UPDATE patient_balances
+            SET total_charges = ROUND(total_charges - COALESCE(old.total_cost, 0), 2),
+                total_paid = ROUND(total_paid - COALESCE(old.paid_amount, 0), 2),
+                total_debt = ROUND(total_charges - COALESCE(old.total_cost, 0)
+                                   - total_paid + COALESCE(old.paid_amount, 0), 2),
+                visit_count = visit_count - 1,
+                last_visit_date = (SELECT MAX(visit_date) FROM visits WHERE patient_id = old.patient_id)
+            WHERE patient_id = old.patient_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_balances_visit_update
+        AFTER UPDATE OF patient_id, total_cost, paid_amount, visit_date ON visits
+        BEGIN
+            UPDATE patient_balances
+            SET total_charges = ROUND(total_charges - COALESCE(old.total_cost, 0), 2),
+                total_paid = ROUND(total_paid - COALESCE(old.paid_amount, 0), 2),
+                total_debt = ROUND(total_charges - COALESCE(old.total_cost, 0)
+                                   - total_paid + COALESCE(old.paid_amount, 0), 2),
+                visit_count = visit_count - 1
+            WHERE patient_id = old.patient_id;
+            INSERT OR IGNORE INTO patient_balances (patient_id) VALUES (new.patient_id);
+            UPDATE patient_balances
+            SET total_charges = ROUND(total_charges + COALESCE(new.total_cost, 0), 2),
+                total_paid = ROUND(total_paid + COALESCE(new.paid_amount, 0), 2),
+                total_debt = ROUND(total_charges + COALESCE(new.total_cost, 0)
+                                   - total_paid - COALESCE(new.paid_amount, 0), 2),
+                visit_count = visit_count + 1
+            WHERE patient_id = new.patient_id;
+            UPDATE patient_balances
+            SET last_visit_date = (SELECT MAX(visit_date) FROM visits WHERE patient_id = patient_balances.patient_id)
+            WHERE patient_id IN (old.patient_id, new.patient_id);
+        END
+    ''')
+    
+    rebuild_patient_balances(cursor)
+
+def _migration_4_patient_search(cursor):
+    """فهرس البحث النصي FTS5 للمرضى مع توحيد الحروف العربية"""
+    # rowid في الفهرس هو رقم المريض، والنصوص مخزنة بعد التوحيد
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS patients_fts USING fts5(
+            name, phone, national_id, email,
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+    ''')
+    
+    # المشغلات تستدعي normalize_arabic المسجلة في _connect
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_search_patient_insert
+        AFTER INSERT ON patients
+        BEGIN
+            INSERT INTO patients_fts (rowid, name, phone, national_id, email)
+            VALUES (new.id, normalize_arabic(new.name), new.phone, new.national_id,
+                    normalize_arabic(new.email));
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_search_patient_update
+        AFTER UPDATE OF name, phone, national_id, email ON patients
+        BEGIN
+            DELETE FROM patients_fts WHERE rowid = old.id;
+            INSERT INTO patients_fts (rowid, name, phone, national_id, email)
+            VALUES (new.id, normalize_arabic(new.name), new.phone, new.national_id,
+                    normalize_arabic(new.email));
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_search_patient_delete
+        AFTER DELETE ON patients
+        BEGIN
+            DELETE FROM patients_fts WHERE rowid = old.id;
+        END
+    ''')
+    
+    rebuild_patient_search(cursor)
+
+def _migration_5_list_pagination(cursor):
+    """فهرس التصفح بالمؤشر في قائمة المرضى"""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_patients_created ON patients (created_date, id)')
+
+def _migration_6_dashboard_stats(cursor):
+    """عدادات لوحة التحكم المحدثة تلقائياً بالمشغلات"""
+    # صف واحد للإجماليات، و version يزيد مع كل تغيير
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS dashboard_totals (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total_patients INTEGER NOT NULL DEFAULT 0,
+            total_visits INTEGER NOT NULL DEFAULT 0,
+            total_revenue REAL NOT NULL DEFAULT 0,
+            total_collected REAL NOT NULL DEFAULT 0,
+            version INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT
+        )
+    ''')
+    # صف لكل يوم بالتوقيت المحلي، فيتغير "اليوم" تلقائياً عند منتصف الليل
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT PRIMARY KEY,
+            visits INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0,
+            scheduled_appointments INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+    
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_dashboard_patient_insert
+        AFTER INSERT ON patients
+        BEGIN
+            UPDATE dashboard_totals
+            SET total_patients = total_patients + 1,
+                version = version + 1, updated_at = strftime('%Y-%m-%dT%H:%M:%fZ', 'now')
+            WHERE id = 1;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_dashboard_patient_delete
+        AFTER DELETE ON patients
+        BEGIN
+            UPDATE dashboard_totals
+            SET total_patients = total_patients - 1,
+                version = version + 1, updated_at = strftime('%Y-%m-%dT%H:%M:%fZ', 'now')
+            WHERE id = 1;
+        END
+    ''')
+    
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_dashboard_visit_insert
+        AFTER INSERT ON visits
+        BEGIN
+            UPDATE dashboard_totals
+            SET total_visits = total_visits + 1,
+                total_revenue = ROUND(total_revenue + COALESCE(new.total_cost, 0), 2),
+                total_collected = ROUND(total_collected + COALESCE(new.paid_amount, 0), 2),
+                version = version + 1, updated_at = strftime('%Y-%m-%dT%H:%M:%fZ', 'now')
+            WHERE id = 1;
+            INSERT INTO daily_stats (day, visits, revenue)
+            SELECT DATE(new.visit_date, 'localtime'), 1, COALESCE(new.paid_amount, 0)
+            WHERE DATE(new.visit_date, 'localtime') IS NOT NULL
+            ON CONFLICT (day) DO UPDATE
+            SET visits = visits + 1, revenue = ROUND(revenue + excluded.revenue, 2);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_dashboard_visit_delete
+        AFTER DELETE ON visits
+        BEGIN
+            UPDATE dashboard_totals
+            SET total_visits = total_visits - 1,
+                total_revenue = ROUND(total_revenue - COALESCE(old.total_cost, 0), 2),
+                total_collected = ROUND(total_collected - COALESCE(old.paid_amount, 0), 2),
+                version = version + 1, updated_at = strftime('%Y-%m-%dT%H:%M:%fZ', 'now')
+            WHERE id = 1;
+            UPDATE daily_stats
+            SET visits = visits - 1, revenue = ROUND(revenue - COALESCE(old.paid_amount, 0), 2)
+            WHERE day = DATE(old.visit_date, 'localtime');
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_dashboard_visit_update
+        AFTER UPDATE OF total_cost, paid_amount, visit_date ON visits
+        BEGIN
+            UPDATE dashboard_totals
+            SET total_revenue = ROUND(total_revenue - COALESCE(old.total_cost, 0)
+                                      + COALESCE(new.total_cost, 0), 2),
+                total_collected = ROUND(total_collected - COALESCE(old.paid_amount, 0)
+                                        + COALESCE(new.paid_amount, 0), 2),
+                version = version + 1, updated_at = strftime('%Y-%m-%dT%H:%M:%fZ', 'now')
+            WHERE id = 1;
+            UPDATE daily_stats
+            SET visits = visits - 1, revenue = ROUND(revenue - COALESCE(old.paid_amount, 0), 2)
+            WHERE day = DATE(old.visit_date, 'localtime');
+            INSERT INTO daily_stats (day, visits, revenue)
+            SELECT DATE(new.visit_date, 'localtime'), 1, COALESCE(new.paid_amount, 0)
+            WHERE DATE(new.visit_date, 'localtime') IS NOT NULL
+            ON CONFLICT (day) DO UPDATE
+            SET visits = visits + 1, revenue = ROUND(revenue + excluded.revenue, 2);
+        END
+    ''')
+    
+    # مواعيد اليوم: عدد المواعيد بحالة "مجدول" لكل تاريخ
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_dashboard_appointment_insert
+        AFTER INSERT ON appointments
+        WHEN new.status = 'مجدول'
+        BEGIN
+            INSERT INTO daily_stats (day, scheduled_appointments)
+            VALUES (new.appointment_date, 1)
+            ON CONFLICT (day) DO UPDATE SET scheduled_appointments = scheduled_appointments + 1;
+            UPDATE dashboard_totals
+            SET version = version + 1, updated_at = strftime('%Y-%m-%dT%H:%M:%fZ', 'now')
+            WHERE id = 1;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_dashboard_appointment_delete
+        AFTER DELETE ON appointments
+        WHEN old.status = 'مجدول'
+        BEGIN
+            UPDATE daily_stats SET scheduled_appointments = scheduled_appointments - 1
+            WHERE day = old.appointment_date;
+            UPDATE dashboard_totals
+            SET version = version + 1, updated_at = strftime('%Y-%m-%dT%H:%M:%fZ', 'now')
+            WHERE id = 1;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_dashboard_appointment_update
+        AFTER UPDATE OF appointment_date, status ON appointments
+        WHEN old.status = 'مجدول' OR new.status = 'مجدول'
+        BEGIN
+            UPDATE daily_stats SET scheduled_appointments = scheduled_appointments - 1
+            WHERE day = old.appointment_date AND old.status = 'مجدول';
+            INSERT INTO daily_stats (day, scheduled_appointments)
+            SELECT new.appointment_date, 1
+            WHERE new.status = 'مجدول'
+            ON CONFLICT (day) DO UPDATE SET scheduled_appointments = scheduled_appointments + 1;
+            UPDATE dashboard_totals
+            SET version = version + 1, updated_at = strftime('%Y-%m-%dT%H:%M:%fZ', 'now')
+            WHERE id = 1;
+        END
+    ''')
+    
+    rebuild_dashboard_stats(cursor)
+
+def _migration_7_import_keys(cursor):
+    """ربط المفاتيح الخارجية للسجلات المستوردة بأرقامها في النظام"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS import_keys (
+            kind TEXT NOT NULL,
+            external_key TEXT NOT NULL,
+            local_id INTEGER NOT NULL,
+            PRIMARY KEY (kind, external_key)
+        ) WITHOUT ROWID
+    ''')
+
+# اليوم المحلي لطابع زمني كرقم صحيح YYYYMMDD، قابل للفهرسة والبحث بالمدى
+LOCAL_DAY_SQL = "CAST(strftime('%Y%m%d', {}, 'localtime') AS INTEGER)"
+
+def _migration_8_day_numbers(cursor):
+    """أعمدة اليوم الرقمية للزيارات والمدفوعات مع فهارسها، لفلترة التواريخ دون DATE()"""
+    if 'visit_day' not in _table_columns(cursor, 'visits'):
+        cursor.execute('ALTER TABLE visits ADD COLUMN visit_day INTEGER')
+    if 'payment_day' not in _table_columns(cursor, 'payments'):
+        cursor.execute('ALTER TABLE payments ADD COLUMN payment_day INTEGER')
+    
+    rebuild_day_numbers(cursor)
+    
+    # (visit_day, patient_id) يغطي البحث عن المرضى الذين لهم زيارات ضمن فترة
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_visits_day ON visits (visit_day, patient_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_visits_patient_day ON visits (patient_id, visit_day)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_payments_day ON payments (payment_day)')
+    
+    for table, column, source in (('visits', 'visit_day', 'visit_date'),
+                                  ('payments', 'payment_day', 'payment_date')):
+        day = LOCAL_DAY_SQL.format(f'new.{source}')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{column}_insert
+            AFTER INSERT ON {table}
+            BEGIN
+                UPDATE {table} SET {column} = {day} WHERE id = new.id;
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{column}_update
+            AFTER UPDATE OF {source} ON {table}
+            BEGIN
+                UPDATE {table} SET {column} = {day} WHERE id = new.id;
+            END
+        ''')
+
+# الطبيب الرئيسي للزيارة (0 = بدون طبيب رئيسي)، أصغر رقم إن وجد أكثر من طبيب رئيسي
+PRIMARY_DOCTOR_SQL = '''COALESCE((SELECT MIN(doctor_id) FROM visit_doctors
+                                  WHERE visit_id = {} AND is_primary = 1), 0)'''
+
+def _revenue_delta_sql(visit_id, doctor, sign, total_cost='v.total_cost', paid_amount='v.paid_amount',
+                       visit_date='v.visit_date'):
+    """عبارة تضيف (sign=+1) أو تطرح (sign=-1) مساهمة زيارة في ملخص الإيرادات"""
+    return f'''
+        INSERT INTO revenue_daily (day, doctor_id, visits, revenue, collected)
+        SELECT {LOCAL_DAY_SQL.format(visit_date)}, {doctor}, {sign},
+               {sign} * COALESCE({total_cost}, 0), {sign} * COALESCE({paid_amount}, 0)
+        FROM visits v
+        WHERE v.id = {visit_id} AND {LOCAL_DAY_SQL.format(visit_date)} IS NOT NULL
+        ON CONFLICT (day, doctor_id) DO UPDATE SET
+            visits = visits + excluded.visits,
+            revenue = ROUND(revenue + excluded.revenue, 2),
+            collected = ROUND(collected + excluded.collected, 2);
+    '''
+
+def _migration_9_revenue_daily(cursor):
+    """ملخص الإيرادات اليومي لكل طبيب رئيسي، محدث تلقائياً بالمشغلات"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS revenue_daily (
+            day INTEGER NOT NULL,
+            doctor_id INTEGER NOT NULL DEFAULT 0,
+            visits INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0,
+            collected REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, doctor_id)
+        ) WITHOUT ROWID
+    ''')
+    
+    # مساهمة كل زيارة تسجل تحت طبيبها الرئيسي الحالي؛ أي تغيير في الزيارة
+    # أو في أطبائها الرئيسيين يطرح المساهمة القديمة ويضيف الجديدة
+    doctor = PRIMARY_DOCTOR_SQL.format('v.id')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_revenue_visit_insert
+        AFTER INSERT ON visits
+        BEGIN
+            {_revenue_delta_sql('new.id', doctor, 1)}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_revenue_visit_delete
+        AFTER DELETE ON visits
+        BEGIN
+            INSERT INTO revenue_daily (day, doctor_id, visits, revenue, collected)
+            SELECT {LOCAL_DAY_SQL.format('old.visit_date')}, {PRIMARY_DOCTOR_SQL.format('old.id')}, -1,
+                   -COALESCE(old.total_cost, 0), -COALESCE(old.paid_amount, 0)
+            WHERE {LOCAL_DAY_SQL.format('old.visit_date')} IS NOT NULL
+            ON CONFLICT (day, doctor_id) DO UPDATE SET
+                visits = visits + excluded.visits,
+                revenue = ROUND(revenue + excluded.revenue, 2),
+                collected = ROUND(collected + excluded.collected, 2);
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_revenue_visit_update
+        AFTER UPDATE OF total_cost, paid_amount, visit_date ON visits
+        BEGIN
+            {_revenue_delta_sql('new.id', doctor, -1, 'old.total_cost', 'old.paid_amount', 'old.visit_date')}
+            {_revenue_delta_sql('new.id', doctor, 1)}
+        END
+    ''')
+    
+    # تغيير الطبيب الرئيسي ينقل مساهمة الزيارة من الطبيب السابق إلى الجديد
+    previous_on_insert = f'''COALESCE((SELECT MIN(doctor_id) FROM visit_doctors
+                                       WHERE visit_id = v.id AND is_primary = 1 AND id != new.id), 0)'''
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_revenue_primary_insert
+        AFTER INSERT ON visit_doctors
+        WHEN new.is_primary = 1
+        BEGIN
+            {_revenue_delta_sql('new.visit_id', previous_on_insert, -1)}
+            {_revenue_delta_sql('new.visit_id', doctor, 1)}
+        END
+    ''')
+    previous_on_delete = f'''CASE WHEN {doctor} = 0 OR old.doctor_id < {doctor}
+                                THEN old.doctor_id ELSE {doctor} END'''
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_revenue_primary_delete
+        AFTER DELETE ON visit_doctors
+        WHEN old.is_primary = 1
+        BEGIN
+            {_revenue_delta_sql('old.visit_id', previous_on_delete, -1)}
+            {_revenue_delta_sql('old.visit_id', doctor, 1)}
+        END
+    ''')
+    
+    rebuild_revenue_daily(cursor)
+
+# نطاقات أرقام النسخ العامة: generation تزيد مع كل إعادة بناء أو استيراد،
+# و reference مع تغيير الأطباء أو إعدادات العيادة، و patients مع تعديل بيانات أي مريض
+DATA_VERSION_SCOPES = ('generation', 'reference', 'patients')
+
+_PATIENT_VERSION_BUMP = '''
+            INSERT INTO patient_versions (patient_id, version, updated_at)
+            SELECT {0}, 1, strftime('%Y-%m-%dT%H:%M:%fZ', 'now') WHERE {0} IS NOT NULL
+            ON CONFLICT (patient_id) DO UPDATE
+            SET version = version + 1, updated_at = excluded.updated_at;'''
+_DATA_VERSION_BUMP = '''
+            UPDATE data_versions
+            SET version = version + 1, updated_at = strftime('%Y-%m-%dT%H:%M:%fZ', 'now')
+            WHERE name = '{0}';'''
+
+def _migration_10_change_versions(cursor):
+    """أرقام نسخ البيانات لكل مريض وللبيانات العامة، لبناء ETag للطلبات الشرطية"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS patient_versions (
+            patient_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT
+        ) WITHOUT ROWID
+    ''')
+    cursor.executemany('''
+        INSERT OR IGNORE INTO data_versions (name, updated_at)
+        VALUES (?, strftime('%Y-%m-%dT%H:%M:%fZ', 'now'))
+    ''', [(name,) for name in DATA_VERSION_SCOPES])
+    
+    # أي تغيير في سجلات المريض يزيد رقم نسخته. صف المريض المحذوف يبقى حتى لا يعود
+    # رقمه إلى الصفر (أرقام المرضى لا يعاد استخدامها). تحديث visit_day و payment_day
+    # من مشغلاتها لا يغير المحتوى فلا يحسب
+    via_visit = '(SELECT patient_id FROM visits WHERE id = {}.visit_id)'
+    triggers = [
+        ('patients', 'UPDATE', None, ['new.id'], 'patients'),
+        ('patients', 'DELETE', None, ['old.id'], None),
+        ('visits', 'INSERT', None, ['new.patient_id'], None),
+        ('visits', 'UPDATE', 'new.visit_day IS old.visit_day',
+         ['old.patient_id', 'new.patient_id'], None),
+        ('visits', 'DELETE', None, ['old.patient_id'], None),
+        ('payments', 'INSERT', None, [via_visit.format('new')], None),
+        ('payments', 'UPDATE', 'new.payment_day IS old.payment_day', [via_visit.format('new')], None),
+        ('payments', 'DELETE', None, [via_visit.format('old')], None),
+        ('visit_doctors', 'INSERT', None, [via_visit.format('new')], None),
+        ('visit_doctors', 'UPDATE', None, [via_visit.format('new')], None),
+        ('visit_doctors', 'DELETE', None, [via_visit.format('old')], None),
+        ('appointments', 'INSERT', None, ['new.patient_id'], None),
+        ('appointments', 'UPDATE', None, ['old.patient_id', 'new.patient_id'], None),
+        ('appointments', 'DELETE', None, ['old.patient_id'], None),
+        ('doctors', 'INSERT', None, [], 'reference'),
+        ('doctors', 'UPDATE', None, [], 'reference'),
+        ('doctors', 'DELETE', None, [], 'reference'),
+        ('clinic_settings', 'UPDATE', None, [], 'reference'),
+    ]
+    for table, event, when, patients, scope in triggers:
+        body = ''.join(_PATIENT_VERSION_BUMP.format(patient) for patient in patients)
+        if scope:
+            body += _DATA_VERSION_BUMP.format(scope)
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_version_{table}_{event.lower()}
+        AFTER {event} ON {table}
+        {f'WHEN {when}' if when else ''}
+        BEGIN{body}
+        END
+        ''')
+
+def _migration_11_idempotency_keys(cursor):
+    """مفاتيح منع تكرار طلبات الكتابة ونتائجها المحفوظة"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            key TEXT PRIMARY KEY,
+            request_hash TEXT NOT NULL,
+            result TEXT,
+            created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ', 'now'))
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created ON idempotency_keys(created_at)')
+
+def _migration_12_name_trigrams(cursor):
+    """فهرس المقاطع الثلاثية لأسماء المرضى، للبحث التقريبي عن الأسماء المكتوبة بخطأ"""
+    # كل اسم موحد (name_key) مرة واحدة مع مقاطعه الثلاثية، وكل مريض مرتبط باسمه
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS name_keys (
+            id INTEGER PRIMARY KEY,
+            key TEXT NOT NULL UNIQUE
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS patient_name_keys (
+            patient_id INTEGER PRIMARY KEY,
+            name_id INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_patient_name_keys_name ON patient_name_keys (name_id)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS name_trigrams (
+            trigram TEXT NOT NULL,
+            name_id INTEGER NOT NULL,
+            PRIMARY KEY (trigram, name_id)
+        ) WITHOUT ROWID
+    ''')
+    # المشغلات لا تقبل WITH RECURSIVE، فالاسم يقطع إلى مقاطع بالربط مع جدول المواقع
+    cursor.execute('CREATE TABLE IF NOT EXISTS trigram_positions (n INTEGER PRIMARY KEY)')
+    cursor.executemany('INSERT OR IGNORE INTO trigram_positions (n) VALUES (?)',
+                       [(n,) for n in range(1, NAME_KEY_MAX_LENGTH - 1)])
+    
+    # مقاطع الاسم تضاف مع أول مريض به وتحذف مع آخر مريض
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_name_key_insert
+        AFTER INSERT ON name_keys
+        BEGIN
+            INSERT OR IGNORE INTO name_trigrams (trigram, name_id)
+            SELECT substr(new.key, n, 3), new.id FROM trigram_positions
+            WHERE n <= length(new.key) - 2;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_name_key_delete
+        AFTER DELETE ON name_keys
+        BEGIN
+            DELETE FROM name_trigrams
+            WHERE name_id = old.id AND trigram IN (
+                SELECT substr(old.key, n, 3) FROM trigram_positions
+                WHERE n <= length(old.key) - 2
+            );
+        END
+    ''')
+    
+    # المشغلات تستدعي name_key المسجلة في _connect
+    link_patient = '''
+            INSERT INTO name_keys (key) VALUES (name_key(new.name))
+            ON CONFLICT (key) DO NOTHING;
+            INSERT OR REPLACE INTO patient_name_keys (patient_id, name_id)
+            SELECT new.id, id FROM name_keys WHERE key = name_key(new.name);'''
+    drop_unused_key = '''
+            DELETE FROM name_keys
+            WHERE key = name_key(old.name)
+              AND NOT EXISTS (SELECT 1 FROM patient_name_keys WHERE name_id = name_keys.id);'''
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_name_patient_insert
+        AFTER INSERT ON patients
+        BEGIN{link_patient}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_name_patient_update
+        AFTER UPDATE OF name ON patients
+        BEGIN{link_patient}{drop_unused_key}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_name_patient_delete
+        AFTER DELETE ON patients
+        BEGIN
+            DELETE FROM patient_name_keys WHERE patient_id = old.id;{drop_unused_key}
+        END
+    ''')
+    
+    rebuild_name_trigrams(cursor)
+
+MIGRATIONS = [
+    _migration_1_base_schema,
+    _migration_2_indexes,
+    _migration_3_patient_balances,
+    _migration_4_patient_search,
+    _migration_5_list_pagination,
+    _migration_6_dashboard_stats,
+    _migration_7_import_keys,
+    _migration_8_day_numbers,
+    _migration_9_revenue_daily,
+    _migration_10_change_versions,
+    _migration_11_idempotency_keys,
+    _migration_12_name_trigrams,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def schema_version(conn):
+    """رقم آخر ترحيل منفذ على قاعدة البيانات"""
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate(conn):
+    """تنفيذ الترحيلات الناقصة، كل واحدة في معاملة مستقلة"""
+    version = schema_version(conn)
+    if version >= SCHEMA_VERSION:
+        return version
+    
+    # وضع WAL دائم في ملف قاعدة البيانات: القراءة لا تحجب الكتابة والعكس
+    conn.execute('PRAGMA journal_mode = WAL')
+    
+    for number in range(version + 1, SCHEMA_VERSION + 1):
+        step = MIGRATIONS[number - 1]
+        print(f"ترحيل قاعدة البيانات إلى النسخة {number}: {step.__doc__}")
+        conn.execute('BEGIN')
+        try:
+            step(conn.cursor())
+            conn.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    
+    # تحديث إحصائيات المخطط ليختار SQLite الفهارس الصحيحة
+    conn.execute('ANALYZE')
     conn.commit()
-    conn.close()
+    return SCHEMA_VERSION
+
+# ===== أرصدة المرضى =====
+
+# الأرصدة كما يجب أن تكون، محسوبة من جدول الزيارات مباشرة
+BALANCES_FROM_VISITS_SQL = '''
+    SELECT p.id AS patient_id,
+           ROUND(COALESCE(SUM(v.total_cost), 0), 2) AS total_charges,
+           ROUND(COALESCE(SUM(v.paid_amount), 0), 2) AS total_paid,
+           ROUND(COALESCE(SUM(v.total_cost), 0) - COALESCE(SUM(v.paid_amount), 0), 2) AS total_debt,
+           COUNT(v.id) AS visit_count,
+           MAX(v.visit_date) AS last_visit_date
+    FROM patients p
+    LEFT JOIN visits v ON v.patient_id = p.id
+    GROUP BY p.id
+'''
+
+def rebuild_patient_balances(cursor):
+    """إعادة حساب جدول الأرصدة بالكامل من الزيارات"""
+    cursor.execute('DELETE FROM patient_balances')
+    cursor.execute(f'''
+        INSERT INTO patient_balances (patient_id, total_charges, total_paid, total_debt,
+                                      visit_count, last_visit_date)
+        {BALANCES_FROM_VISITS_SQL}
+    ''')
+
+def verify_patient_balances(cursor):
+    """مقارنة الأرصدة المخزنة بالمحسوبة وإرجاع قائمة الفروقات"""
+    cursor.execute(f'''
+        SELECT e.patient_id,
+               e.total_charges, b.total_charges AS stored_charges,
+               e.total_paid, b.total_paid AS stored_paid,
+               e.visit_count, b.visit_count AS stored_visit_count,
+               e.last_visit_date, b.last_visit_date AS stored_last_visit_date
+        FROM ({BALANCES_FROM_VISITS_SQL}) e
+        LEFT JOIN patient_balances b ON b.patient_id = e.patient_id
+        WHERE b.patient_id IS NULL
+           OR ABS(e.total_charges - b.total_charges) > 0.005
+           OR ABS(e.total_paid - b.total_paid) > 0.005
+           OR ABS(e.total_debt - b.total_debt) > 0.005
+           OR e.visit_count != b.visit_count
+           OR e.last_visit_date IS NOT b.last_visit_date
+    ''')
+    drift = [dict(row) for row in cursor.fetchall()]
+    
+    # صفوف أرصدة لمرضى لم يعودوا موجودين
+    cursor.execute('''
+        SELECT b.patient_id FROM patient_balances b
+        LEFT JOIN patients p ON p.id = b.patient_id
+        WHERE p.id IS NULL
+    ''')
+    drift.extend({'patient_id': row[0], 'orphan': True} for row in cursor.fetchall())
+    return drift
+
+# ===== البحث النصي =====
+
+def rebuild_patient_search(cursor):
+    """إعادة بناء فهرس البحث النصي من جدول المرضى"""
+    cursor.execute('DELETE FROM patients_fts')
+    cursor.execute('''
+        INSERT INTO patients_fts (rowid, name, phone, national_id, email)
+        SELECT id, normalize_arabic(name), phone, national_id, normalize_arabic(email)
+        FROM patients
+    ''')
+
+SEARCH_LIMIT = 20
+
+def patient_search_query(text):
+    """تحويل نص البحث إلى استعلام FTS5 بالبادئات ("محم" تطابق "مُحَمَّد")"""
+    tokens = re.findall(r'\w+', normalize_arabic(text))
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+# ===== فهرس أرقام الهاتف والرقم الوطني =====
+# موظف الاستقبال يكتب جزءاً من الهاتف أو الرقم الوطني رقماً رقماً. أرقام كل المرضى
+# محفوظة في الذاكرة في قائمتين مرتبتين، والبحث بـ bisect على مدى البادئة أو النهاية
+# (الأرقام معكوسة) يعود بالنتائج في أجزاء من الميلي ثانية بدل استعلام على الجدول.
+
+DIGITS_INDEX_ENABLED = os.environ.get('MEDICAL_DIGITS_INDEX', '1') != '0'
+DIGITS_INDEX_FIELDS = ('phone', 'national_id')
+DIGITS_QUERY_MIN = 2        # أقل عدد أرقام للبحث بالبداية
+DIGITS_SUFFIX_MIN = 3       # وبالنهاية (آخر أرقام الهاتف)
+
+_DIGIT_TRANSLATION = str.maketrans('٠١٢٣٤٥٦٧٨٩۰۱۲۳۴۵۶۷۸۹', '0123456789' * 2)
+_DIGIT_QUERY = re.compile(r'[0-9\s+\-()]+')
+_NON_DIGITS = re.compile(r'[^0-9]')
+
+def normalize_digits(text):
+    """الأرقام فقط، بعد تحويل الأرقام العربية والفارسية ("٠٧٩-١٢" -> "07912")"""
+    if not text:
+        return ''
+    text = str(text)
+    if text.isascii() and text.isdigit():
+        return text
+    return _NON_DIGITS.sub('', text.translate(_DIGIT_TRANSLATION))
+
+def digit_query(text):
+    """أرقام نص البحث إذا كان أرقاماً فقط (مع مسافات أو + - أقواس)، وإلا None"""
+    text = text.translate(_DIGIT_TRANSLATION)
+    if not _DIGIT_QUERY.fullmatch(text):
+        return None
+    digits = normalize_digits(text)
+    return digits if len(digits) >= DIGITS_QUERY_MIN else None
+
+class DigitsIndex:
+    """أرقام هواتف المرضى وأرقامهم الوطنية في قائمتين مرتبتين: كما هي ومعكوسة
+
+    كل قائمة مفاتيح نصية مرتبة مع مصفوفة موازية بأرقام المرضى (حوالي 300 بايت
+    لكل مريض). يحمل عند التشغيل أو أول استخدام ويعاد تحميله إذا تغير رقم نسخة
+    generation (استيراد أو إعادة بناء ولو من عملية أخرى)، وطرق الكتابة تحدثه
+    بـ add و remove مع أرقام المريض نفسها.
+
+    التحميل يبني القوائم الجديدة خارج القفل ثم يستبدلها، والإضافات والحذف أثناءه
+    تسجل في _pending وتعاد على القوائم الجديدة، فمريض يضاف بعد أن بدأ التحميل
+    قراءة الجدول لا يضيع.
+    """
+
+    def __init__(self):
+        self._forward = ([], array.array('q'))
+        self._reverse = ([], array.array('q'))
+        self._generation = None
+        self._epoch = 0             # يزيد مع invalidate فلا يعتمد تحميل بدأ قبلها
+        self._pending = None        # عمليات الكتابة أثناء التحميل، None إن لم يكن تحميل
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def load(self, cursor):
+        """تحميل الفهرس من جدول المرضى (إلا إذا كان محملاً من النسخة نفسها)"""
+        with self._load_lock:
+            generation = self._current_generation(cursor)
+            with self._lock:
+                if generation == self._generation:
+                    return
+                epoch = self._epoch
+                self._pending = []
+            try:
+                forward, reverse = self._build(cursor)
+            except BaseException:
+                with self._lock:
+                    self._pending = None
+                raise
+            with self._lock:
+                self._forward, self._reverse = forward, reverse
+                self._generation = generation if epoch == self._epoch else None
+                pending, self._pending = self._pending, None
+                for apply, patient_id, values in pending:
+                    apply(patient_id, values)
+
+    def _build(self, cursor):
+        """قائمتا الفهرس (كما هي ومعكوسة) من جدول المرضى"""
+        keys = []
+        ids = array.array('q')
+        cursor.execute(f"SELECT id, {', '.join(DIGITS_INDEX_FIELDS)} FROM patients")
+        for patient_id, *values in cursor:
+            for digits in self._entry(values):
+                keys.append(digits)
+                ids.append(patient_id)
+        # ترتيب المواقع بالمفتاح، والمفاتيح المتساوية بترتيب أرقام المرضى
+        indexes = []
+        for index_keys in (keys, [digits[::-1] for digits in keys]):
+            order = sorted(range(len(index_keys)), key=index_keys.__getitem__)
+            indexes.append(([index_keys[i] for i in order],
+                            array.array('q', [ids[i] for i in order])))
+        return indexes
+
+    def ensure_loaded(self, cursor):
+        """تحميل الفهرس إذا لم يحمل بعد أو تغيرت البيانات جماعياً منذ تحميله"""
+        if self._current_generation(cursor) != self._generation:
+            self.load(cursor)
+
+    def invalidate(self):
+        """إعادة التحميل عند الاستخدام التالي (بعد الاستعادة مثلاً)"""
+        with self._lock:
+            self._generation = None
+            self._epoch += 1
+
+    def add(self, patient_id, *values):
+        """إضافة أرقام مريض (تكرار الإضافة بالأرقام نفسها لا يضيف شيئاً)
+
+        قبل أول تحميل لا تفعل شيئاً، فالتحميل سيقرأ المريض من الجدول.
+        """
+        self._write(self._add, patient_id, values)
+
+    def remove(self, patient_id, *values):
+        """حذف أرقام مريض (القيم نفسها التي أضيف بها)"""
+        self._write(self._remove, patient_id, values)
+
+    def _write(self, apply, patient_id, values):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((apply, patient_id, values))
+            if self._generation is not None:
+                apply(patient_id, values)
+
+    def _add(self, patient_id, values):
+        for digits in self._entry(values):
+            for index, key in ((self._forward, digits), (self._reverse, digits[::-1])):
+                if self._find(index, key, patient_id) is None:
+                    position = bisect.bisect_right(index[0], key)
+                    index[0].insert(position, key)
+                    index[1].insert(position, patient_id)
+
+    def _remove(self, patient_id, values):
+        for digits in self._entry(values):
+            for index, key in ((self._forward, digits), (self._reverse, digits[::-1])):
+                position = self._find(index, key, patient_id)
+                if position is not None:
+                    del index[0][position]
+                    del index[1][position]
+
+    def lookup(self, digits, limit):
+        """أرقام المرضى المطابقين: البداية أولاً (والمطابقة التامة أولها)، ثم النهاية"""
+        with self._lock:
+            found = dict.fromkeys(self._scan(self._forward, digits, limit))
+            if len(found) < limit and len(digits) >= DIGITS_SUFFIX_MIN:
+                for patient_id in self._scan(self._reverse, digits[::-1], limit):
+                    found.setdefault(patient_id)
+                    if len(found) >= limit:
+                        break
+            return list(found)
+
+    def snapshot(self):
+        with self._lock:
+            return {'loaded': self._generation is not None, 'keys': len(self._forward[0])}
+
+    @staticmethod
+    def _current_generation(cursor):
+        cursor.execute("SELECT version FROM data_versions WHERE name = 'generation'")
+        return cursor.fetchone()[0]
+
+    @staticmethod
+    def _entry(values):
+        return dict.fromkeys(digits for digits in map(normalize_digits, values) if digits)
+
+    @staticmethod
+    def _find(index, key, patient_id):
+        """موقع (المفتاح، رقم المريض) في القائمة أو None"""
+        keys, ids = index
+        position = bisect.bisect_left(keys, key)
+        while position < len(keys) and keys[position] == key:
+            if ids[position] == patient_id:
+                return position
+            position += 1
+        return None
+
+    @staticmethod
+    def _scan(index, prefix, limit):
+        """أرقام المرضى لأول limit مفتاح يبدأ بالبادئة (بدون تكرار)"""
+        keys, ids = index
+        seen = set()
+        position = bisect.bisect_left(keys, prefix)
+        while position < len(keys) and len(seen) < limit and keys[position].startswith(prefix):
+            patient_id = ids[position]
+            if patient_id not in seen:
+                seen.add(patient_id)
+                yield patient_id
+            position += 1
+
+digits_index = DigitsIndex()
+
+def start_digits_index_loader():
+    """تحميل فهرس الأرقام في خيط خلفي عند التشغيل، فلا يتأخر الخادم ولا أول بحث"""
+    def run():
+        conn = _connect(readonly=True)
+        try:
+            digits_index.load(conn.cursor())
+        except sqlite3.Error:
+            app.logger.exception('تعذر تحميل فهرس الأرقام، سيحمل عند أول بحث')
+        finally:
+            conn.close()
+    
+    thread = threading.Thread(target=run, name='digits-index', daemon=True)
+    thread.start()
+    return thread
+
+# ===== البحث التقريبي بالمقاطع الثلاثية =====
+# الاسم المملى بالصوت أو المكتوب على عجل يختلف غالباً بحرف أو اثنين عن المحفوظ، فلا
+# يطابقه البحث بالبادئات. كل اسم موحد مقطع إلى مقاطع من ثلاثة حروف في name_trigrams
+# (تحدثها المشغلات)، والبحث التقريبي يعد المقاطع المشتركة في SQL ويرتب أفضل المرشحين.
+
+NAME_KEY_MAX_LENGTH = 256
+FUZZY_MIN_TRIGRAMS = 4          # اسم من حرفين أو ثلاثة لا يكفي للمقارنة
+FUZZY_CANDIDATES = 100          # الأسماء المرشحة بأكثر المقاطع المشتركة قبل الترتيب
+FUZZY_MIN_SIMILARITY = 0.5      # أقل نسبة من مقاطع نص البحث موجودة في الاسم
+SEARCH_MODES = ('auto', 'prefix', 'fuzzy')
+
+def name_key(text):
+    """الاسم الموحد للبحث التقريبي: كلماته بعد normalize_arabic بمسافة واحدة وحولها مسافة"""
+    if text is None:
+        return None
+    words = ' '.join(re.findall(r'\w+', normalize_arabic(text)))
+    return f' {words[:NAME_KEY_MAX_LENGTH - 2]} '
+
+def name_trigrams(key):
+    """المقاطع الثلاثية للاسم الموحد (" علي " -> " عل"، "علي"، "لي ")"""
+    return {key[i:i + 3] for i in range(len(key) - 2)}
+
+def rebuild_name_trigrams(cursor):
+    """إعادة بناء فهرس المقاطع الثلاثية من أسماء المرضى
+
+    الأسماء الموجودة تحتفظ بأرقامها، والأسماء الجديدة تضاف بمقاطعها عبر مشغل name_keys.
+    """
+    cursor.execute('DELETE FROM patient_name_keys')
+    cursor.execute('DELETE FROM name_trigrams')
+    cursor.execute('DELETE FROM name_keys WHERE key NOT IN (SELECT name_key(name) FROM patients)')
+    cursor.execute('''
+        INSERT INTO name_trigrams (trigram, name_id)
+        SELECT DISTINCT substr(k.key, p.n, 3), k.id
+        FROM name_keys k
+        JOIN trigram_positions p ON p.n <= length(k.key) - 2
+    ''')
+    cursor.execute('''
+        INSERT INTO name_keys (key)
+        SELECT DISTINCT name_key(name) FROM patients WHERE true
+        ON CONFLICT (key) DO NOTHING
+    ''')
+    cursor.execute('''
+        INSERT INTO patient_name_keys (patient_id, name_id)
+        SELECT p.id, k.id FROM patients p JOIN name_keys k ON k.key = name_key(p.name)
+    ''')
+
+def fuzzy_name_matches(cursor, query, limit=FUZZY_CANDIDATES):
+    """أقرب الأسماء المحفوظة إلى نص البحث: [(رقم الاسم، التشابه)] من الأقرب
+
+    المرشحون الأسماء التي تشترك مع النص في أكثر المقاطع (عد على مفتاح name_trigrams
+    لا مرور على كل الأسماء)، والتشابه نسبة مقاطع النص الموجودة في الاسم، فالتساوي
+    يحسم بتشابه الاسم كاملاً (Jaccard) فيتقدم الأقرب طولاً.
+    """
+    grams = name_trigrams(name_key(query))
+    if len(grams) < FUZZY_MIN_TRIGRAMS:
+        return []
+    cursor.execute(f'''
+        SELECT k.id, k.key, c.shared
+        FROM (
+            SELECT name_id, COUNT(*) AS shared FROM name_trigrams
+            WHERE trigram IN ({', '.join('?' for _ in grams)})
+            GROUP BY name_id
+            ORDER BY shared DESC
+            LIMIT ?
+        ) c
+        JOIN name_keys k ON k.id = c.name_id
+    ''', (*grams, limit))
+    
+    scored = []
+    for name_id, key, shared in cursor.fetchall():
+        similarity = shared / len(grams)
+        if similarity >= FUZZY_MIN_SIMILARITY:
+            jaccard = shared / (len(grams) + len(name_trigrams(key)) - shared)
+            scored.append((similarity, jaccard, name_id))
+    scored.sort(reverse=True)
+    return [(name_id, round(similarity, 3)) for similarity, _, name_id in scored]
+
+# ===== إحصائيات لوحة التحكم =====
+
+def rebuild_dashboard_stats(cursor):
+    """إعادة حساب عدادات لوحة التحكم والإحصائيات اليومية من الجداول"""
+    cursor.execute('DELETE FROM daily_stats')
+    cursor.execute('''
+        INSERT INTO daily_stats (day, visits, revenue)
+        SELECT DATE(visit_date, 'localtime') as day, COUNT(*),
+               ROUND(COALESCE(SUM(paid_amount), 0), 2)
+        FROM visits
+        WHERE day IS NOT NULL
+        GROUP BY day
+    ''')
+    cursor.execute('''
+        INSERT INTO daily_stats (day, scheduled_appointments)
+        SELECT appointment_date, COUNT(*)
+        FROM appointments
+        WHERE status = 'مجدول'
+        GROUP BY appointment_date
+        ON CONFLICT (day) DO UPDATE SET scheduled_appointments = excluded.scheduled_appointments
+    ''')
+    cursor.execute('''
+        INSERT OR REPLACE INTO dashboard_totals (id, total_patients, total_visits, total_revenue,
+                                                 total_collected, version, updated_at)
+        SELECT 1,
+               (SELECT COUNT(*) FROM patients),
+               COUNT(*),
+               ROUND(COALESCE(SUM(total_cost), 0), 2),
+               ROUND(COALESCE(SUM(paid_amount), 0), 2),
+               COALESCE((SELECT version FROM dashboard_totals WHERE id = 1), 0) + 1,
+               strftime('%Y-%m-%dT%H:%M:%fZ', 'now')
+        FROM visits
+    ''')
+
+# ===== أرقام الأيام =====
+
+def day_number(text):
+    """تحويل تاريخ 'YYYY-MM-DD' إلى رقم اليوم YYYYMMDD (يرفع ValueError إذا كان غير صالح)"""
+    return int(datetime.strptime(text.strip()[:10], '%Y-%m-%d').strftime('%Y%m%d'))
+
+def rebuild_day_numbers(cursor):
+    """إعادة حساب visit_day و payment_day من الطوابع الزمنية (تكتب الصفوف المتغيرة فقط)"""
+    for table, column, source in (('visits', 'visit_day', 'visit_date'),
+                                  ('payments', 'payment_day', 'payment_date')):
+        day = LOCAL_DAY_SQL.format(source)
+        cursor.execute(f'UPDATE {table} SET {column} = {day} WHERE {column} IS NOT {day}')
+
+# ===== ملخص الإيرادات =====
+
+def rebuild_revenue_daily(cursor):
+    """إعادة حساب ملخص الإيرادات اليومي لكل طبيب من الزيارات"""
+    cursor.execute('DELETE FROM revenue_daily')
+    cursor.execute('''
+        INSERT INTO revenue_daily (day, doctor_id, visits, revenue, collected)
+        SELECT v.visit_day, COALESCE(pd.doctor_id, 0), COUNT(*),
+               ROUND(COALESCE(SUM(v.total_cost), 0), 2),
+               ROUND(COALESCE(SUM(v.paid_amount), 0), 2)
+        FROM visits v
+        LEFT JOIN (
+            SELECT visit_id, MIN(doctor_id) as doctor_id
+            FROM visit_doctors
+            WHERE is_primary = 1
+            GROUP BY visit_id
+        ) pd ON pd.visit_id = v.id
+        WHERE v.visit_day IS NOT NULL
+        GROUP BY v.visit_day, COALESCE(pd.doctor_id, 0)
+    ''')
+
+@app.cli.command('rebuild-revenue')
+def rebuild_revenue_command():
+    """إعادة بناء ملخص الإيرادات اليومي"""
+    conn = _connect()
+    try:
+        rebuild_revenue_daily(conn.cursor())
+        conn.commit()
+    finally:
+        conn.close()
+    click.echo("تم إعادة بناء ملخص الإيرادات")
+
+# ===== أرقام نسخ البيانات =====
+
+def bump_data_versions(cursor):
+    """زيادة كل أرقام النسخ العامة، فيبطل كل ETag صدر قبل إعادة البناء أو الاستيراد"""
+    cursor.execute('''
+        UPDATE data_versions
+        SET version = version + 1, updated_at = strftime('%Y-%m-%dT%H:%M:%fZ', 'now')
+    ''')
+
+# ===== الجداول المشتقة =====
+
+# دوال إعادة بناء كل الجداول التي تحدثها المشغلات، بترتيب التنفيذ
+DERIVED_REBUILDERS = [
+    rebuild_day_numbers,
+    rebuild_patient_balances,
+    rebuild_patient_search,
+    rebuild_name_trigrams,
+    rebuild_dashboard_stats,
+    rebuild_revenue_daily,
+    bump_data_versions,
+]
+
+def rebuild_derived(cursor):
+    """إعادة بناء كل الجداول المشتقة من الجداول الأساسية"""
+    for rebuild in DERIVED_REBUILDERS:
+        rebuild(cursor)
+
+@app.cli.command('rebuild-derived')
+def rebuild_derived_command():
+    """إعادة بناء الأرصدة وفهرس البحث وعدادات لوحة التحكم وملخص الإيرادات وإبطال ETag السابقة"""
+    conn = _connect()
+    try:
+        rebuild_derived(conn.cursor())
+        conn.commit()
+    finally:
+        conn.close()
+    click.echo("تم إعادة بناء الجداول المشتقة")
+
+# ===== الطلبات الشرطية =====
+# صفحات المريض والتقارير تحمل ETag من أرقام نسخ البيانات، فإعادة فتحها دون تغيير
+# ترجع 304 باستعلام واحد دون تنفيذ المسار أو القالب. MEDICAL_CONDITIONAL_GET=0 يعطلها
+
+CONDITIONAL_GET = os.environ.get('MEDICAL_CONDITIONAL_GET', '1') != '0'
+VERSION_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+# بادئة تتغير مع كل تشغيل (فتبطل الصفحات المحفوظة إذا تغيرت القوالب) ومع كل استعادة
+_etag_salt = os.urandom(4).hex()
+
+# رقم نسخة مريض واحد (صف واحد دائماً، صفر إن لم يتغير شيء منذ إنشاء الجدول)
+PATIENT_VERSION_SQL = '''
+    UNION ALL
+    SELECT 'patient', COALESCE(MAX(version), 0), MAX(updated_at)
+    FROM patient_versions WHERE patient_id = {}
+'''
+DASHBOARD_VERSION_SQL = '''
+    UNION ALL
+    SELECT 'dashboard', version, updated_at FROM dashboard_totals WHERE id = 1
+'''
+
+def rotate_etag_salt():
+    """إبطال كل ETag سابق (بعد استعادة نسخة احتياطية تبدأ الأرقام من قيم أخرى)"""
+    global _etag_salt
+    _etag_salt = os.urandom(4).hex()
+
+def load_versions(cursor, names, extra_sql='', params=()):
+    """ETag ووقت آخر تغيير من أرقام نسخ النطاقات المطلوبة باستعلام واحد"""
+    placeholders = ', '.join('?' for _ in names)
+    cursor.execute(f'''
+        SELECT name, version, updated_at FROM data_versions WHERE name IN ({placeholders})
+        {extra_sql}
+    ''', (*names, *params))
+    rows = sorted(tuple(row) for row in cursor.fetchall())
+    etag = '-'.join([_etag_salt] + [str(version) for _, version, _ in rows])
+    stamps = [updated_at for _, _, updated_at in rows if updated_at]
+    last_modified = (datetime.strptime(max(stamps), VERSION_TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc)
+                     if stamps else None)
+    return etag, last_modified
+
+def with_today(etag, last_modified):
+    """إضافة تاريخ اليوم إلى ETag لصفحة تعتمد على "اليوم"، فلا تعطي 304 بعد منتصف الليل"""
+    midnight = datetime.now().astimezone().replace(hour=0, minute=0, second=0, microsecond=0)
+    return f'{etag}-{midnight.date().isoformat()}', max(filter(None, (last_modified, midnight)))
+
+def patient_etag(cursor, patient_id):
+    """صفحات المريض: نسخته، والأطباء وإعدادات العيادة"""
+    return load_versions(cursor, ('generation', 'reference'), PATIENT_VERSION_SQL.format('?'), (patient_id,))
+
+def patient_details_etag(cursor, patient_id):
+    """صفحة المريض: كـ patient_etag، و"اليوم" لأن المواعيد القادمة تتغير عند منتصف الليل"""
+    return with_today(*patient_etag(cursor, patient_id))
+
+def visit_etag(cursor, visit_id):
+    """تقرير الزيارة: نسخة مريضها"""
+    return load_versions(cursor, ('generation', 'reference'),
+                         PATIENT_VERSION_SQL.format('(SELECT patient_id FROM visits WHERE id = ?)'),
+                         (visit_id,))
+
+def reports_etag(cursor):
+    """التقارير: عدادات لوحة التحكم، وأسماء المرضى (أكبر الديون) والأطباء"""
+    return load_versions(cursor, ('generation', 'reference', 'patients'), DASHBOARD_VERSION_SQL)
+
+def dashboard_etag(cursor):
+    """إحصائيات لوحة التحكم: العدادات، و"اليوم" لأن أرقامه تتغير عند منتصف الليل"""
+    return with_today(*load_versions(cursor, ('generation',), DASHBOARD_VERSION_SQL))
+
+def conditional(validator):
+    """مسار GET بطلب شرطي: ETag و Last-Modified من validator، و304 دون تنفيذ المسار إذا لم يتغير"""
+    def decorate(view):
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            if not CONDITIONAL_GET:
+                return view(**kwargs)
+            etag, last_modified = validator(get_db().cursor(), **kwargs)
+            if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                response = make_response(view(**kwargs))
+                # أخطاء 404 وغيرها لا تحفظ
+                if response.status_code != 200:
+                    return response
+            else:
+                response = app.response_class(status=304)
+            response.set_etag(etag, weak=True)
+            response.last_modified = last_modified
+            # المتصفح يحفظ الصفحة لكن يتحقق منها في كل مرة
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorate
+
+# ===== ذاكرة القوالب =====
+# القوالب المترجمة تحفظ على القرص فلا تعاد ترجمتها بعد كل تشغيل (مهم في نسخة Android)،
+# وبطاقات الصفوف المعروضة تحفظ في الذاكرة بمفتاح (رقم الصف، نسخته)، فصفحة قائمة
+# طويلة لا تعيد إلا عرض الصفوف التي تغيرت منذ آخر طلب.
+
+# المسار الافتراضي بجانب app.py لا في مجلد العمل الحالي؛ فارغ = بدون
+TEMPLATE_CACHE_DIR = os.environ.get('MEDICAL_TEMPLATE_CACHE',
+                                    os.path.join(app.root_path, 'template_cache'))
+FRAGMENT_CACHE_SIZE = int(os.environ.get('MEDICAL_FRAGMENT_CACHE', '5000'))        # 0 = بدون
+
+def install_bytecode_cache(directory=TEMPLATE_CACHE_DIR):
+    """حفظ القوالب المترجمة في المجلد (يتخطى إذا تعذر إنشاؤه، كمجلد للقراءة فقط)
+
+    تستدعى عند تشغيل الخادم لا عند الاستيراد، فاستيراد app في سكربت أو اختبار
+    لا ينشئ مجلدات.
+    """
+    if not directory:
+        return None
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError:
+        return None
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+    return app.jinja_env.bytecode_cache
+
+def fragment_version_sql(patient_column=None, scopes=('generation',)):
+    """عمود fragment_version: أرقام نسخ البيانات التي يعتمد عليها عرض الصف
+
+    نطاقات data_versions ثابتة في الاستعلام فتحسب مرة واحدة، ونسخة المريض
+    بحث بالمفتاح الأساسي لكل صف.
+    """
+    parts = [f"(SELECT version FROM data_versions WHERE name = '{scope}')" for scope in scopes]
+    if patient_column:
+        parts.append(f'COALESCE((SELECT version FROM patient_versions WHERE patient_id = {patient_column}), 0)')
+    return " || '.' || ".join(parts) + ' AS fragment_version'
+
+class FragmentCache:
+    """ذاكرة LRU لمقاطع HTML المعروضة، بمفتاح (القالب، رقم الصف، نسخته)"""
+
+    def __init__(self, max_entries=FRAGMENT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return html
+
+    def put(self, key, html):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = html
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def snapshot(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'max_entries': self.max_entries,
+                    'hits': self.hits, 'misses': self.misses}
+
+fragment_cache = FragmentCache()
+
+@app.template_global()
+@pass_context
+def cached_rows(context, template_name, name, rows):
+    """بطاقات الصفوف بالترتيب، كل بطاقة من الذاكرة إذا لم تتغير نسخة صفها
+
+    قالب البطاقة يرى الصف باسم name مع متغيرات الصفحة (مثل {% include %}). المفتاح
+    (القالب، id، fragment_version)؛ الصف بلا fragment_version، وكل الصفوف في وضع
+    التطوير، تعرض دائماً.
+    """
+    template = app.jinja_env.get_template(template_name)
+    parent = context.parent
+    use_cache = not app.debug
+    html = []
+    for row in rows:
+        version = row['fragment_version'] if use_cache and 'fragment_version' in row.keys() else None
+        key = (template_name, row['id'], version)
+        fragment = fragment_cache.get(key) if version is not None else None
+        if fragment is None:
+            row_context = template.new_context({**parent, name: row}, shared=True)
+            fragment = ''.join(template.root_render_func(row_context))
+            if version is not None:
+                fragment_cache.put(key, fragment)
+        html.append(fragment)
+    return Markup(''.join(html))
+
+# ===== الاستيراد الجماعي =====
+
+IMPORT_BATCH_SIZE = 10000
+# الاستيراد الكبير يؤجل الفهارس والمشغلات ثم يعيد الجداول المشتقة كلها، وكلفة إعادة
+# البناء تتبع حجم قاعدة البيانات (حوالي 33 ثانية لمليون زيارة) بينما المشغلات حوالي
+# 85 ميكروثانية للصف. فالتأجيل من IMPORT_DEFER_ROWS صفاً أو ربع عدد الزيارات أيهما أكبر
+IMPORT_DEFER_ROWS = int(os.environ.get('MEDICAL_IMPORT_DEFER_ROWS', '20000'))
+IMPORT_DEFER_RATIO = 0.25
+IMPORT_KINDS = ('patients', 'visits', 'payments')
+# الجداول التي تؤجل فهارسها ومشغلاتها حتى نهاية الاستيراد الكبير
+IMPORT_TABLES = ('patients', 'visits', 'payments', 'visit_doctors')
+IMPORT_REJECTS_IN_REPORT = 100
+
+PATIENT_IMPORT_FIELDS = [
+    'name', 'age', 'gender', 'phone', 'address', 'email', 'national_id',
+    'blood_type', 'allergies', 'chronic_diseases', 'current_medications',
+    'emergency_contact', 'emergency_phone', 'insurance_company',
+    'insurance_number', 'notes',
+]
+VISIT_IMPORT_TEXT_FIELDS = [
+    'diagnosis', 'symptoms', 'treatment', 'prescriptions', 'lab_tests',
+    'vital_signs', 'notes', 'next_visit_date',
+]
+
+def import_format(filename):
+    """استنتاج صيغة ملف الاستيراد من اسمه"""
+    return 'jsonl' if filename and filename.lower().endswith(('.jsonl', '.json', '.ndjson')) else 'csv'
+
+def read_import_records(stream, fmt):
+    """قراءة سجلات CSV أو JSONL كـ (رقم السطر، السجل، الخطأ)"""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row, None
+        return
+    
+    for number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield number, None, f'JSON غير صالح: {e}'
+            continue
+        if not isinstance(row, dict):
+            yield number, None, 'السطر ليس كائن JSON'
+            continue
+        yield number, row, None
+
+def _import_text(row, field):
+    value = row.get(field)
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+def _import_number(row, field, default=0.0):
+    value = _import_text(row, field)
+    if value is None:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f'قيمة رقمية غير صالحة في {field}: {value}')
+
+def _import_int(row, field):
+    value = _import_text(row, field)
+    if value is None:
+        return None
+    try:
+        return int(float(value))
+    except ValueError:
+        raise ValueError(f'رقم صحيح غير صالح في {field}: {value}')
+
+def _import_timestamp(row, field, default):
+    value = _import_text(row, field)
+    if value is None:
+        return default
+    try:
+        return datetime.fromisoformat(value).strftime('%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        raise ValueError(f'تاريخ غير صالح في {field}: {value}')
+
+def suspend_derived_maintenance(cursor, tables=IMPORT_TABLES):
+    """حذف الفهارس الثانوية والمشغلات مؤقتاً وإرجاع تعريفاتها لإعادة إنشائها"""
+    placeholders = ', '.join('?' for _ in tables)
+    cursor.execute(f'''
+        SELECT type, name, sql FROM sqlite_master
+        WHERE type IN ('index', 'trigger') AND sql IS NOT NULL
+          AND tbl_name IN ({placeholders})
+    ''', tables)
+    deferred = cursor.fetchall()
+    for kind, name, _ in deferred:
+        cursor.execute(f'DROP {kind.upper()} {name}')
+    return [sql for _, _, sql in deferred]
+
+def resume_derived_maintenance(cursor, deferred):
+    """إعادة إنشاء الفهارس والمشغلات ثم إعادة بناء الجداول المشتقة"""
+    for sql in deferred:
+        cursor.execute(sql)
+    rebuild_derived(cursor)
+
+class BulkImporter:
+    """استيراد جماعي للمرضى أو الزيارات أو المدفوعات في معاملة واحدة
+
+    الصفوف تدخل بـ executemany على دفعات كبيرة. عند بلوغ حد التأجيل تؤجل
+    الفهارس والمشغلات حتى النهاية ثم تعاد الجداول المشتقة مرة واحدة، وما دون ذلك
+    تحدث المشغلات الجداول المشتقة كما في الكتابة العادية. الصفوف غير الصالحة لا توقف
+    الاستيراد بل تكتب في ملف المرفوضات. المدفوعات المستوردة تضاف إلى المبلغ
+    المدفوع في الزيارة كما في add_payment، والدفعة التي تتجاوز الدين المتبقي
+    (بعد دفعات الملف السابقة للزيارة نفسها) ترفض كما في allocate_payments.
+    """
+
+    def __init__(self, conn, kind, dry_run=False, rejects=None, progress=None,
+                 batch_size=IMPORT_BATCH_SIZE, defer_rows=IMPORT_DEFER_ROWS):
+        if kind not in IMPORT_KINDS:
+            raise ValueError(f'نوع استيراد غير معروف: {kind}')
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.kind = kind
+        self.dry_run = dry_run
+        self.rejects = rejects
+        self.progress = progress
+        self.batch_size = batch_size
+        self.defer_rows = defer_rows
+        self.report = {'kind': kind, 'dry_run': dry_run, 'read': 0, 'imported': 0,
+                       'rejected': 0, 'rejects': []}
+        self._keys = {}
+        self._ids = {}
+        self._remaining = {}        # رقم الزيارة -> الدين المتبقي بعد دفعات الملف
+        self._batch = []
+        self._new_keys = []
+        self._now = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+    def run(self, records):
+        """تنفيذ الاستيراد وإرجاع التقرير"""
+        started = time.perf_counter()
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            deferred = None
+            self._next_id = self._max_id(self.kind) + 1
+            defer_rows = max(self.defer_rows, int(self._max_id('visits') * IMPORT_DEFER_RATIO))
+            
+            for line, row, error in records:
+                self.report['read'] += 1
+                if error is None:
+                    try:
+                        self._batch.append(self._prepare(row))
+                    except ValueError as e:
+                        error = str(e)
+                if error is not None:
+                    self._reject(line, row, error)
+                # الصفوف المدخلة قبل التأجيل حدثتها المشغلات، وإعادة البناء تشملها أيضاً
+                if deferred is None and self.report['imported'] + len(self._batch) >= defer_rows:
+                    deferred = suspend_derived_maintenance(self.cursor)
+                if len(self._batch) >= self.batch_size:
+                    self._flush()
+            self._flush()
+            
+            self.report['deferred'] = deferred is not None
+            if deferred is not None:
+                resume_derived_maintenance(self.cursor, deferred)
+            else:
+                # فهرس الأرقام في كل العمليات يعاد تحميله كما بعد أي استيراد
+                self.cursor.execute(_DATA_VERSION_BUMP.format('generation'))
+            if self.dry_run:
+                self.conn.rollback()
+            else:
+                if deferred is not None:
+                    self.conn.execute('ANALYZE')
+                self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        
+        self.report['seconds'] = round(time.perf_counter() - started, 3)
+        return self.report
+
+    def _max_id(self, table):
+        self.cursor.execute(f'''
+            SELECT MAX(COALESCE((SELECT MAX(id) FROM {table}), 0),
+                       COALESCE((SELECT seq FROM sqlite_sequence WHERE name = ?), 0))
+        ''', (table,))
+        return self.cursor.fetchone()[0]
+
+    def _reject(self, line, row, error):
+        self.report['rejected'] += 1
+        entry = {'line': line, 'error': error, 'row': row}
+        if len(self.report['rejects']) < IMPORT_REJECTS_IN_REPORT:
+            self.report['rejects'].append(entry)
+        if self.rejects is not None:
+            self.rejects.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+    def _key_map(self, kind):
+        """خريطة المفاتيح الخارجية لنوع معين، تحمل عند أول حاجة"""
+        if kind not in self._keys:
+            self.cursor.execute('SELECT external_key, local_id FROM import_keys WHERE kind = ?', (kind,))
+            self._keys[kind] = dict(self.cursor.fetchall())
+        return self._keys[kind]
+
+    def _exists(self, table, local_id):
+        """وجود السجل المرجعي، بقراءة مفتاحه الأساسي مرة واحدة لكل رقم"""
+        known = self._ids.setdefault(table, {})
+        if local_id not in known:
+            self.cursor.execute(f'SELECT 1 FROM {table} WHERE id = ?', (local_id,))
+            known[local_id] = self.cursor.fetchone() is not None
+        return known[local_id]
+
+    def _resolve(self, row, kind, table):
+        """رقم السجل المرجعي من المفتاح الخارجي أو الرقم المباشر"""
+        key = _import_text(row, f'{kind}_key')
+        if key is not None:
+            local_id = self._key_map(kind).get(key)
+            if local_id is None:
+                raise ValueError(f'مفتاح {kind} غير معروف: {key}')
+            return local_id
+        local_id = _import_int(row, f'{kind}_id')
+        if local_id is None or not self._exists(table, local_id):
+            raise ValueError(f'{kind}_id غير موجود: {local_id}')
+        return local_id
+
+    def _visit_debt(self, visit_id):
+        """الدين المتبقي على الزيارة، محسوباً من قاعدة البيانات عند أول دفعة لها"""
+        if visit_id not in self._remaining:
+            self.cursor.execute('SELECT ROUND(total_cost - paid_amount, 2) FROM visits WHERE id = ?',
+                                (visit_id,))
+            self._remaining[visit_id] = self.cursor.fetchone()[0]
+        return self._remaining[visit_id]
+
+    def _assign_id(self, row, kind):
+        """رقم جديد للسجل مع تسجيل مفتاحه الخارجي إن وجد"""
+        key = _import_text(row, f'{kind}_key')
+        keys = self._key_map(kind)
+        if key is not None and key in keys:
+            raise ValueError(f'مفتاح {kind} مكرر: {key}')
+        local_id = self._next_id
+        self._next_id += 1
+        if key is not None:
+            keys[key] = local_id
+            self._new_keys.append((kind, key, local_id))
+        return local_id
+
+    def _prepare(self, row):
+        if self.kind == 'patients':
+            if not _import_text(row, 'name'):
+                raise ValueError('الاسم مطلوب')
+            values = [_import_text(row, field) for field in PATIENT_IMPORT_FIELDS]
+            values[1] = _import_int(row, 'age')
+            created = _import_timestamp(row, 'created_date', self._now)
+            return (self._assign_id(row, 'patient'), *values, created)
+        
+        if self.kind == 'visits':
+            patient_id = self._resolve(row, 'patient', 'patients')
+            total_cost = _import_number(row, 'total_cost')
+            paid_amount = _import_number(row, 'paid_amount')
+            if total_cost < 0 or paid_amount < 0:
+                raise ValueError('المبالغ لا يمكن أن تكون سالبة')
+            return (self._assign_id(row, 'visit'), patient_id, _import_int(row, 'doctor_id'),
+                    _import_timestamp(row, 'visit_date', self._now),
+                    *[_import_text(row, field) for field in VISIT_IMPORT_TEXT_FIELDS],
+                    total_cost, paid_amount, _import_text(row, 'payment_method') or 'نقدي')
+        
+        visit_id = self._resolve(row, 'visit', 'visits')
+        amount = _import_number(row, 'amount', None)
+        if amount is None or amount <= 0:
+            raise ValueError('المبلغ مطلوب ويجب أن يكون أكبر من صفر')
+        amount = round(amount, 2)
+        debt = self._visit_debt(visit_id)
+        if amount > debt:
+            raise ValueError(f'المبلغ {amount:g} أكبر من الدين المتبقي {debt:g}')
+        self._remaining[visit_id] = round(debt - amount, 2)
+        return (self._assign_id(row, 'payment'), visit_id,
+                _import_timestamp(row, 'payment_date', self._now), amount,
+                _import_text(row, 'payment_method') or 'نقدي', _import_text(row, 'notes'))
+
+    def _flush(self):
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, []
+        
+        if self.kind == 'patients':
+            columns = ', '.join(['id', *PATIENT_IMPORT_FIELDS, 'created_date'])
+            placeholders = ', '.join('?' * (len(PATIENT_IMPORT_FIELDS) + 2))
+            self.cursor.executemany(f'INSERT INTO patients ({columns}) VALUES ({placeholders})', batch)
+        elif self.kind == 'visits':
+            columns = ', '.join(['id', 'patient_id', 'doctor_id', 'visit_date',
+                                 *VISIT_IMPORT_TEXT_FIELDS, 'total_cost', 'paid_amount'])
+            placeholders = ', '.join('?' * (len(VISIT_IMPORT_TEXT_FIELDS) + 6))
+            self.cursor.executemany(f'INSERT INTO visits ({columns}) VALUES ({placeholders})',
+                                    [row[:-1] for row in batch])
+            # الطبيب الرئيسي كما في new_visit
+            self.cursor.executemany('''
+                INSERT OR IGNORE INTO visit_doctors (visit_id, doctor_id, role, is_primary)
+                VALUES (?, ?, 'طبيب رئيسي', 1)
+            ''', [(row[0], row[2]) for row in batch if row[2] is not None])
+            # المبلغ المدفوع عند الزيارة دفعة أولية كما في new_visit، بتاريخ الزيارة
+            self.cursor.executemany('''
+                INSERT INTO payments (visit_id, payment_date, amount, payment_method, notes)
+                VALUES (?, ?, ?, ?, 'دفعة أولية')
+            ''', [(row[0], row[3], row[-2], row[-1]) for row in batch if row[-2] > 0])
+        else:
+            self.cursor.executemany('''
+                INSERT INTO payments (id, visit_id, payment_date, amount, payment_method, notes)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', batch)
+            self.cursor.executemany('UPDATE visits SET paid_amount = paid_amount + ? WHERE id = ?',
+                                    [(row[3], row[1]) for row in batch])
+        
+        if self._new_keys:
+            self.cursor.executemany(
+                'INSERT INTO import_keys (kind, external_key, local_id) VALUES (?, ?, ?)',
+                self._new_keys)
+            self._new_keys = []
+        
+        self.report['imported'] += len(batch)
+        if self.progress:
+            self.progress(self.report)
+
+@app.route('/import/<kind>', methods=['POST'])
+def bulk_import(kind):
+    """استيراد ملف CSV أو JSONL من المرضى أو الزيارات أو المدفوعات
+
+    الاستيراد يحجز قاعدة البيانات للكتابة طوال مدته (والكبير منه يحذف فهارس الجداول
+    المستوردة ومشغلاتها مؤقتاً)، فينفذ وحده في خيط الكتابة: طلبات الكتابة الأخرى تنتظر في
+    الطابور حتى ينتهي بدل أن تفشل بـ database is locked، والقراءة تستمر على آخر
+    نسخة مثبتة (بفهارسها) حتى يثبت الاستيراد.
+    """
+    if kind not in IMPORT_KINDS:
+        return jsonify({'success': False, 'error': f'نوع استيراد غير معروف: {kind}'}), 404
+    
+    upload = request.files.get('file')
+    if not upload:
+        return jsonify({'success': False, 'error': 'لم يتم اختيار ملف'}), 400
+    
+    fmt = request.form.get('format') or import_format(upload.filename)
+    dry_run = request.form.get('dry_run', '').lower() in ('1', 'true', 'on', 'yes')
+    stream = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+    
+    try:
+        report = run_exclusive_write(lambda conn: BulkImporter(conn, kind, dry_run=dry_run).run(
+            read_import_records(stream, fmt)))
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    return jsonify({'success': True, **report})
+
+@app.cli.command('import-data')
+@click.argument('kind', type=click.Choice(IMPORT_KINDS))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), default=None,
+              help='صيغة الملف (تستنتج من الامتداد افتراضياً)')
+@click.option('--dry-run', is_flag=True, help='التحقق فقط دون حفظ أي بيانات')
+@click.option('--rejects', 'rejects_path', default=None, help='ملف JSONL للصفوف المرفوضة')
+@click.option('--batch-size', default=IMPORT_BATCH_SIZE, show_default=True)
+def import_data_command(kind, path, fmt, dry_run, rejects_path, batch_size):
+    """استيراد جماعي من ملف CSV أو JSONL"""
+    def progress(report):
+        click.echo(f"\r{report['imported']} مستورد، {report['rejected']} مرفوض", err=True, nl=False)
+    
+    rejects = open(rejects_path, 'w', encoding='utf-8') if rejects_path else None
+    conn = _connect()
+    try:
+        with open(path, encoding='utf-8-sig', newline='') as stream:
+            records = read_import_records(stream, fmt or import_format(path))
+            report = BulkImporter(conn, kind, dry_run=dry_run, rejects=rejects,
+                                  progress=progress, batch_size=batch_size).run(records)
+    finally:
+        conn.close()
+        if rejects:
+            rejects.close()
+    
+    click.echo(err=True)
+    rate = report['imported'] / report['seconds'] if report['seconds'] else 0
+    click.echo(f"{'تحقق فقط: ' if dry_run else ''}قرئ {report['read']}، "
+               f"استورد {report['imported']}، رفض {report['rejected']} "
+               f"خلال {report['seconds']} ثانية ({rate:.0f} سجل/ثانية)")
+
+# ===== اختيار حقول JSON =====
+# واجهات JSON ترجع افتراضياً الحقول التي تعرضها الواجهة فقط، و fields=a,b,c يختار
+# غيرها (أو fields=all لكلها). الحقول تختار في SELECT نفسه فلا تقرأ النصوص الطويلة
+# (الملاحظات والحساسية والأدوية) إلا عند طلبها.
+
+PATIENT_COLUMNS = ('id', 'name', 'age', 'gender', 'phone', 'address', 'email', 'national_id',
+                   'blood_type', 'allergies', 'chronic_diseases', 'current_medications',
+                   'emergency_contact', 'emergency_phone', 'insurance_company', 'insurance_number',
+                   'notes', 'created_date')
+
+# اسم الحقل -> تعبير SQL (p = patients، b = patient_balances)
+PATIENT_RESULT_FIELDS = {
+    **{column: f'p.{column}' for column in PATIENT_COLUMNS},
+    'total_charges': 'COALESCE(b.total_charges, 0)',
+    'total_paid': 'COALESCE(b.total_paid, 0)',
+    'total_debt': 'COALESCE(b.total_debt, 0)',
+}
+# ما تعرضه بطاقة نتيجة البحث (search.js و index.html)
+PATIENT_RESULT_DEFAULT = ('id', 'name', 'phone', 'age', 'blood_type', 'national_id', 'total_debt')
+
+def requested_fields(available, default):
+    """الحقول المطلوبة في fields= بترتيبها، أو الافتراضية؛ ValueError لحقل غير معروف"""
+    value = request.args.get('fields', '').strip()
+    if not value:
+        return list(default)
+    if value == 'all':
+        return list(available)
+    fields = list(dict.fromkeys(name.strip() for name in value.split(',') if name.strip()))
+    unknown = [name for name in fields if name not in available]
+    if unknown:
+        raise ValueError(f'حقول غير معروفة: {", ".join(unknown)}')
+    return fields
+
+def select_fields(fields, expressions):
+    """قائمة SELECT للحقول المختارة بأسمائها"""
+    return ', '.join(f'{expressions[name]} AS {name}' for name in fields)
+
+def fetch_dicts(cursor):
+    """باقي نتيجة الاستعلام كقواميس
+
+    الصفوف تقرأ كـ tuple عادية وتربط بأسماء الأعمدة مرة واحدة، أسرع من dict(row)
+    لكل sqlite3.Row. مصنع الصفوف الأصلي يعاد للمؤشر بعد القراءة.
+    """
+    columns = [description[0] for description in cursor.description]
+    row_factory = cursor.row_factory
+    cursor.row_factory = None
+    try:
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+    finally:
+        cursor.row_factory = row_factory
+
+# ===== التصفح بالمؤشر =====
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+def encode_cursor(values):
+    """تحويل قيم آخر صف في الصفحة إلى مؤشر نصي"""
+    raw = json.dumps(list(values), ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(text):
+    """قراءة المؤشر النصي، أو None للصفحة الأولى"""
+    if not text:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+        values = json.loads(raw.decode('utf-8'))
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError('مؤشر غير صالح')
+    if not isinstance(values, list):
+        raise ValueError('مؤشر غير صالح')
+    return values
+
+def page_limit():
+    """عدد الصفوف المطلوب في الصفحة"""
+    try:
+        limit = int(request.args.get('limit', PAGE_SIZE))
+    except ValueError:
+        limit = PAGE_SIZE
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+def split_page(rows, limit, key):
+    """فصل صف الفحص الزائد وحساب مؤشر الصفحة التالية"""
+    page = rows[:limit]
+    next_cursor = encode_cursor(key(page[-1])) if len(rows) > limit else None
+    return page, next_cursor
+
+@app.cli.command('rebuild-balances')
+@click.option('--check-only', is_flag=True, help='عرض الفروقات دون إعادة البناء')
+def rebuild_balances_command(check_only):
+    """التحقق من جدول أرصدة المرضى وإعادة بنائه"""
+    conn = _connect()
+    try:
+        cursor = conn.cursor()
+        drift = verify_patient_balances(cursor)
+        for row in drift:
+            click.echo(f"فرق في رصيد المريض {row['patient_id']}: {row}")
+        click.echo(f"عدد الأرصدة غير المتطابقة: {len(drift)}")
+        
+        if not check_only:
+            rebuild_patient_balances(cursor)
+            conn.commit()
+            click.echo("تم إعادة بناء جدول الأرصدة")
+    finally:
+        conn.close()
+
+def init_db():
+    """إنشاء جداول قاعدة البيانات أو ترقيتها إلى آخر نسخة"""
+    conn = _connect()
+    try:
+        return migrate(conn)
+    finally:
+        conn.close()
 
 @app.route('/')
 def index():
@@ -226,26 +2714,60 @@ def index():
 
 @app.route('/patients')
 def patients_list():
-    """قائمة المرضى"""
+    """قائمة المرضى، مقسمة إلى صفحات بمؤشر على (تاريخ الإضافة، الرقم)"""
+    try:
+        after = decode_cursor(request.args.get('cursor'))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    limit = page_limit()
+    
     conn = get_db()
     cursor = conn.cursor()
     
-    # جلب جميع المرضى مع معلومات الديون
-    cursor.execute('''
+    # المرضى مع معلومات الديون من جدول الأرصدة
+    sql = f'''
         SELECT p.*, 
-               COALESCE(SUM(v.total_cost), 0) as total_charges,
-               COALESCE(SUM(v.paid_amount), 0) as total_paid,
-               COALESCE(SUM(v.total_cost - v.paid_amount), 0) as total_debt
+               COALESCE(b.total_charges, 0) as total_charges,
+               COALESCE(b.total_paid, 0) as total_paid,
+               COALESCE(b.total_debt, 0) as total_debt,
+               {fragment_version_sql('p.id')}
         FROM patients p
-        LEFT JOIN visits v ON p.id = v.patient_id
-        GROUP BY p.id
-        ORDER BY p.created_date DESC
-    ''')
+        LEFT JOIN patient_balances b ON b.patient_id = p.id
+    '''
+    params = []
+    if after:
+        sql += ' WHERE (p.created_date, p.id) < (?, ?)'
+        params.extend(after[:2])
+    sql += ' ORDER BY p.created_date DESC, p.id DESC LIMIT ?'
+    params.append(limit + 1)
+    
+    cursor.execute(sql, params)
+    patients, next_cursor = split_page(cursor.fetchall(), limit,
+                                       lambda row: (row['created_date'], row['id']))
     
-    patients = cursor.fetchall()
-    conn.close()
+    if request.args.get('format') == 'json':
+        try:
+            fields = requested_fields(PATIENT_RESULT_FIELDS, PATIENT_RESULT_DEFAULT)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        return jsonify({
+            'items': [{name: row[name] for name in fields} for row in patients],
+            'html': render_template('_patient_cards.html', patients=patients),
+            'next_cursor': next_cursor,
+            'next_url': url_for('patients_list', cursor=next_cursor, limit=limit, format='json')
+                        if next_cursor else None,
+        })
     
-    return render_template('patients.html', patients=patients)
+    # ملخص الأعداد لكل المرضى وليس للصفحة فقط
+    cursor.execute('''
+        SELECT COUNT(*) as total,
+               (SELECT COUNT(*) FROM patient_balances WHERE total_debt > 0) as in_debt
+        FROM patients
+    ''')
+    counts = cursor.fetchone()
+    
+    return render_template('patients.html', patients=patients, counts=counts,
+                           next_cursor=next_cursor)
 
 @app.route('/patient/new', methods=['GET', 'POST'])
 def new_patient():
@@ -253,86 +2775,199 @@ def new_patient():
     if request.method == 'POST':
         data = request.get_json()
         
-        conn = get_db()
-        cursor = conn.cursor()
+        def insert_patient(cursor):
+            cursor.execute('''
+                INSERT INTO patients (
+                    name, age, gender, phone, address, email, national_id,
+                    blood_type, allergies, chronic_diseases, current_medications,
+                    emergency_contact, emergency_phone, insurance_company, 
+                    insurance_number, notes
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                data['name'], 
+                data.get('age'), 
+                data.get('gender'), 
+                data.get('phone'), 
+                data.get('address'),
+                data.get('email'),
+                data.get('national_id'),
+                data.get('blood_type'),
+                data.get('allergies'),
+                data.get('chronic_diseases'),
+                data.get('current_medications'),
+                data.get('emergency_contact'),
+                data.get('emergency_phone'),
+                data.get('insurance_company'),
+                data.get('insurance_number'),
+                data.get('notes')
+            ))
+            return cursor.lastrowid
         
-        cursor.execute('''
-            INSERT INTO patients (
-                name, age, gender, phone, address, email, national_id,
-                blood_type, allergies, chronic_diseases, current_medications,
-                emergency_contact, emergency_phone, insurance_company, 
-                insurance_number, notes
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            data['name'], 
-            data.get('age'), 
-            data.get('gender'), 
-            data.get('phone'), 
-            data.get('address'),
-            data.get('email'),
-            data.get('national_id'),
-            data.get('blood_type'),
-            data.get('allergies'),
-            data.get('chronic_diseases'),
-            data.get('current_medications'),
-            data.get('emergency_contact'),
-            data.get('emergency_phone'),
-            data.get('insurance_company'),
-            data.get('insurance_number'),
-            data.get('notes')
-        ))
-        
-        patient_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        patient_id = run_write(insert_patient)
+        digits_index.add(patient_id, data.get('phone'), data.get('national_id'))
         
         return jsonify({'success': True, 'patient_id': patient_id})
     
     return render_template('new_patient.html')
 
 @app.route('/patient/<int:patient_id>')
+@conditional(patient_details_etag)
 def patient_details(patient_id):
-    """تفاصيل المريض"""
+    """تفاصيل المريض، مع الصفحة الأولى من سجله الزمني وباقي الصفحات تحمل عند التمرير"""
     conn = get_db()
     cursor = conn.cursor()
     
-    # بيانات المريض
-    cursor.execute('SELECT * FROM patients WHERE id = ?', (patient_id,))
-    patient = cursor.fetchone()
+    # بيانات المريض مع ملخص الديون
+    patient = load_timeline_patient(cursor, patient_id)
     
     if not patient:
-        conn.close()
         return "المريض غير موجود", 404
     
-    # زيارات المريض
+    visits, next_cursor = load_timeline_visits(cursor, patient_id, None, page_limit())
+    appointments = load_upcoming_appointments(cursor, patient_id)
+    
+    return render_template('patient_details.html', 
+                         patient=patient, 
+                         visits=visits,
+                         summary=patient,
+                         appointments=appointments,
+                         next_cursor=next_cursor)
+
+# ===== السجل الزمني للمريض =====
+
+TIMELINE_VISIT_FIELDS = ('id', 'visit_date', 'diagnosis', 'symptoms', 'treatment', 'prescriptions',
+                         'lab_tests', 'vital_signs', 'notes', 'total_cost', 'paid_amount',
+                         'remaining_debt', 'next_visit_date', 'fragment_version')
+TIMELINE_APPOINTMENTS = 20   # أقصى عدد مواعيد قادمة في الصفحة الأولى
+
+def load_timeline_patient(cursor, patient_id):
+    """المريض مع أرصدته في استعلام واحد"""
     cursor.execute('''
-        SELECT v.*, 
-               (v.total_cost - v.paid_amount) as remaining_debt
+        SELECT p.*,
+               COALESCE(b.total_charges, 0) as total_charges,
+               COALESCE(b.total_paid, 0) as total_paid,
+               COALESCE(b.total_debt, 0) as total_debt
+        FROM patients p
+        LEFT JOIN patient_balances b ON b.patient_id = p.id
+        WHERE p.id = ?
+    ''', (patient_id,))
+    return cursor.fetchone()
+
+def load_timeline_visits(cursor, patient_id, after, limit):
+    """صفحة من زيارات المريض (الأحدث أولاً) مع أطبائها ودفعاتها
+
+    ثلاثة استعلامات مهما كان عدد الزيارات: الزيارات بمؤشر على (التاريخ، الرقم)،
+    ثم أطباء كل زيارات الصفحة، ثم دفعاتها. يعيد قواميس جاهزة للقالب ولـ JSON.
+    """
+    sql = f'''
+        SELECT v.*, (v.total_cost - v.paid_amount) as remaining_debt,
+               d.name as doctor_name,
+               {fragment_version_sql('v.patient_id', ('generation', 'reference'))}
         FROM visits v
+        LEFT JOIN doctors d ON d.id = v.doctor_id
         WHERE v.patient_id = ?
-        ORDER BY v.visit_date DESC
-    ''', (patient_id,))
+    '''
+    params = [patient_id]
+    if after:
+        sql += ' AND (v.visit_date, v.id) < (?, ?)'
+        params.extend(after[:2])
+    sql += ' ORDER BY v.visit_date DESC, v.id DESC LIMIT ?'
+    params.append(limit + 1)
+    
+    cursor.execute(sql, params)
+    rows, next_cursor = split_page(cursor.fetchall(), limit,
+                                   lambda row: (row['visit_date'], row['id']))
     
-    visits = cursor.fetchall()
+    visits = {}
+    for row in rows:
+        visit = {field: row[field] for field in TIMELINE_VISIT_FIELDS}
+        visit['doctors'] = []
+        visit['payments'] = []
+        visits[row['id']] = (visit, row)
+    if not visits:
+        return [], next_cursor
     
-    # إجمالي الديون
+    placeholders = ', '.join('?' for _ in visits)
+    cursor.execute(f'''
+        SELECT vd.visit_id, d.id, d.name, d.specialization, vd.role, vd.is_primary
+        FROM visit_doctors vd
+        JOIN doctors d ON d.id = vd.doctor_id
+        WHERE vd.visit_id IN ({placeholders})
+        ORDER BY vd.visit_id, vd.is_primary DESC, d.name
+    ''', list(visits))
+    for row in cursor.fetchall():
+        visits[row['visit_id']][0]['doctors'].append({
+            'id': row['id'], 'name': row['name'], 'specialization': row['specialization'],
+            'role': row['role'], 'is_primary': bool(row['is_primary']),
+        })
+    
+    cursor.execute(f'''
+        SELECT id, visit_id, payment_date, amount, payment_method, notes
+        FROM payments
+        WHERE visit_id IN ({placeholders})
+        ORDER BY visit_id, payment_date, id
+    ''', list(visits))
+    for row in cursor.fetchall():
+        visits[row['visit_id']][0]['payments'].append({
+            'id': row['id'], 'payment_date': row['payment_date'], 'amount': row['amount'],
+            'payment_method': row['payment_method'], 'notes': row['notes'],
+        })
+    
+    # الزيارات القديمة بلا سجلات في visit_doctors تعرض طبيبها من visits.doctor_id
+    result = []
+    for visit, row in visits.values():
+        if not visit['doctors'] and row['doctor_id']:
+            visit['doctors'].append({'id': row['doctor_id'], 'name': row['doctor_name'],
+                                     'specialization': None, 'role': None, 'is_primary': True})
+        result.append(visit)
+    return result, next_cursor
+
+def load_upcoming_appointments(cursor, patient_id):
+    """مواعيد المريض من اليوم فصاعداً"""
     cursor.execute('''
-        SELECT 
-            COALESCE(SUM(total_cost), 0) as total_charges,
-            COALESCE(SUM(paid_amount), 0) as total_paid,
-            COALESCE(SUM(total_cost - paid_amount), 0) as total_debt
-        FROM visits
-        WHERE patient_id = ?
-    ''', (patient_id,))
+        SELECT id, appointment_date, appointment_time, reason, status, notes
+        FROM appointments
+        WHERE patient_id = ? AND appointment_date >= ?
+        ORDER BY appointment_date, appointment_time, id
+        LIMIT ?
+    ''', (patient_id, datetime.now().date().isoformat(), TIMELINE_APPOINTMENTS))
+    return [dict(row) for row in cursor.fetchall()]
+
+@app.route('/api/patient/<int:patient_id>/timeline')
+def patient_timeline(patient_id):
+    """السجل الزمني للمريض: الزيارات مع أطبائها ودفعاتها، مقسمة إلى صفحات بمؤشر
+
+    الصفحة الأولى تتضمن أيضاً بيانات المريض وأرصدته ومواعيده القادمة. مع html=1
+    تضاف بطاقات الزيارات جاهزة لزر "تحميل المزيد" في صفحة المريض.
+    """
+    try:
+        after = decode_cursor(request.args.get('cursor'))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    limit = page_limit()
+    with_html = request.args.get('html') == '1'
+    
+    conn = get_db()
+    cursor = conn.cursor()
     
-    summary = cursor.fetchone()
-    conn.close()
+    result = {}
+    if not after:
+        patient = load_timeline_patient(cursor, patient_id)
+        if not patient:
+            return jsonify({'success': False, 'error': 'المريض غير موجود'}), 404
+        result['patient'] = dict(patient)
+        result['appointments'] = load_upcoming_appointments(cursor, patient_id)
     
-    return render_template('patient_details.html', 
-                         patient=patient, 
-                         visits=visits,
-                         summary=summary)
+    visits, next_cursor = load_timeline_visits(cursor, patient_id, after, limit)
+    result['visits'] = visits
+    result['next_cursor'] = next_cursor
+    result['next_url'] = url_for('patient_timeline', patient_id=patient_id, cursor=next_cursor,
+                                 limit=limit, **({'html': 1} if with_html else {})) \
+                         if next_cursor else None
+    if with_html:
+        result['html'] = render_template('_visit_cards.html', visits=visits)
+    return jsonify(result)
 
 @app.route('/visit/new/<int:patient_id>', methods=['GET', 'POST'])
 def new_visit(patient_id):
@@ -340,63 +2975,62 @@ def new_visit(patient_id):
     if request.method == 'POST':
         data = request.get_json()
         
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        # إضافة الزيارة
-        cursor.execute('''
-            INSERT INTO visits (
-                patient_id, doctor_id, diagnosis, symptoms, treatment, prescriptions,
-                lab_tests, vital_signs, notes, total_cost, paid_amount, next_visit_date
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            patient_id,
-            data.get('doctor_id'),  # الطبيب الرئيسي (للتوافق مع النظام القديم)
-            data.get('diagnosis'), 
-            data.get('symptoms'),
-            data.get('treatment'),
-            data.get('prescriptions'),
-            data.get('lab_tests'),
-            data.get('vital_signs'),
-            data.get('notes'), 
-            float(data.get('total_cost', 0)),
-            float(data.get('paid_amount', 0)),
-            data.get('next_visit_date')
-        ))
-        
-        visit_id = cursor.lastrowid
-        
-        # إضافة الأطباء المشاركين
-        primary_doctor_id = data.get('doctor_id')
-        participating_doctors = data.get('participating_doctors', [])
-        
-        # إضافة الطبيب الرئيسي
-        if primary_doctor_id:
+        def insert_visit(cursor):
+            # إضافة الزيارة
             cursor.execute('''
-                INSERT INTO visit_doctors (visit_id, doctor_id, role, is_primary)
-                VALUES (?, ?, ?, ?)
-            ''', (visit_id, primary_doctor_id, 'طبيب رئيسي', 1))
+                INSERT INTO visits (
+                    patient_id, doctor_id, diagnosis, symptoms, treatment, prescriptions,
+                    lab_tests, vital_signs, notes, total_cost, paid_amount, next_visit_date
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                patient_id,
+                data.get('doctor_id'),  # الطبيب الرئيسي (للتوافق مع النظام القديم)
+                data.get('diagnosis'), 
+                data.get('symptoms'),
+                data.get('treatment'),
+                data.get('prescriptions'),
+                data.get('lab_tests'),
+                data.get('vital_signs'),
+                data.get('notes'), 
+                float(data.get('total_cost', 0)),
+                float(data.get('paid_amount', 0)),
+                data.get('next_visit_date')
+            ))
         
-        # إضافة الأطباء المشاركين
-        for doc in participating_doctors:
-            if doc.get('doctor_id') and doc['doctor_id'] != primary_doctor_id:
+            visit_id = cursor.lastrowid
+        
+            # إضافة الأطباء المشاركين
+            primary_doctor_id = data.get('doctor_id')
+            participating_doctors = data.get('participating_doctors', [])
+        
+            # إضافة الطبيب الرئيسي
+            if primary_doctor_id:
                 cursor.execute('''
-                    INSERT INTO visit_doctors (visit_id, doctor_id, role, is_primary, notes)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (visit_id, doc['doctor_id'], doc.get('role', 'طبيب مشارك'), 0, doc.get('notes')))
+                    INSERT INTO visit_doctors (visit_id, doctor_id, role, is_primary)
+                    VALUES (?, ?, ?, ?)
+                ''', (visit_id, primary_doctor_id, 'طبيب رئيسي', 1))
         
-        # إذا في دفعة، سجلها في جدول المدفوعات
-        if float(data.get('paid_amount', 0)) > 0:
-            cursor.execute('''
-                INSERT INTO payments (visit_id, amount, payment_method, notes)
-                VALUES (?, ?, ?, ?)
-            ''', (visit_id, float(data['paid_amount']), 
-                  data.get('payment_method', 'نقدي'), 
-                  'دفعة أولية'))
+            # إضافة الأطباء المشاركين
+            for doc in participating_doctors:
+                if doc.get('doctor_id') and doc['doctor_id'] != primary_doctor_id:
+                    cursor.execute('''
+                        INSERT INTO visit_doctors (visit_id, doctor_id, role, is_primary, notes)
+                        VALUES (?, ?, ?, ?, ?)
+                    ''', (visit_id, doc['doctor_id'], doc.get('role', 'طبيب مشارك'), 0, doc.get('notes')))
         
-        conn.commit()
-        conn.close()
+            # إذا في دفعة، سجلها في جدول المدفوعات
+            if float(data.get('paid_amount', 0)) > 0:
+                cursor.execute('''
+                    INSERT INTO payments (visit_id, amount, payment_method, notes)
+                    VALUES (?, ?, ?, ?)
+                ''', (visit_id, float(data['paid_amount']), 
+                      data.get('payment_method', 'نقدي'), 
+                      'دفعة أولية'))
+            
+            return visit_id
+        
+        visit_id = run_write(insert_visit)
         
         return jsonify({'success': True, 'visit_id': visit_id})
     
@@ -411,8 +3045,6 @@ def new_visit(patient_id):
     cursor.execute('SELECT * FROM doctors ORDER BY name')
     doctors = cursor.fetchall()
     
-    conn.close()
-    
     if not patient:
         return "المريض غير موجود", 404
     
@@ -423,61 +3055,244 @@ def add_payment(visit_id):
     """إضافة دفعة جديدة"""
     data = request.get_json()
     
-    conn = get_db()
-    cursor = conn.cursor()
+    run_write(lambda cursor: apply_payments(cursor, [(
+        visit_id, float(data['amount']), data.get('payment_method', 'نقدي'), data.get('notes', '')
+    )]))
     
-    # إضافة الدفعة
-    cursor.execute('''
+    return jsonify({'success': True})
+
+# ===== الدفعات الجماعية =====
+
+PAYMENT_BATCH_LIMIT = 1000
+
+def apply_payments(cursor, payments):
+    """تسجيل دفعات (visit_id, amount, payment_method, notes) وإضافتها إلى المبلغ المدفوع في زياراتها"""
+    cursor.executemany('''
         INSERT INTO payments (visit_id, amount, payment_method, notes)
         VALUES (?, ?, ?, ?)
-    ''', (visit_id, float(data['amount']), 
-          data.get('payment_method', 'نقدي'),
-          data.get('notes', '')))
+    ''', payments)
     
-    # تحديث المبلغ المدفوع في الزيارة
-    cursor.execute('''
+    cursor.executemany('''
         UPDATE visits
         SET paid_amount = paid_amount + ?
         WHERE id = ?
-    ''', (float(data['amount']), visit_id))
+    ''', [(amount, visit_id) for visit_id, amount, _, _ in payments])
+
+class PaymentsRejected(Exception):
+    """عناصر غير صالحة في طلب الدفعات
+
+    ترفع داخل مهمة الكتابة فتلغى المعاملة ومعها حجز مفتاح منع التكرار، فيمكن
+    إرسال الطلب المصحح بالمفتاح نفسه.
+    """
+
+    def __init__(self, errors):
+        super().__init__(errors)
+        self.errors = errors
+
+def allocate_payments(cursor, entries):
+    """توزيع الدفعات على الزيارات مع التحقق من ألا تتجاوز الدين المتبقي
+
+    كل عنصر إما لزيارة محددة (visit_id) أو دفعة مجمعة لمريض (patient_id) توزع
+    على أقدم زياراته غير المسددة. الديون تخصم أثناء التوزيع، فلا يمكن لعنصرين
+    في الدفعة نفسها سداد الدين نفسه مرتين. يعيد (التوزيع، الأخطاء).
+    """
+    remaining = {}
     
-    conn.commit()
-    conn.close()
+    def visit_debts(sql, params):
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+        for row in rows:
+            remaining.setdefault(row['id'], (row['patient_id'], row['debt']))
+        return [row['id'] for row in rows]
     
-    return jsonify({'success': True})
+    allocations = []
+    errors = []
+    for index, entry in enumerate(entries):
+        try:
+            amount = round(float(entry.get('amount')), 2)
+        except (TypeError, ValueError):
+            errors.append({'index': index, 'error': 'مبلغ غير صالح'})
+            continue
+        if amount <= 0:
+            errors.append({'index': index, 'error': 'المبلغ يجب أن يكون أكبر من صفر'})
+            continue
+        method = entry.get('payment_method', 'نقدي')
+        notes = entry.get('notes', '')
+        
+        if entry.get('visit_id') is not None:
+            visit_ids = visit_debts('''
+                SELECT id, patient_id, ROUND(total_cost - paid_amount, 2) as debt
+                FROM visits WHERE id = ?
+            ''', (entry['visit_id'],))
+            if not visit_ids:
+                errors.append({'index': index, 'error': 'الزيارة غير موجودة'})
+                continue
+        elif entry.get('patient_id') is not None:
+            # أقدم الزيارات غير المسددة أولاً (فهرس idx_visits_patient)
+            visit_ids = visit_debts('''
+                SELECT id, patient_id, ROUND(total_cost - paid_amount, 2) as debt
+                FROM visits
+                WHERE patient_id = ? AND total_cost - paid_amount > 0.005
+                ORDER BY visit_date, id
+            ''', (entry['patient_id'],))
+        else:
+            errors.append({'index': index, 'error': 'حدد الزيارة أو المريض'})
+            continue
+        
+        debt = round(sum(remaining[visit_id][1] for visit_id in visit_ids), 2)
+        if amount > debt:
+            errors.append({'index': index, 'error': f'المبلغ {amount:g} أكبر من الدين المتبقي {debt:g}'})
+            continue
+        
+        left = amount
+        for visit_id in visit_ids:
+            patient_id, visit_debt = remaining[visit_id]
+            part = round(min(left, visit_debt), 2)
+            if part <= 0:
+                continue
+            allocations.append({'index': index, 'visit_id': visit_id, 'patient_id': patient_id,
+                                'amount': part, 'payment_method': method, 'notes': notes})
+            remaining[visit_id] = (patient_id, round(visit_debt - part, 2))
+            left = round(left - part, 2)
+            if left <= 0:
+                break
+    
+    return allocations, errors
+
+@app.route('/payments/batch', methods=['POST'])
+def add_payments_batch():
+    """تسجيل دفعات عدة في معاملة واحدة (تسوية نهاية اليوم)
+
+    الطلب: {"payments": [{"visit_id": 5, "amount": 20}, {"patient_id": 7, "amount": 300,
+    "payment_method": "تأمين"}]}. إذا كان أي عنصر غير صالح لا تسجل أي دفعة.
+    """
+    data = request.get_json(silent=True) or {}
+    entries = data.get('payments')
+    
+    if not isinstance(entries, list) or not entries:
+        return jsonify({'success': False, 'error': 'قائمة الدفعات فارغة'}), 400
+    if len(entries) > PAYMENT_BATCH_LIMIT:
+        return jsonify({'success': False, 'error': f'الحد الأقصى {PAYMENT_BATCH_LIMIT} دفعة في الطلب'}), 400
+    if not all(isinstance(entry, dict) for entry in entries):
+        return jsonify({'success': False, 'error': 'صيغة الدفعات غير صالحة'}), 400
+    
+    def post_payments(cursor):
+        # التحقق والتسجيل في المعاملة نفسها حتى لا تتغير الديون بينهما
+        allocations, errors = allocate_payments(cursor, entries)
+        if errors:
+            raise PaymentsRejected(errors)
+        
+        apply_payments(cursor, [(row['visit_id'], row['amount'], row['payment_method'], row['notes'])
+                                for row in allocations])
+        
+        patient_ids = sorted({row['patient_id'] for row in allocations})
+        cursor.execute(f'''
+            SELECT patient_id, total_charges, total_paid, total_debt, visit_count
+            FROM patient_balances
+            WHERE patient_id IN ({', '.join('?' for _ in patient_ids)})
+        ''', patient_ids)
+        balances = [dict(row) for row in cursor.fetchall()]
+        
+        return {'allocations': allocations, 'balances': balances}
+    
+    try:
+        result = run_write(post_payments)
+    except PaymentsRejected as e:
+        return jsonify({'success': False, 'error': 'لم تسجل أي دفعة', 'errors': e.errors}), 400
+    
+    return jsonify({
+        'success': True,
+        'total_amount': round(sum(row['amount'] for row in result['allocations']), 2),
+        'payments': result['allocations'],
+        'balances': result['balances'],
+    })
+
+def prefix_search(cursor, query, fields):
+    """البحث بالأرقام أو ببادئات الكلمات: قائمة المرضى المطابقين بالحقول المطلوبة"""
+    # جزء من رقم هاتف أو رقم وطني: من فهرس الأرقام في الذاكرة، بترتيبه
+    digits = digit_query(query) if DIGITS_INDEX_ENABLED else None
+    if digits:
+        digits_index.ensure_loaded(cursor)
+        patient_ids = digits_index.lookup(digits, SEARCH_LIMIT)
+        if patient_ids:
+            cursor.execute(f'''
+                WITH hits (id, position) AS (VALUES {', '.join('(?, ?)' for _ in patient_ids)})
+                SELECT {select_fields(fields, PATIENT_RESULT_FIELDS)}
+                FROM hits h
+                JOIN patients p ON p.id = h.id
+                LEFT JOIN patient_balances b ON b.patient_id = p.id
+                ORDER BY h.position
+            ''', [value for position, patient_id in enumerate(patient_ids)
+                  for value in (patient_id, position)])
+            return fetch_dicts(cursor)
+    
+    match = patient_search_query(query)
+    if not match:
+        return []
+    
+    # البحث في الاسم والهاتف والرقم الوطني والبريد مرتباً حسب bm25
+    cursor.execute(f'''
+        SELECT {select_fields(fields, PATIENT_RESULT_FIELDS)}
+        FROM patients_fts f
+        JOIN patients p ON p.id = f.rowid
+        LEFT JOIN patient_balances b ON b.patient_id = p.id
+        WHERE patients_fts MATCH ?
+        ORDER BY f.rank, p.name
+        LIMIT ?
+    ''', (match, SEARCH_LIMIT))
+    
+    return fetch_dicts(cursor)
 
 @app.route('/search')
 def search():
-    """البحث عن المرضى"""
+    """البحث عن المرضى
+
+    mode=prefix بالبادئات فقط، و mode=fuzzy بالتشابه فقط، والافتراضي بالبادئات ثم
+    بالتشابه إذا لم يطابق شيء. نتائج التشابه فيها حقل similarity.
+    """
     query = request.args.get('q', '').strip()
     
     if not query:
         return jsonify([])
     
+    try:
+        fields = requested_fields(PATIENT_RESULT_FIELDS, PATIENT_RESULT_DEFAULT)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    mode = request.args.get('mode', 'auto')
+    if mode not in SEARCH_MODES:
+        return jsonify({'success': False, 'error': f'طريقة بحث غير معروفة: {mode}'}), 400
+    
     conn = get_db()
     cursor = conn.cursor()
     
-    # البحث في حقول متعددة
-    cursor.execute('''
-        SELECT p.*, 
-               COALESCE(SUM(v.total_cost - v.paid_amount), 0) as total_debt
-        FROM patients p
-        LEFT JOIN visits v ON p.id = v.patient_id
-        WHERE p.name LIKE ? 
-           OR p.phone LIKE ? 
-           OR p.national_id LIKE ?
-           OR p.email LIKE ?
-        GROUP BY p.id
-        ORDER BY p.name
-        LIMIT 20
-    ''', (f'%{query}%', f'%{query}%', f'%{query}%', f'%{query}%'))
+    if mode != 'fuzzy':
+        results = prefix_search(cursor, query, fields)
+        if results or mode == 'prefix':
+            return jsonify(results)
     
-    results = cursor.fetchall()
-    conn.close()
+    # أقرب الأسماء، ومرضى كل اسم بترتيبه
+    matches = fuzzy_name_matches(cursor, query)[:SEARCH_LIMIT]
+    if not matches:
+        return jsonify([])
+    cursor.execute(f'''
+        WITH hits (name_id, position, similarity) AS (
+            VALUES {', '.join('(?, ?, ?)' for _ in matches)}
+        )
+        SELECT {select_fields(fields, PATIENT_RESULT_FIELDS)}, h.similarity
+        FROM hits h
+        JOIN patient_name_keys m ON m.name_id = h.name_id
+        JOIN patients p ON p.id = m.patient_id
+        LEFT JOIN patient_balances b ON b.patient_id = p.id
+        ORDER BY h.position, p.id
+        LIMIT ?
+    ''', [*(value for position, (name_id, similarity) in enumerate(matches)
+            for value in (name_id, position, similarity)), SEARCH_LIMIT])
     
-    return jsonify([dict(row) for row in results])
+    return jsonify(fetch_dicts(cursor))
 
 @app.route('/reports')
+@conditional(reports_etag)
 def reports():
     """التقارير المالية"""
     conn = get_db()
@@ -486,76 +3301,155 @@ def reports():
     # إحصائيات عامة
     cursor.execute('''
         SELECT 
-            COUNT(DISTINCT p.id) as total_patients,
-            COUNT(v.id) as total_visits,
-            COALESCE(SUM(v.total_cost), 0) as total_revenue,
-            COALESCE(SUM(v.paid_amount), 0) as total_collected,
-            COALESCE(SUM(v.total_cost - v.paid_amount), 0) as total_outstanding
-        FROM patients p
-        LEFT JOIN visits v ON p.id = v.patient_id
+            COUNT(*) as total_patients,
+            COALESCE(SUM(visit_count), 0) as total_visits,
+            COALESCE(SUM(total_charges), 0) as total_revenue,
+            COALESCE(SUM(total_paid), 0) as total_collected,
+            COALESCE(SUM(total_debt), 0) as total_outstanding
+        FROM patient_balances
     ''')
     
     stats = cursor.fetchone()
     
-    # أكبر الديون
+    # أكبر الديون (مسح لفهرس الدين تنازلياً)
     cursor.execute('''
-        SELECT p.name, p.phone,
-               COALESCE(SUM(v.total_cost - v.paid_amount), 0) as debt
-        FROM patients p
-        LEFT JOIN visits v ON p.id = v.patient_id
-        GROUP BY p.id
-        HAVING debt > 0
-        ORDER BY debt DESC
+        SELECT p.name, p.phone, b.total_debt as debt
+        FROM patient_balances b
+        JOIN patients p ON p.id = b.patient_id
+        WHERE b.total_debt > 0
+        ORDER BY b.total_debt DESC
         LIMIT 10
     ''')
     
     top_debtors = cursor.fetchall()
-    conn.close()
     
-    return render_template('reports.html', stats=stats, top_debtors=top_debtors)
+    # قائمة الأطباء لفلتر مخطط الإيرادات
+    cursor.execute('SELECT id, name FROM doctors ORDER BY name')
+    doctors = cursor.fetchall()
+    
+    return render_template('reports.html', stats=stats, top_debtors=top_debtors, doctors=doctors)
 
 @app.route('/api/dashboard-stats')
+@conditional(dashboard_etag)
 def dashboard_stats():
-    """إحصائيات لوحة التحكم"""
+    """إحصائيات لوحة التحكم (قراءة صفين من العدادات المحدثة تلقائياً)"""
     conn = get_db()
     cursor = conn.cursor()
     
-    # إحصائيات عامة
+    # "اليوم" بالتوقيت المحلي، مثل مفاتيح جدول daily_stats
+    today = datetime.now().date().isoformat()
+    
     cursor.execute('''
-        SELECT 
-            COUNT(DISTINCT p.id) as total_patients,
-            COUNT(v.id) as total_visits,
-            COALESCE(SUM(v.total_cost), 0) as total_revenue,
-            COALESCE(SUM(v.paid_amount), 0) as total_collected,
-            COALESCE(SUM(v.total_cost - v.paid_amount), 0) as total_debt
-        FROM patients p
-        LEFT JOIN visits v ON p.id = v.patient_id
-    ''')
+        SELECT t.total_patients, t.total_visits, t.total_revenue, t.total_collected,
+               ROUND(t.total_revenue - t.total_collected, 2) as total_debt,
+               COALESCE(d.revenue, 0) as today_revenue,
+               COALESCE(d.scheduled_appointments, 0) as today_appointments,
+               t.version, t.updated_at as generated_at
+        FROM dashboard_totals t
+        LEFT JOIN daily_stats d ON d.day = ?
+        WHERE t.id = 1
+    ''', (today,))
     
     stats = dict(cursor.fetchone())
+    stats['day'] = today
     
-    # إيرادات اليوم
-    cursor.execute('''
-        SELECT COALESCE(SUM(paid_amount), 0) as today_revenue
-        FROM visits
-        WHERE DATE(visit_date) = DATE('now')
-    ''')
+    try:
+        fields = requested_fields(stats, stats)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     
-    stats['today_revenue'] = cursor.fetchone()[0]
+    return jsonify({name: stats[name] for name in fields})
+
+REVENUE_MAX_DAYS = 3660     # أقصى عدد أيام في السلسلة اليومية
+
+def _month_start(day, months_back=0):
+    """أول يوم في الشهر بعد الرجوع عدداً من الأشهر"""
+    month_index = day.year * 12 + day.month - 1 - months_back
+    return day.replace(year=month_index // 12, month=month_index % 12 + 1, day=1)
+
+@app.route('/api/revenue')
+def revenue_series():
+    """الإيرادات والتحصيل وعدد الزيارات لكل يوم أو شهر ضمن فترة، ولكل طبيب رئيسي
+
+    المعاملات: from و to بصيغة YYYY-MM-DD، و group=day|month، و doctor_id اختياري
+    (0 = زيارات بدون طبيب رئيسي). تجمع من ملخص revenue_daily وليس من الزيارات.
+    """
+    group = request.args.get('group', 'day')
+    if group not in ('day', 'month'):
+        return jsonify({'success': False, 'error': 'التجميع يجب أن يكون day أو month'}), 400
     
-    # مواعيد اليوم
-    cursor.execute('''
-        SELECT COUNT(*) as today_appointments
-        FROM appointments
-        WHERE appointment_date = DATE('now')
-        AND status = 'مجدول'
-    ''')
+    today = datetime.now().date()
+    default_start = today - timedelta(days=29) if group == 'day' else _month_start(today, 11)
+    try:
+        start = datetime.strptime(request.args.get('from') or default_start.isoformat(), '%Y-%m-%d').date()
+        end = datetime.strptime(request.args.get('to') or today.isoformat(), '%Y-%m-%d').date()
+    except ValueError:
+        return jsonify({'success': False, 'error': 'تاريخ غير صالح'}), 400
+    if end < start:
+        return jsonify({'success': False, 'error': 'تاريخ البداية بعد تاريخ النهاية'}), 400
+    if group == 'day' and (end - start).days >= REVENUE_MAX_DAYS:
+        return jsonify({'success': False, 'error': 'الفترة طويلة، استخدم التجميع الشهري'}), 400
+    doctor_id = request.args.get('doctor_id', type=int)
     
-    stats['today_appointments'] = cursor.fetchone()[0]
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    where = 'r.day BETWEEN ? AND ?'
+    params = [day_number(start.isoformat()), day_number(end.isoformat())]
+    if doctor_id is not None:
+        where += ' AND r.doctor_id = ?'
+        params.append(doctor_id)
+    
+    # مسح مدى على المفتاح الأساسي (day, doctor_id)
+    period = 'r.day' if group == 'day' else 'r.day / 100'
+    cursor.execute(f'''
+        SELECT {period} as period, SUM(r.visits) as visits,
+               ROUND(SUM(r.revenue), 2) as revenue, ROUND(SUM(r.collected), 2) as collected
+        FROM revenue_daily r
+        WHERE {where}
+        GROUP BY period
+    ''', params)
+    totals_by_period = {row['period']: row for row in cursor.fetchall()}
     
-    conn.close()
+    cursor.execute(f'''
+        SELECT r.doctor_id, d.name, SUM(r.visits) as visits,
+               ROUND(SUM(r.revenue), 2) as revenue, ROUND(SUM(r.collected), 2) as collected
+        FROM revenue_daily r
+        LEFT JOIN doctors d ON d.id = r.doctor_id
+        WHERE {where}
+        GROUP BY r.doctor_id
+        HAVING SUM(r.visits) != 0
+        ORDER BY revenue DESC
+    ''', params)
+    doctors = [dict(row) for row in cursor.fetchall()]
     
-    return jsonify(stats)
+    # سلسلة كاملة بدون فجوات، حتى يرسم المخطط الأيام أو الأشهر الفارغة
+    series = []
+    current = start if group == 'day' else _month_start(start)
+    while current <= end:
+        key = int(current.strftime('%Y%m%d' if group == 'day' else '%Y%m'))
+        row = totals_by_period.get(key)
+        series.append({
+            'period': current.isoformat() if group == 'day' else current.strftime('%Y-%m'),
+            'visits': row['visits'] if row else 0,
+            'revenue': row['revenue'] if row else 0,
+            'collected': row['collected'] if row else 0,
+        })
+        current = current + timedelta(days=1) if group == 'day' else _month_start(current, -1)
+    
+    return jsonify({
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'group': group,
+        'doctor_id': doctor_id,
+        'totals': {
+            'visits': sum(point['visits'] for point in series),
+            'revenue': round(sum(point['revenue'] for point in series), 2),
+            'collected': round(sum(point['collected'] for point in series), 2),
+        },
+        'series': series,
+        'doctors': doctors,
+    })
 
 # ===== إدارة الأطباء =====
 
@@ -565,9 +3459,11 @@ def doctors_list():
     conn = get_db()
     cursor = conn.cursor()
     
-    cursor.execute('SELECT * FROM doctors ORDER BY name')
+    cursor.execute(f'''
+        SELECT *, {fragment_version_sql(scopes=('generation', 'reference'))}
+        FROM doctors ORDER BY name
+    ''')
     doctors = cursor.fetchall()
-    conn.close()
     
     return render_template('doctors.html', doctors=doctors)
 
@@ -577,18 +3473,15 @@ def new_doctor():
     if request.method == 'POST':
         data = request.get_json()
         
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO doctors (name, specialization, phone, email, license_number)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (data['name'], data.get('specialization'), data.get('phone'),
-              data.get('email'), data.get('license_number')))
+        def insert_doctor(cursor):
+            cursor.execute('''
+                INSERT INTO doctors (name, specialization, phone, email, license_number)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (data['name'], data.get('specialization'), data.get('phone'),
+                  data.get('email'), data.get('license_number')))
+            return cursor.lastrowid
         
-        doctor_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        doctor_id = run_write(insert_doctor)
         
         return jsonify({'success': True, 'doctor_id': doctor_id})
     
@@ -597,58 +3490,72 @@ def new_doctor():
 @app.route('/doctor/delete/<int:doctor_id>', methods=['POST'])
 def delete_doctor(doctor_id):
     """حذف طبيب"""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    cursor.execute('DELETE FROM doctors WHERE id = ?', (doctor_id,))
+    def delete(cursor):
+        cursor.execute('DELETE FROM doctors WHERE id = ?', (doctor_id,))
     
-    conn.commit()
-    conn.close()
+    run_write(delete)
     
     return jsonify({'success': True})
 
 # ===== التصدير والنسخ الاحتياطي =====
 
+def load_clinic(cursor):
+    """إعدادات العيادة المستخدمة في ترويسة التقارير"""
+    cursor.execute('SELECT * FROM clinic_settings WHERE id = 1')
+    return cursor.fetchone()
+
+def load_patient_export(cursor, patient_id, start_date=None, end_date=None):
+    """بيانات تقرير المريض: المريض وزياراته (ضمن فترة اختيارية)"""
+    cursor.execute('SELECT * FROM patients WHERE id = ?', (patient_id,))
+    patient = cursor.fetchone()
+    if not patient:
+        return None, []
+    
+    sql = '''
+        SELECT v.*, d.name as doctor_name, d.specialization as doctor_spec
+        FROM visits v
+        LEFT JOIN doctors d ON v.doctor_id = d.id
+        WHERE v.patient_id = ?
+    '''
+    params = [patient_id]
+    if start_date:
+        sql += ' AND v.visit_day >= ?'
+        params.append(day_number(start_date))
+    if end_date:
+        sql += ' AND v.visit_day <= ?'
+        params.append(day_number(end_date))
+    sql += ' ORDER BY v.visit_date DESC'
+    
+    cursor.execute(sql, params)
+    return patient, cursor.fetchall()
+
 @app.route('/patient/<int:patient_id>/export')
+@conditional(patient_etag)
 def export_patient(patient_id):
     """تصدير ملف المريض كـ PDF"""
     conn = get_db()
     cursor = conn.cursor()
     
     # إعدادات العيادة
-    cursor.execute('SELECT * FROM clinic_settings WHERE id = 1')
-    clinic = cursor.fetchone()
+    clinic = load_clinic(cursor)
     
-    # بيانات المريض
-    cursor.execute('SELECT * FROM patients WHERE id = ?', (patient_id,))
-    patient = cursor.fetchone()
+    # بيانات المريض وزياراته
+    patient, visits = load_patient_export(cursor, patient_id)
     
     if not patient:
         return "المريض غير موجود", 404
     
-    # زيارات المريض
-    cursor.execute('''
-        SELECT v.*, d.name as doctor_name, d.specialization as doctor_spec
-        FROM visits v
-        LEFT JOIN doctors d ON v.doctor_id = d.id
-        WHERE v.patient_id = ?
-        ORDER BY v.visit_date DESC
-    ''', (patient_id,))
-    
-    visits = cursor.fetchall()
-    conn.close()
-    
     return render_template('export_patient.html', patient=patient, visits=visits, clinic=clinic)
 
 @app.route('/visit/<int:visit_id>/export')
+@conditional(visit_etag)
 def export_visit(visit_id):
     """تصدير زيارة واحدة"""
     conn = get_db()
     cursor = conn.cursor()
     
     # إعدادات العيادة
-    cursor.execute('SELECT * FROM clinic_settings WHERE id = 1')
-    clinic = cursor.fetchone()
+    clinic = load_clinic(cursor)
     
     # بيانات الزيارة
     cursor.execute('''
@@ -661,42 +3568,169 @@ def export_visit(visit_id):
     ''', (visit_id,))
     
     visit = cursor.fetchone()
-    conn.close()
     
     if not visit:
         return "الزيارة غير موجودة", 404
     
     return render_template('export_visit.html', visit=visit, clinic=clinic)
 
+# ===== التصدير الجماعي =====
+
+EXPORT_WORKERS = 4
+EXPORT_IN_FLIGHT = EXPORT_WORKERS * 2   # أقصى عدد تقارير في الذاكرة في نفس الوقت
+
+class _ZipStreamBuffer(io.RawIOBase):
+    """مخزن يجمع ما يكتبه zipfile لإرساله على دفعات (ملف غير قابل للتنقل)"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def _export_file_name(patient):
+    """اسم ملف التقرير داخل الأرشيف"""
+    name = re.sub(r'[\\/:*?"<>|\s]+', '_', patient['name']).strip('_')
+    return f"{patient['id']}_{name or 'patient'}.html"
+
+def _render_patient_export(patient_id, clinic, start_date, end_date, base_url):
+    """تحميل بيانات مريض وعرض تقريره (يعمل داخل خيط من مجمع العمال)"""
+    pool = _get_pool(readonly=True)
+    conn = pool.acquire()
+    try:
+        patient, visits = load_patient_export(conn.cursor(), patient_id, start_date, end_date)
+    finally:
+        pool.release(conn)
+    if not patient:
+        return None, None
+    
+    with app.test_request_context('/', base_url=base_url):
+        html = render_template('export_patient.html', patient=patient, visits=visits, clinic=clinic)
+    return _export_file_name(patient), html.encode('utf-8')
+
+def _stream_export_zip(patient_ids, clinic, start_date, end_date, base_url):
+    """عرض التقارير بالتوازي وإضافة كل تقرير إلى الأرشيف فور انتهائه"""
+    buffer = _ZipStreamBuffer()
+    ids = iter(patient_ids)
+    
+    with ThreadPoolExecutor(max_workers=EXPORT_WORKERS) as executor:
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+            pending = set()
+            while True:
+                for patient_id in itertools.islice(ids, EXPORT_IN_FLIGHT - len(pending)):
+                    pending.add(executor.submit(_render_patient_export, patient_id, clinic,
+                                                start_date, end_date, base_url))
+                if not pending:
+                    break
+                
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, html = future.result()
+                    if name:
+                        archive.writestr(name, html)
+                yield buffer.drain()
+    yield buffer.drain()
+
+@app.route('/export/batch')
+def export_batch():
+    """تصدير ملفات عدة مرضى في أرشيف ZIP واحد
+
+    المرضى يحددون بقائمة أرقام (patient_ids=1,2,3) أو بشركة التأمين،
+    مع فترة اختيارية (start_date, end_date) تحدد الزيارات المشمولة.
+    """
+    patient_ids = request.args.get('patient_ids', '').strip()
+    insurance_company = request.args.get('insurance_company', '').strip()
+    start_date = request.args.get('start_date') or None
+    end_date = request.args.get('end_date') or None
+    
+    if not (patient_ids or insurance_company or start_date or end_date):
+        return jsonify({'success': False, 'error': 'حدد المرضى أو شركة التأمين أو الفترة'}), 400
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    sql = 'SELECT p.id FROM patients p WHERE 1=1'
+    params = []
+    
+    if patient_ids:
+        try:
+            ids = [int(value) for value in patient_ids.split(',') if value.strip()]
+        except ValueError:
+            return jsonify({'success': False, 'error': 'أرقام مرضى غير صالحة'}), 400
+        sql += f" AND p.id IN ({', '.join('?' for _ in ids)})"
+        params.extend(ids)
+    
+    if insurance_company:
+        sql += ' AND p.insurance_company = ?'
+        params.append(insurance_company)
+    
+    # المرضى الذين لهم زيارة واحدة على الأقل ضمن الفترة (مسح مدى على idx_visits_day)
+    if start_date or end_date:
+        try:
+            first_day = day_number(start_date) if start_date else 0
+            last_day = day_number(end_date) if end_date else 99991231
+        except ValueError:
+            return jsonify({'success': False, 'error': 'تاريخ غير صالح'}), 400
+        sql += ' AND p.id IN (SELECT v.patient_id FROM visits v WHERE v.visit_day BETWEEN ? AND ?)'
+        params.extend([first_day, last_day])
+    
+    sql += ' ORDER BY p.id'
+    cursor.execute(sql, params)
+    selected = [row[0] for row in cursor.fetchall()]
+    
+    if not selected:
+        return jsonify({'success': False, 'error': 'لا يوجد مرضى مطابقون'}), 404
+    
+    # إعدادات العيادة تحمل مرة واحدة للدفعة كلها
+    clinic = load_clinic(cursor)
+    
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    response = app.response_class(
+        _stream_export_zip(selected, clinic, start_date, end_date, request.host_url),
+        mimetype='application/zip', direct_passthrough=True)
+    response.headers['Content-Disposition'] = f'attachment; filename=patients_export_{timestamp}.zip'
+    return response
+
 @app.route('/settings', methods=['GET', 'POST'])
 def clinic_settings():
     """إعدادات العيادة"""
     if request.method == 'POST':
         data = request.get_json()
         
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            UPDATE clinic_settings
-            SET clinic_name = ?,
-                clinic_address = ?,
-                clinic_phone = ?,
-                clinic_email = ?,
-                header_text = ?,
-                footer_text = ?
-            WHERE id = 1
-        ''', (
-            data.get('clinic_name'),
-            data.get('clinic_address'),
-            data.get('clinic_phone'),
-            data.get('clinic_email'),
-            data.get('header_text'),
-            data.get('footer_text')
-        ))
+        def update_settings(cursor):
+            cursor.execute('''
+                UPDATE clinic_settings
+                SET clinic_name = ?,
+                    clinic_address = ?,
+                    clinic_phone = ?,
+                    clinic_email = ?,
+                    header_text = ?,
+                    footer_text = ?
+                WHERE id = 1
+            ''', (
+                data.get('clinic_name'),
+                data.get('clinic_address'),
+                data.get('clinic_phone'),
+                data.get('clinic_email'),
+                data.get('header_text'),
+                data.get('footer_text')
+            ))
         
-        conn.commit()
-        conn.close()
+        run_write(update_settings)
         
         return jsonify({'success': True})
     
@@ -704,17 +3738,16 @@ def clinic_settings():
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM clinic_settings WHERE id = 1')
     settings = cursor.fetchone()
-    conn.close()
     
     return render_template('settings.html', settings=settings)
 
 @app.route('/patient/<int:patient_id>/delete', methods=['POST'])
 def delete_patient(patient_id):
     """حذف المريض وجميع بياناته المرتبطة"""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    try:
+    def delete(cursor):
+        cursor.execute('SELECT phone, national_id FROM patients WHERE id = ?', (patient_id,))
+        patient = cursor.fetchone()
+        
         # حذف المدفوعات المرتبطة بزيارات المريض
         cursor.execute('''
             DELETE FROM payments 
@@ -727,37 +3760,222 @@ def delete_patient(patient_id):
         # حذف المواعيد
         cursor.execute('DELETE FROM appointments WHERE patient_id = ?', (patient_id,))
         
-        # حذف المريض
+        # حذف المريض (مشغلاته تحذف اسمه من فهرس المقاطع الثلاثية إن لم يبق غيره)
         cursor.execute('DELETE FROM patients WHERE id = ?', (patient_id,))
-        
-        conn.commit()
-        conn.close()
-        
-        return jsonify({'success': True, 'message': 'تم حذف المريض وجميع بياناته بنجاح'})
-    except Exception as e:
-        conn.close()
+        return list(patient) if patient else None
+    
+    try:
+        patient = run_write(delete)
+    except sqlite3.Error as e:
         return jsonify({'success': False, 'error': str(e)}), 500
+    
+    # فهرس الأرقام في الذاكرة يحدث بعد تثبيت الحذف
+    if patient:
+        digits_index.remove(patient_id, *patient)
+    
+    return jsonify({'success': True, 'message': 'تم حذف المريض وجميع بياناته بنجاح'})
+
+# ===== النسخ الاحتياطي والاستعادة =====
+
+BACKUP_PAGES_PER_STEP = 256         # صفحات تنسخ في كل خطوة من واجهة backup
+BACKUP_STEP_SLEEP = 0.005           # استراحة بين الخطوات حتى تستمر عمليات الكتابة
+BACKUP_CHUNK_SIZE = 64 * 1024
+BACKUP_DIR = os.environ.get('MEDICAL_BACKUP_DIR', 'backups')
+BACKUP_KEEP = int(os.environ.get('MEDICAL_BACKUP_KEEP', '0'))   # 0 = بدون نسخ يومية تلقائية
+BACKUP_INTERVAL = 3600              # فحص الحاجة لنسخة يومية كل ساعة
+
+def _temp_path_near_database(suffix):
+    """مسار ملف مؤقت بجانب قاعدة البيانات (نفس القرص، وليس /tmp)"""
+    directory = os.path.dirname(os.path.abspath(DATABASE))
+    fd, path = tempfile.mkstemp(prefix='.snapshot_', suffix=suffix, dir=directory)
+    os.close(fd)
+    return path
+
+def snapshot_database(target_path):
+    """أخذ نسخة متسقة من قاعدة البيانات الحية على دفعات دون إيقاف الكتابة"""
+    source = _connect(readonly=True)
+    target = sqlite3.connect(target_path)
+    try:
+        source.backup(target, pages=BACKUP_PAGES_PER_STEP,
+                      progress=lambda status, remaining, total: time.sleep(BACKUP_STEP_SLEEP))
+        # ملف واحد مستقل بدون ملفات -wal
+        target.execute('PRAGMA journal_mode = DELETE')
+    finally:
+        target.close()
+        source.close()
+
+def _gzip_chunks(path):
+    """قراءة الملف على أجزاء وضغطها بصيغة gzip"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(BACKUP_CHUNK_SIZE)
+            if not chunk:
+                break
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+    yield compressor.flush()
+
+def _stream_snapshot(path):
+    """إرسال النسخة مضغوطة أثناء القراءة ثم حذف الملف المؤقت"""
+    try:
+        yield from _gzip_chunks(path)
+    finally:
+        os.remove(path)
+
+def write_compressed_backup(target_path):
+    """حفظ نسخة احتياطية مضغوطة في مسار محدد"""
+    snapshot = _temp_path_near_database('.db')
+    partial = target_path + '.part'
+    try:
+        snapshot_database(snapshot)
+        with open(partial, 'wb') as out:
+            for data in _gzip_chunks(snapshot):
+                out.write(data)
+        os.replace(partial, target_path)
+    finally:
+        os.remove(snapshot)
+        if os.path.exists(partial):
+            os.remove(partial)
+
+def rotate_backups(directory=None, keep=None):
+    """نسخة يومية مضغوطة في مجلد النسخ مع الاحتفاظ بآخر keep نسخة"""
+    directory = directory or BACKUP_DIR
+    keep = keep or BACKUP_KEEP or 7
+    os.makedirs(directory, exist_ok=True)
+    
+    target = os.path.join(directory, f"daily_{datetime.now().strftime('%Y%m%d')}.db.gz")
+    created = None
+    if not os.path.exists(target):
+        write_compressed_backup(target)
+        created = target
+    
+    dailies = sorted(name for name in os.listdir(directory)
+                     if name.startswith('daily_') and name.endswith('.db.gz'))
+    for name in dailies[:-keep]:
+        os.remove(os.path.join(directory, name))
+    return created
+
+def start_backup_scheduler(interval=BACKUP_INTERVAL):
+    """تشغيل النسخ اليومي في خيط خلفي"""
+    def run():
+        while True:
+            try:
+                created = rotate_backups()
+                if created:
+                    print(f"تم حفظ نسخة احتياطية يومية: {created}")
+            except Exception as e:
+                print(f"خطأ في النسخ الاحتياطي اليومي: {e}")
+            time.sleep(interval)
+    
+    thread = threading.Thread(target=run, name='backup-scheduler', daemon=True)
+    thread.start()
+    return thread
+
+def restore_database(source_path):
+    """التحقق من نسخة احتياطية (مضغوطة أو لا) ثم استبدال قاعدة البيانات الحية بها"""
+    with open(source_path, 'rb') as f:
+        compressed = f.read(2) == b'\x1f\x8b'
+    
+    snapshot_path = source_path
+    if compressed:
+        snapshot_path = _temp_path_near_database('.db')
+        with gzip.open(source_path, 'rb') as src, open(snapshot_path, 'wb') as out:
+            shutil.copyfileobj(src, out, BACKUP_CHUNK_SIZE)
+    
+    try:
+        # النسخ نفسه يتم في خيط الكتابة
+        snapshot = sqlite3.connect(snapshot_path, check_same_thread=False)
+        try:
+            try:
+                result = snapshot.execute('PRAGMA integrity_check').fetchone()[0]
+            except sqlite3.DatabaseError as e:
+                raise ValueError(f'الملف ليس قاعدة بيانات صالحة: {e}')
+            if result != 'ok':
+                raise ValueError(f'فشل فحص سلامة النسخة الاحتياطية: {result}')
+            if not _table_exists(snapshot.cursor(), 'patients'):
+                raise ValueError('الملف لا يحتوي على بيانات المرضى')
+            if schema_version(snapshot) > SCHEMA_VERSION:
+                raise ValueError('النسخة الاحتياطية من إصدار أحدث من التطبيق')
+            
+            # الاستبدال عبر واجهة backup: تغيير ذري يراه كل الاتصالات الأخرى. ينفذ
+            # وحده في خيط الكتابة فلا يتداخل مع دفعة كتابة ولا تفشل كتابة بـ database
+            # is locked، ثم ترقى النسخة المستعادة إذا كانت من إصدار أقدم
+            def replace(live):
+                snapshot.backup(live)
+                return migrate(live)
+            
+            version = run_exclusive_write(replace)
+        finally:
+            snapshot.close()
+    finally:
+        if compressed:
+            os.remove(snapshot_path)
+    
+    close_pools()
+    rotate_etag_salt()
+    fragment_cache.clear()
+    digits_index.invalidate()
+    return version
 
 @app.route('/backup/database')
 def backup_database():
-    """تصدير نسخة احتياطية من قاعدة البيانات"""
-    import shutil
-    from datetime import datetime
-    
+    """تصدير نسخة احتياطية مضغوطة من قاعدة البيانات أثناء عملها"""
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    backup_filename = f'backup_{timestamp}.db'
-    backup_path = os.path.join('/tmp', backup_filename)
+    backup_filename = f'backup_{timestamp}.db.gz'
     
     try:
-        shutil.copy2(DATABASE, backup_path)
-        
-        from flask import send_file
-        return send_file(backup_path, 
-                        as_attachment=True,
-                        download_name=backup_filename,
-                        mimetype='application/x-sqlite3')
+        snapshot = _temp_path_near_database('.db')
+        snapshot_database(snapshot)
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+    
+    response = app.response_class(_stream_snapshot(snapshot), mimetype='application/gzip',
+                                  direct_passthrough=True)
+    response.headers['Content-Disposition'] = f'attachment; filename={backup_filename}'
+    return response
+
+@app.route('/backup/restore', methods=['POST'])
+def restore_backup():
+    """استعادة قاعدة البيانات من نسخة احتياطية مرفوعة"""
+    upload = request.files.get('file')
+    if not upload:
+        return jsonify({'success': False, 'error': 'لم يتم اختيار ملف'}), 400
+    
+    upload_path = _temp_path_near_database('.upload')
+    try:
+        upload.save(upload_path)
+        version = restore_database(upload_path)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        os.remove(upload_path)
+    
+    return jsonify({'success': True, 'schema_version': version})
+
+@app.cli.command('backup')
+@click.option('--dir', 'directory', default=None, help='مجلد النسخ اليومية')
+@click.option('--keep', default=None, type=int, help='عدد النسخ اليومية المحفوظة')
+def backup_command(directory, keep):
+    """حفظ نسخة احتياطية يومية مضغوطة وحذف النسخ القديمة"""
+    created = rotate_backups(directory, keep)
+    click.echo(f"تم حفظ النسخة: {created}" if created else "نسخة اليوم موجودة بالفعل")
+
+@app.cli.command('restore-backup')
+@click.argument('path')
+def restore_backup_command(path):
+    """استعادة قاعدة البيانات من ملف نسخة احتياطية"""
+    try:
+        version = restore_database(path)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"تمت الاستعادة بنجاح (نسخة المخطط {version})")
+
+# عدد الزيارات في الفترة الذي يصبح بعده المرور بترتيب الاسم أسرع من جمع المرضى وترتيبهم
+DATE_FILTER_SCAN_LIMIT = 5000
 
 @app.route('/search/advanced')
 def advanced_search():
@@ -765,15 +3983,18 @@ def advanced_search():
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
     query = request.args.get('q', '').strip()
+    try:
+        fields = requested_fields(PATIENT_RESULT_FIELDS, PATIENT_RESULT_DEFAULT)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     
     conn = get_db()
     cursor = conn.cursor()
     
-    sql = '''
-        SELECT DISTINCT p.*, 
-               COALESCE(SUM(v.total_cost - v.paid_amount), 0) as total_debt
+    sql = f'''
+        SELECT {select_fields(fields, PATIENT_RESULT_FIELDS)}
         FROM patients p
-        LEFT JOIN visits v ON p.id = v.patient_id
+        LEFT JOIN patient_balances b ON b.patient_id = p.id
         WHERE 1=1
     '''
     
@@ -783,40 +4004,92 @@ def advanced_search():
         sql += ' AND (p.name LIKE ? OR p.phone LIKE ? OR p.national_id LIKE ?)'
         params.extend([f'%{query}%', f'%{query}%', f'%{query}%'])
     
-    if start_date:
-        sql += ' AND DATE(v.visit_date) >= ?'
-        params.append(start_date)
-    
-    if end_date:
-        sql += ' AND DATE(v.visit_date) <= ?'
-        params.append(end_date)
+    # المرضى الذين لهم زيارة واحدة على الأقل ضمن الفترة
+    if start_date or end_date:
+        try:
+            first_day = day_number(start_date) if start_date else 0
+            last_day = day_number(end_date) if end_date else 99991231
+        except ValueError:
+            return jsonify({'success': False, 'error': 'تاريخ غير صالح'}), 400
+        
+        # فترة فيها زيارات قليلة: جمع مرضاها بمسح مدى على idx_visits_day ثم الترتيب.
+        # فترة واسعة: المرور على المرضى بترتيب الاسم والتوقف عند أول 50 مطابقاً.
+        cursor.execute('''
+            SELECT COUNT(*) FROM (
+                SELECT 1 FROM visits WHERE visit_day BETWEEN ? AND ? LIMIT ?
+            )
+        ''', (first_day, last_day, DATE_FILTER_SCAN_LIMIT))
+        if cursor.fetchone()[0] < DATE_FILTER_SCAN_LIMIT:
+            sql += ' AND p.id IN (SELECT v.patient_id FROM visits v WHERE v.visit_day BETWEEN ? AND ?)'
+        else:
+            sql += ''' AND EXISTS (SELECT 1 FROM visits v
+                             WHERE v.patient_id = p.id AND v.visit_day BETWEEN ? AND ?)'''
+        params.extend([first_day, last_day])
     
-    sql += ' GROUP BY p.id ORDER BY p.name LIMIT 50'
+    sql += ' ORDER BY p.name LIMIT 50'
     
     cursor.execute(sql, params)
-    results = cursor.fetchall()
-    conn.close()
     
-    return jsonify([dict(row) for row in results])
+    return jsonify(fetch_dicts(cursor))
 
 @app.route('/appointments')
 def appointments_list():
-    """قائمة المواعيد"""
+    """قائمة المواعيد، افتراضياً المواعيد القادمة، مقسمة إلى صفحات بمؤشر"""
+    try:
+        after = decode_cursor(request.args.get('cursor'))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    limit = page_limit()
+    
+    # بدون معامل "from" تعرض المواعيد من اليوم فصاعداً، وقيمة فارغة تعرض الكل
+    filters = {
+        'from': request.args.get('from', datetime.now().date().isoformat()),
+        'to': request.args.get('to', ''),
+        'status': request.args.get('status', ''),
+    }
+    
     conn = get_db()
     cursor = conn.cursor()
     
-    # جلب جميع المواعيد مع بيانات المرضى
-    cursor.execute('''
-        SELECT a.*, p.name as patient_name, p.phone
+    sql = f'''
+        SELECT a.*, p.name as patient_name, p.phone,
+               {fragment_version_sql('a.patient_id')}
         FROM appointments a
         JOIN patients p ON a.patient_id = p.id
-        ORDER BY a.appointment_date, a.appointment_time
-    ''')
+        WHERE 1=1
+    '''
+    params = []
+    if filters['from']:
+        sql += ' AND a.appointment_date >= ?'
+        params.append(filters['from'])
+    if filters['to']:
+        sql += ' AND a.appointment_date <= ?'
+        params.append(filters['to'])
+    if filters['status']:
+        sql += ' AND a.status = ?'
+        params.append(filters['status'])
+    if after:
+        sql += ' AND (a.appointment_date, a.appointment_time, a.id) > (?, ?, ?)'
+        params.extend(after[:3])
+    sql += ' ORDER BY a.appointment_date, a.appointment_time, a.id LIMIT ?'
+    params.append(limit + 1)
+    
+    cursor.execute(sql, params)
+    appointments, next_cursor = split_page(
+        cursor.fetchall(), limit,
+        lambda row: (row['appointment_date'], row['appointment_time'], row['id']))
     
-    appointments = cursor.fetchall()
-    conn.close()
+    if request.args.get('format') == 'json':
+        return jsonify({
+            'items': [dict(row) for row in appointments],
+            'html': render_template('_appointment_cards.html', appointments=appointments),
+            'next_cursor': next_cursor,
+            'next_url': url_for('appointments_list', cursor=next_cursor, limit=limit,
+                                format='json', **filters) if next_cursor else None,
+        })
     
-    return render_template('appointments.html', appointments=appointments)
+    return render_template('appointments.html', appointments=appointments,
+                           filters=filters, next_cursor=next_cursor)
 
 @app.route('/appointment/new/<int:patient_id>', methods=['GET', 'POST'])
 def new_appointment(patient_id):
@@ -824,19 +4097,16 @@ def new_appointment(patient_id):
     if request.method == 'POST':
         data = request.get_json()
         
-        conn = get_db()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO appointments (patient_id, appointment_date, appointment_time, 
-                                    reason, status, notes)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (patient_id, data['appointment_date'], data['appointment_time'],
-              data.get('reason'), data.get('status', 'مجدول'), data.get('notes')))
+        def insert_appointment(cursor):
+            cursor.execute('''
+                INSERT INTO appointments (patient_id, appointment_date, appointment_time, 
+                                        reason, status, notes)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (patient_id, data['appointment_date'], data['appointment_time'],
+                  data.get('reason'), data.get('status', 'مجدول'), data.get('notes')))
+            return cursor.lastrowid
         
-        appointment_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        appointment_id = run_write(insert_appointment)
         
         return jsonify({'success': True, 'appointment_id': appointment_id})
     
@@ -844,7 +4114,6 @@ def new_appointment(patient_id):
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM patients WHERE id = ?', (patient_id,))
     patient = cursor.fetchone()
-    conn.close()
     
     if not patient:
         return "المريض غير موجود", 404
@@ -856,34 +4125,195 @@ def update_appointment_status(appointment_id):
     """تحديث حالة الموعد"""
     data = request.get_json()
     
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        UPDATE appointments
-        SET status = ?
-        WHERE id = ?
-    ''', (data['status'], appointment_id))
+    def update_status(cursor):
+        cursor.execute('''
+            UPDATE appointments
+            SET status = ?
+            WHERE id = ?
+        ''', (data['status'], appointment_id))
     
-    conn.commit()
-    conn.close()
+    run_write(update_status)
     
     return jsonify({'success': True})
 
 @app.route('/appointment/delete/<int:appointment_id>', methods=['POST'])
 def delete_appointment(appointment_id):
     """حذف موعد"""
-    conn = get_db()
-    cursor = conn.cursor()
+    def delete(cursor):
+        cursor.execute('DELETE FROM appointments WHERE id = ?', (appointment_id,))
     
-    cursor.execute('DELETE FROM appointments WHERE id = ?', (appointment_id,))
-    
-    conn.commit()
-    conn.close()
+    run_write(delete)
     
     return jsonify({'success': True})
 
+# ===== الملفات الثابتة =====
+# python build_assets.py يبني static/dist: ملفات مصغرة بأسماء فيها بصمة المحتوى،
+# مع نسخ gz و br مضغوطة مسبقاً، و assets.json يربط كل اسم أصلي بالاسم المبني.
+# بدون البناء (أو في وضع --debug) تستخدم الملفات الأصلية كما هي
+
+DIST_DIR = os.path.join(app.static_folder, 'dist')
+ASSET_MANIFEST = os.path.join(DIST_DIR, 'assets.json')
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+# الملفات التي تدمج في ملف واحد عند البناء، بترتيب تحميلها
+ASSET_BUNDLES = {
+    'css/app.css': ('css/style.css', 'css/enhanced-style.css', 'css/mobile.css'),
+}
+
+def load_asset_manifest():
+    """قراءة assets.json إن وجد، أو قاموس فارغ"""
+    try:
+        with open(ASSET_MANIFEST, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+asset_manifest = load_asset_manifest()
+
+def built_assets():
+    """جدول الملفات المبنية، أو قاموس فارغ في وضع التطوير"""
+    return {} if app.debug else asset_manifest.get('files', {})
+
+@app.url_defaults
+def fingerprinted_static_url(endpoint, values):
+    """url_for('static', filename=...) يعيد رابط النسخة المبنية إن وجدت"""
+    if endpoint == 'static' and 'filename' in values:
+        values['filename'] = built_assets().get(values['filename'], values['filename'])
+
+@app.template_global()
+def asset_bundle(name):
+    """أسماء الملفات التي يحمّلها القالب: الملف المدمج إن بني، وإلا الملفات الأصلية"""
+    return [name] if name in built_assets() else list(ASSET_BUNDLES[name])
+
+@app.route('/static/dist/<path:filename>')
+def dist_asset(filename):
+    """ملفات البناء: النسخة المضغوطة مسبقاً إن قبلها المتصفح، وتخزين دائم للأسماء ذات البصمة"""
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    # الأسماء ذات البصمة لا يتغير محتواها أبداً، والباقي (sw.js) يتحقق منه كل مرة
+    max_age = IMMUTABLE_MAX_AGE if filename in asset_manifest.get('immutable', ()) else None
+    encoding = next((name for name, suffix in (('br', '.br'), ('gzip', '.gz'))
+                     if request.accept_encodings[name]
+                     and os.path.isfile(os.path.join(DIST_DIR, filename + suffix))), None)
+    if encoding:
+        response = send_from_directory(DIST_DIR, filename + ('.br' if encoding == 'br' else '.gz'),
+                                       mimetype=mimetype, max_age=max_age)
+        response.content_encoding = encoding
+    else:
+        response = send_from_directory(DIST_DIR, filename, mimetype=mimetype, max_age=max_age)
+    response.vary.add('Accept-Encoding')
+    if max_age:
+        response.cache_control.immutable = True
+    return response
+
+@app.route('/sw.js')
+def service_worker():
+    """عامل الخدمة من جذر الموقع ليشمل كل الصفحات، بقائمة التخزين المولدة عند البناء"""
+    directory = DIST_DIR if 'sw.js' in built_assets() else app.static_folder
+    response = send_from_directory(directory, 'sw.js', mimetype='text/javascript')
+    response.cache_control.no_cache = True
+    return response
+
+# ===== ضغط الاستجابات =====
+# صفحات HTML واستجابات JSON الأكبر من COMPRESS_MIN_BYTES تضغط حسب Accept-Encoding:
+# br إذا كانت مكتبة brotli مثبتة، وإلا gzip. ملفات static/dist مضغوطة مسبقاً
+# والملفات المرسلة من القرص لا تمر هنا. MEDICAL_COMPRESS=0 يعطل الضغط
+
+COMPRESSION_ENABLED = os.environ.get('MEDICAL_COMPRESS', '1') != '0'
+COMPRESS_MIN_BYTES = 1024
+COMPRESS_MIMETYPES = ('text/html', 'application/json', 'text/plain', 'text/csv')
+GZIP_LEVEL = 6          # توازن بين الحجم وزمن المعالج لكل طلب
+BROTLI_QUALITY = 5      # الجودة 11 للملفات الثابتة فقط، بطيئة جداً للاستجابات الحية
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+def negotiate_encoding():
+    """أفضل ترميز يقبله المتصفح: br ثم gzip، أو None"""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br'] and accepted['br'] >= accepted['gzip']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+@app.after_request
+def compress_response(response):
+    """ضغط الاستجابة النصية إذا كانت كبيرة بما يكفي وقبل المتصفح الضغط"""
+    if (not COMPRESSION_ENABLED or response.direct_passthrough or response.is_streamed
+            or response.mimetype not in COMPRESS_MIMETYPES or 'Content-Encoding' in response.headers
+            or response.status_code < 200 or response.status_code in (204, 206, 304)
+            or response.cache_control.no_transform):
+        return response
+    response.vary.add('Accept-Encoding')
+    
+    data = response.get_data()
+    encoding = negotiate_encoding()
+    if len(data) < COMPRESS_MIN_BYTES or encoding is None:
+        return response
+    
+    if encoding == 'br':
+        compressed = brotli.compress(data, quality=BROTLI_QUALITY)
+    else:
+        compressed = gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+    response.set_data(compressed)
+    response.content_encoding = encoding
+    g._uncompressed_bytes = len(data)
+    return response
+
+# ===== التشغيل =====
+
+@app.route('/healthz')
+def healthz():
+    """فحص جاهزية خفيف: الخادم يستقبل الطلبات وقاعدة البيانات مهيأة
+
+    قراءة رقم نسخة المخطط باتصال القراءة، و503 إذا تعذرت القراءة أو لم تنته
+    الترحيلات بعد.
+    """
+    try:
+        version = schema_version(get_db(readonly=True))
+    except sqlite3.Error as e:
+        return jsonify({'status': 'unavailable', 'error': str(e)}), 503
+    if version < SCHEMA_VERSION:
+        return jsonify({'status': 'migrating', 'schema_version': version}), 503
+    return jsonify({'status': 'ok', 'schema_version': version})
+
+SERVE_THREADS = int(os.environ.get('MEDICAL_THREADS', '8'))
+
+def serve(host='0.0.0.0', port=5000, threads=SERVE_THREADS):
+    """تشغيل التطبيق على خادم WSGI للإنتاج
+
+    waitress إن كان مثبتاً، وإلا خادم Werkzeug متعدد الخيوط بدون وضع التطوير.
+    عملية واحدة بعدة خيوط: الكتابة كلها تمر بخيط الكتابة الواحد في هذه العملية.
+    """
+    try:
+        from waitress import serve as waitress_serve
+    except ImportError:
+        from werkzeug.serving import run_simple
+        app.logger.warning('waitress غير مثبت، التشغيل على خادم Werkzeug متعدد الخيوط')
+        run_simple(host, port, app, threaded=True)
+        return
+    waitress_serve(app, host=host, port=port, threads=threads, ident='medical-records')
+
 if __name__ == '__main__':
-    init_db()
+    import argparse
+
+    parser = argparse.ArgumentParser(description='نظام إدارة الملفات الطبية')
     # استخدم 0.0.0.0 ليكون متاح على الشبكة
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    parser.add_argument('--host', default=os.environ.get('MEDICAL_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('MEDICAL_PORT', '5000')))
+    parser.add_argument('--threads', type=int, default=SERVE_THREADS, help='عدد خيوط خادم WSGI')
+    parser.add_argument('--debug', action='store_true', help='خادم التطوير مع إعادة التحميل التلقائي')
+    args = parser.parse_args()
+
+    init_db()
+    install_bytecode_cache()
+    if DIGITS_INDEX_ENABLED:
+        start_digits_index_loader()
+    if BACKUP_KEEP:
+        start_backup_scheduler()
+    if args.debug:
+        app.run(host=args.host, port=args.port, debug=True)
+    else:
+        serve(args.host, args.port, args.threads)
@@ -0,0 +1,8 @@
+"""
+Benchmarks for the Medical Records app
+قياس أداء نظام الملفات الطبية
+
+    python -m benchmarks.run --scale 1k --out bench.json
+    python -m benchmarks.run --scale 100k --compare bench.json
+    python -m benchmarks.load --scale 10k --clients 16 --compare-writer
+"""
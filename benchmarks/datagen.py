@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Synthetic clinic dataset generator
+توليد بيانات عيادة تجريبية بأحجام مختلفة لقياس الأداء
+"""
+
+import random
+import time
+from datetime import datetime, timedelta
+
+import app
+
+SCALES = {
+    '1k': 1000,
+    '10k': 10000,
+    '100k': 100000,
+    '1m': 1000000,
+}
+
+BATCH_SIZE = 20000
+
+FIRST_NAMES = [
+    'محمد', 'أحمد', 'علي', 'عمر', 'خالد', 'يوسف', 'إبراهيم', 'حسن', 'حسين', 'عبدالله',
+    'سامي', 'طارق', 'ماجد', 'زياد', 'فيصل', 'مصطفى', 'إسماعيل', 'رامي', 'باسل', 'نادر',
+    'فاطمة', 'عائشة', 'مريم', 'زينب', 'خديجة', 'سارة', 'نور', 'ليلى', 'هدى', 'رنا',
+    'آمنة', 'إيمان', 'أسماء', 'سلمى', 'رقية', 'دعاء', 'هبة', 'منى', 'ريم', 'لمى',
+]
+FAMILY_NAMES = [
+    'الأحمد', 'العلي', 'الخطيب', 'النجار', 'الحداد', 'الشامي', 'المصري', 'العمري',
+    'الزعبي', 'القاسم', 'الحسيني', 'الرفاعي', 'السعدي', 'التميمي', 'الكردي', 'البدوي',
+    'العبدالله', 'الشريف', 'الجبوري', 'الدوري', 'اليوسف', 'الصالح', 'الحلبي', 'المحمد',
+]
+SPECIALIZATIONS = ['باطنية', 'أطفال', 'نسائية', 'عظام', 'جلدية', 'أسنان', 'عيون', 'قلب']
+BLOOD_TYPES = ['A+', 'A-', 'B+', 'B-', 'AB+', 'AB-', 'O+', 'O-']
+INSURANCE_COMPANIES = [None, None, 'التأمين الوطني', 'الشرق العربي', 'المتحدة للتأمين', 'الضمان']
+DIAGNOSES = ['التهاب الحلق', 'ارتفاع ضغط الدم', 'سكري النوع الثاني', 'نزلة برد', 'آلام الظهر',
+             'التهاب المعدة', 'حساسية موسمية', 'صداع نصفي', 'فقر الدم', 'التهاب الأذن']
+TREATMENTS = ['مضاد حيوي لمدة أسبوع', 'مسكن عند اللزوم', 'راحة وسوائل', 'متابعة بعد شهر',
+              'تعديل جرعة الدواء', 'علاج طبيعي']
+PAYMENT_METHODS = ['نقدي', 'نقدي', 'بطاقة', 'تأمين']
+APPOINTMENT_STATUSES = ['مجدول', 'مجدول', 'تم', 'ملغي']
+
+def _batched(rows, size=BATCH_SIZE):
+    """تقسيم مولد الصفوف إلى دفعات"""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _timestamp(moment):
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+def generate_dataset(database, patients, visits_per_patient=3, doctors=20, seed=42, progress=None):
+    """توليد بيانات تجريبية في قاعدة بيانات جديدة وإرجاع أعداد الصفوف"""
+    rng = random.Random(seed)
+    app.DATABASE = database
+    app.close_pools()
+    app.init_db()
+
+    now = datetime.now()
+    history_days = 3 * 365
+    counts = {'patients': patients, 'doctors': doctors, 'visits': 0, 'visit_doctors': 0,
+              'payments': 0, 'appointments': 0}
+    started = time.perf_counter()
+
+    conn = app._connect()
+    cursor = conn.cursor()
+    conn.execute('BEGIN IMMEDIATE')
+    deferred = app.suspend_derived_maintenance(
+        cursor, ('patients', 'visits', 'payments', 'visit_doctors', 'appointments', 'doctors'))
+
+    cursor.executemany('''
+        INSERT INTO doctors (id, name, specialization, phone)
+        VALUES (?, ?, ?, ?)
+    ''', [(doctor_id, f'د. {rng.choice(FIRST_NAMES[:20])} {rng.choice(FAMILY_NAMES)}',
+           rng.choice(SPECIALIZATIONS), f'07{rng.randrange(10**8):08d}')
+          for doctor_id in range(1, doctors + 1)])
+
+    def patient_rows():
+        for patient_id in range(1, patients + 1):
+            created = now - timedelta(days=history_days * (patients - patient_id) / patients,
+                                      seconds=rng.randrange(86400))
+            yield (patient_id, f'{rng.choice(FIRST_NAMES)} {rng.choice(FIRST_NAMES[:20])} {rng.choice(FAMILY_NAMES)}',
+                   rng.randint(1, 90), rng.choice(['ذكر', 'أنثى']), f'07{rng.randrange(10**8):08d}',
+                   f'{rng.randrange(10**9, 10**10)}', rng.choice(BLOOD_TYPES),
+                   rng.choice(INSURANCE_COMPANIES), _timestamp(created))
+
+    for batch in _batched(patient_rows()):
+        cursor.executemany('''
+            INSERT INTO patients (id, name, age, gender, phone, national_id, blood_type,
+                                  insurance_company, created_date)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', batch)
+        if progress:
+            progress('patients', batch[-1][0])
+
+    visit_id = 0
+    payment_id = 0
+
+    def visit_rows():
+        nonlocal visit_id
+        for patient_id in range(1, patients + 1):
+            for _ in range(rng.randint(0, 2 * visits_per_patient)):
+                visit_id += 1
+                total = float(rng.choice([20, 30, 50, 75, 100, 150, 250]))
+                paid = rng.choice([total, total, total / 2, 0.0])
+                visited = now - timedelta(days=rng.randrange(history_days), seconds=rng.randrange(86400))
+                yield (visit_id, patient_id, rng.randint(1, doctors), _timestamp(visited),
+                       rng.choice(DIAGNOSES), rng.choice(TREATMENTS), total, paid)
+
+    for batch in _batched(visit_rows()):
+        cursor.executemany('''
+            INSERT INTO visits (id, patient_id, doctor_id, visit_date, diagnosis, treatment,
+                                total_cost, paid_amount)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', batch)
+
+        # الطبيب الرئيسي لكل زيارة، وطبيب مشارك لبعض الزيارات
+        doctor_rows = [(row[0], row[2], 'طبيب رئيسي', 1) for row in batch]
+        doctor_rows.extend((row[0], row[2] % doctors + 1, 'طبيب مشارك', 0)
+                           for row in batch if rng.random() < 0.2)
+        cursor.executemany('''
+            INSERT INTO visit_doctors (visit_id, doctor_id, role, is_primary)
+            VALUES (?, ?, ?, ?)
+        ''', doctor_rows)
+
+        payment_rows = []
+        for row in batch:
+            if row[7] > 0:
+                payment_id += 1
+                payment_rows.append((payment_id, row[0], row[3], row[7], rng.choice(PAYMENT_METHODS)))
+        cursor.executemany('''
+            INSERT INTO payments (id, visit_id, payment_date, amount, payment_method)
+            VALUES (?, ?, ?, ?, ?)
+        ''', payment_rows)
+
+        counts['visit_doctors'] += len(doctor_rows)
+        counts['payments'] += len(payment_rows)
+        if progress:
+            progress('visits', batch[-1][0])
+    counts['visits'] = visit_id
+
+    def appointment_rows():
+        for appointment_id in range(1, patients // 2 + 1):
+            day = now.date() + timedelta(days=rng.randint(-60, 60))
+            yield (appointment_id, rng.randint(1, patients), day.isoformat(),
+                   f'{rng.randint(8, 17):02d}:{rng.choice(["00", "15", "30", "45"])}',
+                   rng.choice(DIAGNOSES), rng.choice(APPOINTMENT_STATUSES))
+
+    for batch in _batched(appointment_rows()):
+        cursor.executemany('''
+            INSERT INTO appointments (id, patient_id, appointment_date, appointment_time,
+                                      reason, status)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', batch)
+        counts['appointments'] += len(batch)
+
+    app.resume_derived_maintenance(cursor, deferred)
+    conn.execute('ANALYZE')
+    conn.commit()
+    conn.close()
+
+    counts['seconds'] = round(time.perf_counter() - started, 2)
+    return counts
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='توليد بيانات عيادة تجريبية')
+    parser.add_argument('database')
+    parser.add_argument('--scale', choices=SCALES, default='1k')
+    parser.add_argument('--visits-per-patient', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    print(generate_dataset(args.database, SCALES[args.scale], args.visits_per_patient, seed=args.seed))
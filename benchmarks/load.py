@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Mixed read/write load test against the production server
+قياس الإنتاجية تحت حمل مختلط من القراءة والكتابة على خادم الإنتاج
+
+الخادم يشغل كعملية منفصلة (python app.py) على نسخة من قاعدة بيانات القياس،
+وعدة عملاء متزامنين يرسلون طلبات قراءة وكتابة لمدة محددة.
+
+    python -m benchmarks.load --scale 10k --clients 16 --duration 20 --compare-writer
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from benchmarks.datagen import SCALES, generate_dataset
+from benchmarks.run import percentile
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app.py')
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_server(database, threads, write_queue=True):
+    """تشغيل app.py في مجلد مؤقت يحوي نسخة من قاعدة البيانات وانتظار جاهزيته"""
+    workdir = tempfile.mkdtemp(prefix='medical_load_')
+    shutil.copy(database, os.path.join(workdir, 'medical_records.db'))
+    port = _free_port()
+    env = dict(os.environ, MEDICAL_WRITE_QUEUE='1' if write_queue else '0', MEDICAL_BACKUP_KEEP='0')
+    process = subprocess.Popen([sys.executable, APP_PATH, '--host', '127.0.0.1', '--port', str(port),
+                                '--threads', str(threads)],
+                               cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(base_url + '/api/dashboard-stats', timeout=1).read()
+            return process, base_url, workdir
+        except (urllib.error.URLError, ConnectionError):
+            if process.poll() is not None:
+                raise RuntimeError('server exited during startup')
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('server did not become ready')
+
+def stop_server(process, workdir):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+def _request(base_url, method, path, payload=None):
+    data = json.dumps(payload).encode('utf-8') if payload is not None else None
+    req = urllib.request.Request(base_url + urllib.parse.quote(path, safe='/?=&'), data=data, method=method,
+                                 headers={'Content-Type': 'application/json'} if data else {})
+    try:
+        with urllib.request.urlopen(req, timeout=30) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except (urllib.error.URLError, ConnectionError, TimeoutError):
+        return 0
+
+def run_load(base_url, clients, duration, write_ratio, max_patient, max_visit, seed=11):
+    """تشغيل العملاء المتزامنين وإرجاع الإنتاجية والأزمنة"""
+    reads = [
+        lambda rng: '/patients?format=json',
+        lambda rng: f'/patient/{rng.randint(1, max_patient)}',
+        lambda rng: '/search?q=محمد',
+        lambda rng: '/api/dashboard-stats',
+        lambda rng: '/appointments?format=json',
+    ]
+    writes = [
+        lambda rng: ('/patient/new', {'name': 'مريض حمل', 'phone': f'07{rng.randrange(10**8):08d}'}),
+        lambda rng: (f'/visit/new/{rng.randint(1, max_patient)}',
+                     {'doctor_id': 1, 'diagnosis': 'فحص', 'total_cost': 50, 'paid_amount': 10}),
+        lambda rng: (f'/payment/add/{rng.randint(1, max_visit)}', {'amount': 5}),
+    ]
+    results = {'read': [], 'write': [], 'statuses': {}}
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def client(index):
+        rng = random.Random(seed + index)
+        local = {'read': [], 'write': [], 'statuses': {}}
+        while time.monotonic() < stop_at:
+            if rng.random() < write_ratio:
+                kind = 'write'
+                path, payload = rng.choice(writes)(rng)
+                started = time.perf_counter()
+                status = _request(base_url, 'POST', path, payload)
+            else:
+                kind = 'read'
+                started = time.perf_counter()
+                status = _request(base_url, 'GET', rng.choice(reads)(rng))
+            local[kind].append((time.perf_counter() - started) * 1000)
+            local['statuses'][status] = local['statuses'].get(status, 0) + 1
+        with lock:
+            results['read'].extend(local['read'])
+            results['write'].extend(local['write'])
+            for status, count in local['statuses'].items():
+                results['statuses'][status] = results['statuses'].get(status, 0) + count
+
+    threads = [threading.Thread(target=client, args=(index,)) for index in range(clients)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    summary = {
+        'clients': clients,
+        'duration_s': round(elapsed, 2),
+        'write_ratio': write_ratio,
+        'requests_per_s': round((len(results['read']) + len(results['write'])) / elapsed, 1),
+        'statuses': {str(code): count for code, count in sorted(results['statuses'].items())},
+        'errors': sum(count for code, count in results['statuses'].items() if code == 0 or code >= 500),
+    }
+    for kind in ('read', 'write'):
+        samples = results[kind]
+        summary[kind] = {
+            'requests': len(samples),
+            'per_s': round(len(samples) / elapsed, 1),
+            'p50_ms': round(percentile(samples, 0.50), 2) if samples else None,
+            'p95_ms': round(percentile(samples, 0.95), 2) if samples else None,
+            'p99_ms': round(percentile(samples, 0.99), 2) if samples else None,
+        }
+    return summary
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='قياس الإنتاجية تحت حمل مختلط')
+    parser.add_argument('--scale', choices=SCALES, default='10k')
+    parser.add_argument('--db', help='قاعدة بيانات القياس (تولد إذا لم تكن موجودة)')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--threads', type=int, default=8, help='خيوط خادم WSGI')
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--write-ratio', type=float, default=0.2)
+    parser.add_argument('--compare-writer', action='store_true',
+                        help='تشغيل القياس مرة بطابور الكتابة ومرة بدونه')
+    parser.add_argument('--out', help='حفظ النتيجة في ملف JSON')
+    args = parser.parse_args(argv)
+
+    database = args.db or os.path.join(tempfile.gettempdir(), f'medical_records_bench_{args.scale}.db')
+    if not os.path.exists(database):
+        print(f'generating {args.scale} dataset in {database} ...')
+        print(f'  {generate_dataset(database, SCALES[args.scale])}')
+
+    import sqlite3
+    conn = sqlite3.connect(database)
+    max_patient = conn.execute('SELECT MAX(id) FROM patients').fetchone()[0]
+    max_visit = conn.execute('SELECT MAX(id) FROM visits').fetchone()[0]
+    conn.close()
+
+    modes = [True, False] if args.compare_writer else [True]
+    report = {}
+    for write_queue in modes:
+        name = 'write_queue' if write_queue else 'direct_writes'
+        process, base_url, workdir = start_server(database, args.threads, write_queue)
+        try:
+            summary = run_load(base_url, args.clients, args.duration, args.write_ratio,
+                               max_patient, max_visit)
+        finally:
+            stop_server(process, workdir)
+        report[name] = summary
+        print(f'{name:14} {summary["requests_per_s"]:8.1f} req/s  '
+              f'read p95 {summary["read"]["p95_ms"]}ms  write p95 {summary["write"]["p95_ms"]}ms  '
+              f'errors {summary["errors"]}  statuses {summary["statuses"]}')
+
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f'saved {args.out}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
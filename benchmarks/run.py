@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-route benchmark suite
+قياس زمن الاستجابة وعدد الاستعلامات والذاكرة لكل مسار
+
+كل مسار يطلب عدة مرات عبر عميل الاختبار في Flask على بيانات تجريبية
+بالحجم المطلوب، والنتيجة تكتب بصيغة JSON لمقارنتها بين التعديلات.
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import app
+from benchmarks.datagen import SCALES, generate_dataset
+
+DEFAULT_REQUESTS = 50
+WARMUP_REQUESTS = 3
+REGRESSION_THRESHOLD = 0.10
+
+class QueryCounter:
+    """عداد استعلامات SQL عبر set_trace_callback على كل اتصال جديد"""
+
+    def __init__(self):
+        self.count = 0
+        self._last = None
+        self._lock = threading.Lock()
+
+    def trace(self, statement):
+        # عبارات المشغلات والاستعلامات الداخلية لـ FTS5 جزء من الاستعلام الأصلي:
+        # تظهر كتعليقات "-- ..." أو بأسماء مقتبسة 'main'.'...' أو بتكرار العبارة نفسها
+        if statement.startswith('--') or "'main'." in statement:
+            return
+        with self._lock:
+            if statement != self._last:
+                self.count += 1
+            self._last = statement
+
+    def reset(self):
+        with self._lock:
+            count, self.count, self._last = self.count, 0, None
+        return count
+
+def install_query_counter():
+    """تغليف app._connect بحيث تحسب كل اتصالات المجمع استعلاماتها"""
+    counter = QueryCounter()
+    connect = app._connect
+
+    def counted_connect(readonly=False):
+        conn = connect(readonly)
+        conn.set_trace_callback(counter.trace)
+        return conn
+
+    app.close_pools()
+    app._connect = counted_connect
+    return counter
+
+def percentile(samples, fraction):
+    """النسبة المئوية بالاستيفاء الخطي بين أقرب عينتين"""
+    ordered = sorted(samples)
+    if len(ordered) == 1:
+        return ordered[0]
+    position = (len(ordered) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+def peak_rss_kb():
+    """أعلى استهلاك للذاكرة منذ بدء العملية (بالكيلوبايت)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS يعيدها بالبايت
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(app.__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def load_fixture_ids(cursor):
+    """أرقام وأسماء حقيقية من البيانات لتوزيع الطلبات عليها"""
+    cursor.execute('SELECT MAX(id) FROM patients')
+    max_patient = cursor.fetchone()[0] or 0
+    cursor.execute('SELECT MAX(id) FROM visits')
+    max_visit = cursor.fetchone()[0] or 0
+    cursor.execute('SELECT name, phone, national_id FROM patients ORDER BY RANDOM() LIMIT 200')
+    samples = cursor.fetchall()
+    return {
+        'max_patient': max_patient,
+        'max_visit': max_visit,
+        'names': [row['name'] for row in samples],
+        'phones': [row['phone'] for row in samples if row['phone']],
+        'national_ids': [row['national_id'] for row in samples if row['national_id']],
+    }
+
+def build_routes(fixtures, rng):
+    """قائمة المسارات المقاسة: (الاسم، الطريقة، دالة تولد الرابط والبيانات)"""
+    today = datetime.now().date()
+
+    def patient_id():
+        return rng.randint(1, fixtures['max_patient'])
+
+    def visit_id():
+        return rng.randint(1, fixtures['max_visit'])
+
+    def name_prefix():
+        return rng.choice(fixtures['names']).split()[0]
+
+    def month_range():
+        start = today - timedelta(days=rng.randint(30, 900))
+        return start.isoformat(), (start + timedelta(days=30)).isoformat()
+
+    def typed_prefixes():
+        # كل طلب حرف إضافي من اسم، كما يرسل search.js أثناء الكتابة (من الحرف الثاني)
+        while True:
+            name = rng.choice(fixtures['names'])
+            for length in range(2, len(name) + 1):
+                yield name[:length]
+
+    def typed_digits():
+        # رقم هاتف يكتب رقماً رقماً في خانة البحث
+        while True:
+            phone = rng.choice(fixtures['phones'])
+            for length in range(2, len(phone) + 1):
+                yield phone[:length]
+
+    def misspelled_name():
+        # أول كلمتين من اسم مع حرف واحد مستبدل، كما يخطئ الإملاء الصوتي
+        letters = list(' '.join(rng.choice(fixtures['names']).split()[:2]))
+        position = rng.choice([i for i, letter in enumerate(letters) if letter != ' '])
+        letters[position] = 'ي' if letters[position] != 'ي' else 'و'
+        return ''.join(letters)
+
+    typing = typed_prefixes()
+    digit_typing = typed_digits()
+
+    routes = [
+        ('patients', 'GET', lambda: ('/patients', None)),
+        ('patients_json', 'GET', lambda: ('/patients?format=json', None)),
+        ('patient_details', 'GET', lambda: (f'/patient/{patient_id()}', None)),
+        ('patient_timeline', 'GET', lambda: (f'/api/patient/{patient_id()}/timeline', None)),
+        ('search_name', 'GET', lambda: (f'/search?q={name_prefix()}', None)),
+        ('search_typing', 'GET', lambda: (f'/search?q={next(typing)}', None)),
+        ('search_misspelled', 'GET', lambda: (f'/search?q={misspelled_name()}', None)),
+        ('search_fuzzy', 'GET', lambda: (f'/search?q={misspelled_name()}&mode=fuzzy', None)),
+        ('search_phone', 'GET', lambda: (f'/search?q={rng.choice(fixtures["phones"])[:6]}', None)),
+        ('search_phone_typing', 'GET', lambda: (f'/search?q={next(digit_typing)}', None)),
+        ('search_phone_suffix', 'GET', lambda: (f'/search?q={rng.choice(fixtures["phones"])[-4:]}', None)),
+        ('search_national_id', 'GET', lambda: (f'/search?q={rng.choice(fixtures["national_ids"])}', None)),
+        ('search_advanced', 'GET',
+         lambda: ('/search/advanced?start_date={}&end_date={}'.format(*month_range()), None)),
+        ('reports', 'GET', lambda: ('/reports', None)),
+        ('dashboard_stats', 'GET', lambda: ('/api/dashboard-stats', None)),
+        ('appointments', 'GET', lambda: ('/appointments', None)),
+        ('export_patient', 'GET', lambda: (f'/patient/{patient_id()}/export', None)),
+        ('export_visit', 'GET', lambda: (f'/visit/{visit_id()}/export', None)),
+        ('export_batch', 'GET',
+         lambda: ('/export/batch?patient_ids=' + ','.join(str(patient_id()) for _ in range(10)), None)),
+        ('new_patient', 'POST', lambda: ('/patient/new', {
+            'name': f'{name_prefix()} تجريبي', 'age': rng.randint(1, 90),
+            'phone': f'07{rng.randrange(10**8):08d}'})),
+        ('new_visit', 'POST', lambda: (f'/visit/new/{patient_id()}', {
+            'doctor_id': 1, 'diagnosis': 'فحص دوري', 'total_cost': 50, 'paid_amount': 20})),
+        ('add_payment', 'POST', lambda: (f'/payment/add/{visit_id()}', {'amount': 5})),
+    ]
+    return routes
+
+def measure_route(client, counter, method, make_request, requests, headers=None):
+    """تنفيذ المسار عدة مرات وإرجاع إحصاءات الزمن والاستعلامات والذاكرة"""
+    for _ in range(WARMUP_REQUESTS):
+        url, payload = make_request()
+        client.open(url, method=method, json=payload, headers=headers).close()
+
+    rss_before = peak_rss_kb()
+    timings = []
+    queries = []
+    statuses = {}
+    response_bytes = 0
+    for _ in range(requests):
+        url, payload = make_request()
+        counter.reset()
+        started = time.perf_counter()
+        response = client.open(url, method=method, json=payload, headers=headers)
+        # الاستجابات المتدفقة (ZIP) تحسب حتى آخر بايت
+        body = response.get_data()
+        timings.append((time.perf_counter() - started) * 1000)
+        response.close()
+        queries.append(counter.reset())
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        response_bytes += len(body)
+
+    return {
+        'requests': requests,
+        'p50_ms': round(percentile(timings, 0.50), 3),
+        'p95_ms': round(percentile(timings, 0.95), 3),
+        'p99_ms': round(percentile(timings, 0.99), 3),
+        'mean_ms': round(statistics.fmean(timings), 3),
+        'max_ms': round(max(timings), 3),
+        'queries_per_request': round(statistics.fmean(queries), 2),
+        'max_queries': max(queries),
+        'avg_response_bytes': response_bytes // requests,
+        'peak_rss_kb': peak_rss_kb(),
+        'rss_growth_kb': peak_rss_kb() - rss_before,
+        'statuses': {str(code): count for code, count in sorted(statuses.items())},
+    }
+
+def run_benchmarks(database, scale, requests=DEFAULT_REQUESTS, only=None, seed=7, log=print,
+                   accept_encoding=None):
+    """تشغيل مجموعة القياس كاملة وإرجاع النتيجة كقاموس"""
+    rng = random.Random(seed)
+    app.DATABASE = database
+    dataset = None
+    if not os.path.exists(database):
+        log(f'generating {scale} dataset in {database} ...')
+        dataset = generate_dataset(database, SCALES[scale])
+        log(f'  {dataset}')
+    else:
+        app.init_db()
+
+    counter = install_query_counter()
+    app.app.config['TESTING'] = True
+    client = app.app.test_client()
+
+    conn = app._connect(readonly=True)
+    fixtures = load_fixture_ids(conn.cursor())
+    conn.close()
+
+    results = {}
+    for name, method, make_request in build_routes(fixtures, rng):
+        if only and name not in only:
+            continue
+        results[name] = measure_route(client, counter, method, make_request, requests,
+                                      {'Accept-Encoding': accept_encoding} if accept_encoding else None)
+        row = results[name]
+        log(f'{name:20} p50 {row["p50_ms"]:9.2f}ms  p95 {row["p95_ms"]:9.2f}ms  '
+            f'p99 {row["p99_ms"]:9.2f}ms  q/req {row["queries_per_request"]:6.1f}  '
+            f'{row["avg_response_bytes"]:>8}B  rss {row["peak_rss_kb"] // 1024}MB')
+
+    app.close_pools()
+    return {
+        'scale': scale,
+        'database': os.path.abspath(database),
+        'commit': git_commit(),
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'requests_per_route': requests,
+        'accept_encoding': accept_encoding,
+        'dataset': dataset,
+        'peak_rss_kb': peak_rss_kb(),
+        'routes': results,
+    }
+
+def compare_results(previous, current, threshold=REGRESSION_THRESHOLD, log=print):
+    """مقارنة نتيجتين وإرجاع قائمة المسارات التي تراجع أداؤها"""
+    regressions = []
+    log(f'{"route":20} {"p95 before":>12} {"p95 after":>12} {"change":>8} {"queries":>12}')
+    for name, after in current['routes'].items():
+        before = previous.get('routes', {}).get(name)
+        if not before:
+            continue
+        change = (after['p95_ms'] - before['p95_ms']) / before['p95_ms'] if before['p95_ms'] else 0.0
+        queries = f'{before["queries_per_request"]:g}->{after["queries_per_request"]:g}'
+        marker = ''
+        if change > threshold or after['queries_per_request'] > before['queries_per_request']:
+            regressions.append(name)
+            marker = '  !'
+        log(f'{name:20} {before["p95_ms"]:11.2f}ms {after["p95_ms"]:11.2f}ms {change:+8.1%} {queries:>12}{marker}')
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='قياس أداء مسارات التطبيق')
+    parser.add_argument('--scale', choices=SCALES, default='1k')
+    parser.add_argument('--db', help='قاعدة بيانات القياس (تولد إذا لم تكن موجودة)')
+    parser.add_argument('--requests', type=int, default=DEFAULT_REQUESTS, help='عدد الطلبات لكل مسار')
+    parser.add_argument('--route', action='append', help='قياس مسار محدد فقط (يمكن تكراره)')
+    parser.add_argument('--accept-encoding', help='ترويسة Accept-Encoding للطلبات (مثلاً "gzip, br")، '
+                        'فيقيس avg_response_bytes الحجم المرسل فعلاً')
+    parser.add_argument('--out', help='حفظ النتيجة في ملف JSON')
+    parser.add_argument('--compare', help='مقارنة النتيجة بملف JSON سابق')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help='نسبة التراجع المسموحة في p95 قبل اعتباره تراجعاً')
+    args = parser.parse_args(argv)
+
+    database = args.db or os.path.join(tempfile.gettempdir(), f'medical_records_bench_{args.scale}.db')
+    result = run_benchmarks(database, args.scale, args.requests, args.route,
+                            accept_encoding=args.accept_encoding)
+
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f'saved {args.out}')
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            previous = json.load(f)
+        regressions = compare_results(previous, result, args.threshold)
+        if regressions:
+            print(f'regressions: {", ".join(regressions)}')
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
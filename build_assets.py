@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Static asset build step
+بناء الملفات الثابتة: دمج وتصغير CSS و JS، وأسماء فيها بصمة المحتوى،
+ونسخ gz و br مضغوطة مسبقاً، وأيقونات التطبيق، وقائمة تخزين عامل الخدمة
+
+    python build_assets.py
+
+الناتج في static/dist مع assets.json الذي يقرؤه app.py عند التشغيل (أعد تشغيل
+الخادم بعد البناء). نسخ br تحتاج مكتبة brotli، والأيقونات تحتاج Pillow؛ بدونهما
+تتخطى هذه الخطوة وتستخدم الأيقونات الموجودة.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+
+import app
+
+STATIC_DIR = app.app.static_folder
+DIST_DIR = app.DIST_DIR
+HASH_LENGTH = 10
+COMPRESS_MIN_BYTES = 512
+COMPRESSED_TYPES = ('.css', '.js', '.json', '.svg')
+ICON_SIZES = (192, 512)
+
+_CSS_STRINGS = re.compile(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'')
+
+def minify_css(text):
+    """حذف التعليقات والمسافات الزائدة (النصوص بين علامات التنصيص لا تمس)"""
+    strings = []
+
+    def keep(match):
+        strings.append(match.group(0))
+        return f'\0{len(strings) - 1}\0'
+
+    text = _CSS_STRINGS.sub(keep, text)
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.S)
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'\s*([{};,>])\s*', r'\1', text)
+    text = re.sub(r':\s+', ':', text)
+    text = text.replace(';}', '}')
+    return re.sub(r'\0(\d+)\0', lambda match: strings[int(match.group(1))], text).strip()
+
+def minify_js(text):
+    """تصغير محافظ: حذف أسطر التعليقات والأسطر الفارغة والمسافات في أول السطر
+
+    لا يعيد كتابة الكود؛ أسطر القوالب النصية (`...`) تبقى كما هي، والضغط
+    بـ gzip/br يتكفل بالباقي.
+    """
+    lines = []
+    in_template = False
+    for line in text.splitlines():
+        if not in_template:
+            stripped = line.strip()
+            if not stripped or stripped.startswith('//'):
+                continue
+            line = stripped
+        lines.append(line.rstrip())
+        if line.count('`') % 2:
+            in_template = not in_template
+    return '\n'.join(lines) + '\n'
+
+MINIFIERS = {'.css': minify_css, '.js': minify_js}
+
+def fingerprint(name, data):
+    """css/app.css -> css/app.<بصمة>.css"""
+    root, ext = os.path.splitext(name)
+    return f'{root}.{hashlib.sha256(data).hexdigest()[:HASH_LENGTH]}{ext}'
+
+def compress(path, data):
+    """كتابة نسخ gz (ثابتة بلا تاريخ) و br إن توفرت brotli"""
+    if len(data) < COMPRESS_MIN_BYTES or not path.endswith(COMPRESSED_TYPES):
+        return
+    with open(path + '.gz', 'wb') as f:
+        f.write(gzip.compress(data, compresslevel=9, mtime=0))
+    try:
+        import brotli
+    except ImportError:
+        return
+    with open(path + '.br', 'wb') as f:
+        f.write(brotli.compress(data, quality=11))
+
+def read_source(name):
+    with open(os.path.join(STATIC_DIR, name), 'rb') as f:
+        return f.read()
+
+def build_icons():
+    """أيقونات التطبيق بكل الأحجام، أو None إذا لم تكن Pillow مثبتة"""
+    try:
+        from create_icons import create_icon
+    except ImportError:
+        return None
+    icons = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in ICON_SIZES:
+            path = os.path.join(workdir, f'icon-{size}.png')
+            create_icon(size, path)
+            with open(path, 'rb') as f:
+                icons[f'icon-{size}.png'] = f.read()
+    return icons
+
+class AssetBuilder:
+    """يجمع الملفات المبنية ثم يكتبها مع assets.json"""
+
+    def __init__(self, dist_dir=DIST_DIR):
+        self.dist_dir = dist_dir
+        self.files = {}         # الاسم الأصلي -> المسار داخل static
+        self.immutable = []     # المسارات داخل dist ذات البصمة
+        self.sizes = {}
+
+    def emit(self, name, data, hashed=True):
+        built = fingerprint(name, data) if hashed else name
+        path = os.path.join(self.dist_dir, built)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        compress(path, data)
+        self.files[name] = f'dist/{built}'
+        if hashed:
+            self.immutable.append(built)
+        self.sizes[name] = len(data)
+        return f'/static/dist/{built}'
+
+    def build(self):
+        shutil.rmtree(self.dist_dir, ignore_errors=True)
+        os.makedirs(self.dist_dir)
+
+        # الملفات المدمجة، ثم كل ملفات CSS و JS الأخرى منفردة
+        bundled = set()
+        for name, sources in app.ASSET_BUNDLES.items():
+            ext = os.path.splitext(name)[1]
+            data = '\n'.join(read_source(source).decode('utf-8') for source in sources)
+            self.emit(name, MINIFIERS[ext](data).encode('utf-8'))
+            bundled.update(sources)
+        for folder in ('css', 'js'):
+            for filename in sorted(os.listdir(os.path.join(STATIC_DIR, folder))):
+                name = f'{folder}/{filename}'
+                ext = os.path.splitext(name)[1]
+                if name in bundled or ext not in MINIFIERS:
+                    continue
+                self.emit(name, MINIFIERS[ext](read_source(name).decode('utf-8')).encode('utf-8'))
+
+        # الأيقونات: تولد بـ Pillow، أو تنسخ الموجودة
+        icons = build_icons() or {
+            f'icon-{size}.png': read_source(f'icon-{size}.png') for size in ICON_SIZES}
+        for name, data in icons.items():
+            self.emit(name, data)
+
+        # بيان التطبيق بروابط الأيقونات المبنية
+        manifest = json.loads(read_source('manifest.json'))
+        for icon in manifest.get('icons', []):
+            name = icon['src'].removeprefix('/static/')
+            if name in self.files:
+                icon['src'] = f'/static/{self.files[name]}'
+        self.emit('manifest.json', json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8'))
+
+        # عامل الخدمة: اسم ذاكرة التخزين من بصمة كل الملفات، وقائمتها من الجدول نفسه
+        precache = sorted(f'/static/{path}' for name, path in self.files.items())
+        version = hashlib.sha256('\n'.join(precache).encode('utf-8')).hexdigest()[:HASH_LENGTH]
+        worker = read_source('sw.js').decode('utf-8')
+        worker = re.sub(r"const CACHE_NAME = .*?;", f"const CACHE_NAME = 'medical-records-{version}';",
+                        worker, count=1)
+        worker = re.sub(r"const PRECACHE_URLS = \[.*?\];",
+                        'const PRECACHE_URLS = ' + json.dumps(precache, indent=2) + ';',
+                        worker, count=1, flags=re.S)
+        self.emit('sw.js', minify_js(worker).encode('utf-8'), hashed=False)
+
+        with open(os.path.join(self.dist_dir, 'assets.json'), 'w', encoding='utf-8') as f:
+            json.dump({'version': version, 'files': self.files, 'immutable': sorted(self.immutable),
+                       'precache': precache}, f, ensure_ascii=False, indent=2)
+        return version
+
+def main():
+    builder = AssetBuilder()
+    version = builder.build()
+    original = sum(os.path.getsize(os.path.join(STATIC_DIR, name))
+                   for sources in app.ASSET_BUNDLES.values() for name in sources)
+    for name, path in sorted(builder.files.items()):
+        full = os.path.join(STATIC_DIR, path)
+        sizes = [f'{builder.sizes[name]:>7}']
+        for suffix in ('.gz', '.br'):
+            if os.path.exists(full + suffix):
+                sizes.append(f'{suffix[1:]} {os.path.getsize(full + suffix):>6}')
+        print(f'{path:45} {"  ".join(sizes)}')
+    print(f'CSS المدمج: {original} -> {builder.sizes["css/app.css"]} بايت')
+    print(f'تم البناء ({version}): {len(builder.files)} ملف في {DIST_DIR}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -33,9 +33,10 @@ def create_icon(size, filename):
     img.save(filename, 'PNG')
     print(f'Created: {filename}')
 
-# Create icons
-static_dir = '/home/claude/medical_records_app/static'
-create_icon(192, os.path.join(static_dir, 'icon-192.png'))
-create_icon(512, os.path.join(static_dir, 'icon-512.png'))
+if __name__ == '__main__':
+    # Create icons (build_assets.py also generates them into static/dist)
+    static_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    create_icon(192, os.path.join(static_dir, 'icon-192.png'))
+    create_icon(512, os.path.join(static_dir, 'icon-512.png'))
 
-print('Icons created successfully!')
+    print('Icons created successfully!')
@@ -7,35 +7,46 @@ Database Migration Script
 
 import sqlite3
 import os
+import time
 
-DATABASE = 'medical_records.db'
+import app
 
 def migrate_database():
-    """تحديث قاعدة البيانات للنسخة الجديدة"""
+    """تحديث قاعدة البيانات للنسخة الجديدة في مكانها دون فقدان البيانات"""
     print("🔄 بدء تحديث قاعدة البيانات...")
-    
-    # حذف قاعدة البيانات القديمة إذا كانت موجودة
-    if os.path.exists(DATABASE):
-        backup_name = f'medical_records_backup_{os.path.getmtime(DATABASE)}.db'
+
+    if os.path.exists(app.DATABASE):
+        # دوال SQL التي تستدعيها مشغلات جدول المرضى
+        conn = app.register_functions(sqlite3.connect(app.DATABASE))
+        current = app.schema_version(conn)
+
+        if current >= app.SCHEMA_VERSION:
+            conn.close()
+            print(f"✅ قاعدة البيانات محدثة بالفعل (النسخة {current})")
+            return True
+
+        backup_name = f'medical_records_backup_{time.strftime("%Y%m%d_%H%M%S")}.db'
         print(f"📦 إنشاء نسخة احتياطية: {backup_name}")
-        
+
         try:
-            # نسخ قاعدة البيانات القديمة
-            import shutil
-            shutil.copy2(DATABASE, backup_name)
+            # نسخة متسقة حتى لو كان التطبيق يعمل
+            backup = sqlite3.connect(backup_name)
+            conn.backup(backup)
+            backup.close()
             print("✅ تم إنشاء النسخة الاحتياطية بنجاح!")
         except Exception as e:
             print(f"⚠️  تحذير: لم يتم إنشاء نسخة احتياطية: {e}")
-        
-        # حذف قاعدة البيانات القديمة
-        try:
-            os.remove(DATABASE)
-            print("🗑️  تم حذف قاعدة البيانات القديمة")
-        except Exception as e:
-            print(f"❌ خطأ في حذف قاعدة البيانات القديمة: {e}")
-            return False
-    
-    print("✨ سيتم إنشاء قاعدة بيانات جديدة عند تشغيل التطبيق")
+        finally:
+            conn.close()
+
+        print(f"🔧 الترحيل من النسخة {current} إلى النسخة {app.SCHEMA_VERSION}")
+
+    try:
+        app.init_db()
+    except Exception as e:
+        print(f"❌ خطأ في ترحيل قاعدة البيانات: {e}")
+        return False
+
     print("✅ اكتمل التحديث!")
     return True
 
@@ -44,7 +55,7 @@ if __name__ == '__main__':
     print("🔧 أداة تحديث قاعدة البيانات")
     print("=" * 50)
     print()
-    
+
     if migrate_database():
         print()
         print("✅ النظام جاهز للعمل!")
@@ -24,6 +24,9 @@ if ! python -c "import flask" &> /dev/null; then
 fi
 
 echo "✅ جميع المكتبات مثبتة"
+
+# بناء الملفات الثابتة (تصغير وضغط وأسماء ببصمة المحتوى)
+python build_assets.py > /dev/null && echo "✅ تم بناء الملفات الثابتة"
 echo ""
 
 # Get IP address
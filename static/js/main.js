@@ -61,7 +61,84 @@ style.textContent = `
 `;
 document.head.appendChild(style);
 
+// Success message, or a notice when the service worker queued the write while offline
+function savedMessage(result, message) {
+    return result.queued ? '⏳ لا يوجد اتصال بالخادم: تم حفظ الطلب وسيرسل تلقائياً عند عودة الاتصال' : message;
+}
+
+// Pending offline writes badge (updates come from the service worker)
+function initOutbox() {
+    if (!('serviceWorker' in navigator)) {
+        return;
+    }
+
+    const badge = document.createElement('div');
+    badge.className = 'outbox-status';
+    badge.hidden = true;
+    document.body.appendChild(badge);
+
+    navigator.serviceWorker.addEventListener('message', event => {
+        if (!event.data || event.data.type !== 'outbox') {
+            return;
+        }
+        badge.hidden = event.data.pending === 0;
+        badge.textContent = `⏳ ${event.data.pending} عملية بانتظار الإرسال`;
+        if (event.data.failed) {
+            showToast(`❌ رفض الخادم ${event.data.failed} عملية محفوظة`, 'error');
+        }
+    });
+
+    const flush = () => navigator.serviceWorker.ready
+        .then(registration => registration.active.postMessage({ type: 'flush-outbox' }));
+    window.addEventListener('online', flush);
+    flush();
+}
+
+// Infinite scroll for paginated lists (buttons with data-next-url)
+function initLoadMore(button) {
+    const target = document.getElementById(button.dataset.target);
+    let loading = false;
+
+    async function loadNextPage() {
+        if (loading || !button.dataset.nextUrl) {
+            return;
+        }
+        loading = true;
+        button.disabled = true;
+
+        try {
+            const response = await fetch(button.dataset.nextUrl);
+            const page = await response.json();
+
+            target.insertAdjacentHTML('beforeend', page.html);
+
+            if (page.next_url) {
+                button.dataset.nextUrl = page.next_url;
+                button.disabled = false;
+            } else {
+                button.parentElement.remove();
+                observer.disconnect();
+            }
+        } catch (error) {
+            console.error('Load more error:', error);
+            button.disabled = false;
+        }
+        loading = false;
+    }
+
+    const observer = new IntersectionObserver(entries => {
+        if (entries.some(entry => entry.isIntersecting)) {
+            loadNextPage();
+        }
+    }, { rootMargin: '400px' });
+
+    button.addEventListener('click', loadNextPage);
+    observer.observe(button);
+}
+
 // Initialize app
 document.addEventListener('DOMContentLoaded', function() {
+    document.querySelectorAll('[data-next-url]').forEach(initLoadMore);
+    initOutbox();
     console.log('Medical Records App initialized');
 });
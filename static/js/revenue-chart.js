@@ -0,0 +1,129 @@
+// Revenue Chart Module
+
+const RevenueChart = {
+    form: null,
+    chart: null,
+    summary: null,
+    doctorsTable: null,
+
+    init() {
+        this.form = document.getElementById('revenueFilters');
+        this.chart = document.getElementById('revenueChart');
+        this.summary = document.getElementById('revenueSummary');
+        this.doctorsTable = document.getElementById('revenueDoctors');
+
+        if (!this.form || !this.chart) {
+            return;
+        }
+
+        this.form.addEventListener('submit', (e) => {
+            e.preventDefault();
+            this.load();
+        });
+        this.form.querySelectorAll('select').forEach(select => {
+            select.addEventListener('change', () => this.load());
+        });
+
+        this.load();
+    },
+
+    async load() {
+        const params = new URLSearchParams();
+        new FormData(this.form).forEach((value, key) => {
+            if (value !== '') {
+                params.append(key, value);
+            }
+        });
+
+        try {
+            const response = await fetch(`/api/revenue?${params}`);
+            const data = await response.json();
+
+            if (!response.ok) {
+                this.chart.innerHTML = `<p class="error">${data.error}</p>`;
+                return;
+            }
+
+            this.render(data);
+            this.renderDoctors(data.doctors);
+        } catch (error) {
+            console.error('Revenue chart error:', error);
+            this.chart.innerHTML = '<p class="error">حدث خطأ في تحميل الإيرادات</p>';
+        }
+    },
+
+    render(data) {
+        const series = data.series;
+        this.summary.innerHTML = `
+            <span>📋 ${data.totals.visits} زيارة</span>
+            <span>💰 ${data.totals.revenue.toFixed(2)} إيرادات</span>
+            <span>✅ ${data.totals.collected.toFixed(2)} محصل</span>
+        `;
+
+        if (data.totals.visits === 0) {
+            this.chart.innerHTML = '<p class="no-data">لا توجد زيارات في هذه الفترة</p>';
+            return;
+        }
+
+        // أعمدة الإيرادات، وفوقها أعمدة المحصل بلون مختلف
+        const width = 800;
+        const height = 260;
+        const padding = 30;
+        const max = Math.max(...series.map(point => point.revenue), 1);
+        const slot = (width - padding) / series.length;
+        const barWidth = Math.max(slot * 0.8, 1);
+        const scale = (value) => (value / max) * (height - padding);
+
+        const bars = series.map((point, index) => {
+            const x = padding + index * slot;
+            const label = `${point.period}: ${point.revenue.toFixed(2)} / ${point.collected.toFixed(2)} (${point.visits})`;
+            return `
+                <g>
+                    <title>${label}</title>
+                    <rect x="${x}" y="${height - padding - scale(point.revenue)}" width="${barWidth}"
+                          height="${scale(point.revenue)}" fill="#c3cdf5"></rect>
+                    <rect x="${x}" y="${height - padding - scale(point.collected)}" width="${barWidth}"
+                          height="${scale(point.collected)}" fill="#667eea"></rect>
+                </g>`;
+        }).join('');
+
+        // تسمية أول وآخر فترة ووسطها فقط حتى لا تتزاحم
+        const labels = [0, Math.floor(series.length / 2), series.length - 1]
+            .filter((index, position, all) => all.indexOf(index) === position)
+            .map(index => `
+                <text x="${padding + index * slot + barWidth / 2}" y="${height - 8}"
+                      font-size="12" text-anchor="middle" fill="#666">${series[index].period}</text>`)
+            .join('');
+
+        this.chart.innerHTML = `
+            <svg viewBox="0 0 ${width} ${height}" preserveAspectRatio="none" role="img"
+                 style="width: 100%; height: ${height}px; direction: ltr;">
+                <line x1="${padding}" y1="${height - padding}" x2="${width}" y2="${height - padding}" stroke="#ccc"></line>
+                <text x="0" y="12" font-size="12" fill="#666">${max.toFixed(0)}</text>
+                ${bars}
+                ${labels}
+            </svg>`;
+    },
+
+    renderDoctors(doctors) {
+        if (!this.doctorsTable) {
+            return;
+        }
+
+        this.doctorsTable.innerHTML = doctors.map(doctor => `
+            <tr>
+                <td>${doctor.doctor_id ? (doctor.name || '-') : 'بدون طبيب رئيسي'}</td>
+                <td>${doctor.visits}</td>
+                <td>${doctor.revenue.toFixed(2)}</td>
+                <td>${doctor.collected.toFixed(2)}</td>
+            </tr>
+        `).join('') || '<tr><td colspan="4" class="no-data">لا توجد بيانات</td></tr>';
+    }
+};
+
+// Initialize when DOM is ready
+if (document.readyState === 'loading') {
+    document.addEventListener('DOMContentLoaded', () => RevenueChart.init());
+} else {
+    RevenueChart.init();
+}
@@ -4,6 +4,11 @@ const Search = {
     searchInput: null,
     searchResults: null,
     debounceTimer: null,
+    controller: null,
+    // آخر نتائج البحث: الرجوع بـ Backspace أو تكرار البحث لا يرسل طلباً جديداً
+    cache: new Map(),
+    cacheSize: 30,
+    cacheMaxAge: 60000,
 
     init() {
         this.searchInput = document.getElementById('searchInput');
@@ -16,6 +21,7 @@ const Search = {
         // Add event listener with debounce
         this.searchInput.addEventListener('input', (e) => {
             clearTimeout(this.debounceTimer);
+            this.cancel();
             this.debounceTimer = setTimeout(() => {
                 this.performSearch(e.target.value);
             }, 300);
@@ -32,20 +38,69 @@ const Search = {
         }
     },
 
+    // إلغاء الطلب السابق حتى لا يصل رده بعد رد بحث أحدث
+    cancel() {
+        if (this.controller) {
+            this.controller.abort();
+            this.controller = null;
+        }
+    },
+
+    cached(query) {
+        const entry = this.cache.get(query);
+        if (!entry || Date.now() - entry.time > this.cacheMaxAge) {
+            this.cache.delete(query);
+            return null;
+        }
+        // الأحدث استخداماً في آخر الترتيب
+        this.cache.delete(query);
+        this.cache.set(query, entry);
+        return entry.results;
+    },
+
+    remember(query, results) {
+        this.cache.set(query, { results, time: Date.now() });
+        if (this.cache.size > this.cacheSize) {
+            this.cache.delete(this.cache.keys().next().value);
+        }
+    },
+
     async performSearch(query) {
+        this.cancel();
+        query = query.trim();
         if (!query || query.length < 2) {
             this.searchResults.innerHTML = '';
             return;
         }
 
+        const cached = this.cached(query);
+        if (cached) {
+            this.displayResults(cached);
+            return;
+        }
+
+        const controller = new AbortController();
+        this.controller = controller;
         try {
-            const response = await fetch(`/search?q=${encodeURIComponent(query)}`);
+            const response = await fetch(`/search?q=${encodeURIComponent(query)}`, {
+                signal: controller.signal
+            });
             const results = await response.json();
             
+            if (response.ok) {
+                this.remember(query, results);
+            }
             this.displayResults(results);
         } catch (error) {
+            if (error.name === 'AbortError') {
+                return;
+            }
             console.error('Search error:', error);
             this.searchResults.innerHTML = '<p class="error">حدث خطأ في البحث</p>';
+        } finally {
+            if (this.controller === controller) {
+                this.controller = null;
+            }
         }
     },
 
@@ -55,6 +110,11 @@ const Search = {
             return;
         }
 
+        // نتائج البحث التقريبي (فيها similarity): الاسم المكتوب أو المملى لم يطابق حرفياً
+        const hint = results[0].similarity !== undefined
+            ? '<p class="search-hint">لا يوجد اسم مطابق، هذه أقرب الأسماء:</p>'
+            : '';
+
         const html = results.map(patient => `
             <div class="search-result-item" onclick="window.location.href='/patient/${patient.id}'">
                 <div style="display: flex; justify-content: space-between; align-items: center;">
@@ -80,7 +140,7 @@ const Search = {
             </div>
         `).join('');
 
-        this.searchResults.innerHTML = html;
+        this.searchResults.innerHTML = hint + html;
     }
 };
 
@@ -1,27 +1,248 @@
-// Service Worker للعمل كتطبيق مستقل
-const CACHE_NAME = 'medical-records-v1';
-const urlsToCache = [
-  '/',
+// Service Worker للعمل كتطبيق مستقل وبدون اتصال
+// build_assets.py يستبدل CACHE_NAME و PRECACHE_URLS بالملفات المبنية وبصمتها،
+// فكل بناء جديد ينشئ ذاكرة تخزين جديدة ويحذف القديمة عند التفعيل
+const CACHE_NAME = 'medical-records-dev';
+const PRECACHE_URLS = [
   '/static/css/style.css',
   '/static/css/enhanced-style.css',
   '/static/css/mobile.css',
+  '/static/js/main.js',
   '/static/js/voice.js'
 ];
 
+// الصفحات والبيانات المحفوظة تتبع نسخة الملفات الثابتة التي تشير إليها
+const PAGES_CACHE = CACHE_NAME + '-pages';
+const PAGE_PATTERNS = [
+  /^\/$/,
+  /^\/patients$/,
+  /^\/patient\/\d+$/,
+  /^\/api\/dashboard-stats$/
+];
+
+// طلبات الكتابة التي تحفظ في الطابور إذا انقطعت الشبكة ثم ترسل لاحقاً
+const QUEUED_WRITES = [
+  /^\/visit\/new\/\d+$/,
+  /^\/payment\/add\/\d+$/,
+  /^\/payments\/batch$/,
+  /^\/patient\/new$/,
+  /^\/appointment\/(new|update)\/\d+$/
+];
+
+const OUTBOX_DB = 'medical-records-outbox';
+const OUTBOX_STORE = 'requests';
+const MAX_ATTEMPTS = 5;
+
+// ===== طابور الكتابة (IndexedDB) =====
+
+function openOutbox() {
+  return new Promise((resolve, reject) => {
+    const request = indexedDB.open(OUTBOX_DB, 1);
+    request.onupgradeneeded = () => {
+      request.result.createObjectStore(OUTBOX_STORE, { keyPath: 'id', autoIncrement: true });
+    };
+    request.onsuccess = () => resolve(request.result);
+    request.onerror = () => reject(request.error);
+  });
+}
+
+// تنفيذ عملية على مخزن الطابور وإرجاع نتيجتها بعد اكتمال المعاملة
+async function outbox(mode, operation) {
+  const db = await openOutbox();
+  return new Promise((resolve, reject) => {
+    const transaction = db.transaction(OUTBOX_STORE, mode);
+    const request = operation(transaction.objectStore(OUTBOX_STORE));
+    transaction.oncomplete = () => {
+      db.close();
+      resolve(request.result);
+    };
+    transaction.onerror = () => {
+      db.close();
+      reject(transaction.error);
+    };
+  });
+}
+
+const outboxAdd = entry => outbox('readwrite', store => store.add(entry));
+const outboxAll = () => outbox('readonly', store => store.getAll());
+const outboxPut = entry => outbox('readwrite', store => store.put(entry));
+const outboxDelete = id => outbox('readwrite', store => store.delete(id));
+
+// إبلاغ الصفحات المفتوحة بعدد الطلبات المنتظرة
+async function notifyClients(message) {
+  const clients = await self.clients.matchAll({ type: 'window' });
+  clients.forEach(client => client.postMessage(message));
+}
+
+async function notifyPending(failed = 0) {
+  const pending = await outboxAll();
+  await notifyClients({ type: 'outbox', pending: pending.length, failed });
+}
+
+// الطلب المحفوظ يعاد كما هو بمفتاح منع التكرار نفسه، فالخادم لا ينفذه مرتين
+// حتى لو وصل الطلب الأول وانقطع الاتصال قبل وصول الرد
+function sendEntry(entry) {
+  return fetch(entry.url, {
+    method: 'POST',
+    headers: entry.headers,
+    body: entry.body,
+    credentials: 'same-origin'
+  });
+}
+
+// إرسال الطلبات المنتظرة بالترتيب، والتوقف عند أول انقطاع
+let flushing = null;
+
+function flushOutbox() {
+  if (!flushing) {
+    flushing = (async () => {
+      const entries = await outboxAll();
+      let sent = 0;
+      let failed = 0;
+      for (const entry of entries) {
+        let response;
+        try {
+          response = await sendEntry(entry);
+        } catch (error) {
+          break;
+        }
+        // أخطاء الخادم المؤقتة تعاد لاحقاً، وأي رد آخر نهائي
+        if ((response.status >= 500 || response.status === 429) && entry.attempts + 1 < MAX_ATTEMPTS) {
+          entry.attempts += 1;
+          await outboxPut(entry);
+          break;
+        }
+        await outboxDelete(entry.id);
+        sent += 1;
+        if (!response.ok) {
+          failed += 1;
+        }
+      }
+      if (sent) {
+        await caches.delete(PAGES_CACHE);
+      }
+      if (entries.length) {
+        await notifyPending(failed);
+      }
+    })().finally(() => {
+      flushing = null;
+    });
+  }
+  return flushing;
+}
+
+async function handleWrite(request) {
+  // كل طلب يحمل مفتاح منع تكرار، يستخدم في الإرسال الأول وفي كل إعادة
+  const headers = {
+    'Content-Type': request.headers.get('Content-Type') || 'application/json',
+    'Idempotency-Key': request.headers.get('Idempotency-Key') || self.crypto.randomUUID()
+  };
+  const entry = { url: request.url, headers, body: await request.text(), attempts: 0, queued_at: Date.now() };
+
+  try {
+    const response = await sendEntry(entry);
+    // الكتابة غيرت البيانات: الصفحات المحفوظة تطلب من الشبكة من جديد
+    await caches.delete(PAGES_CACHE);
+    flushOutbox();
+    return response;
+  } catch (error) {
+    await outboxAdd(entry);
+    if (self.registration.sync) {
+      self.registration.sync.register('outbox').catch(() => {});
+    }
+    await notifyPending();
+    return new Response(JSON.stringify({ success: true, queued: true }), {
+      status: 202,
+      headers: { 'Content-Type': 'application/json' }
+    });
+  }
+}
+
+// ===== الصفحات: المحفوظة فوراً ثم تحديثها من الشبكة =====
+
+async function staleWhileRevalidate(event) {
+  const cache = await caches.open(PAGES_CACHE);
+  const cached = await cache.match(event.request);
+  const network = fetch(event.request).then(async response => {
+    if (response.ok && !/no-store/.test(response.headers.get('Cache-Control') || '')) {
+      await cache.put(event.request, response.clone());
+    }
+    flushOutbox();
+    return response;
+  });
+
+  if (cached) {
+    event.waitUntil(network.catch(() => {}));
+    return cached;
+  }
+  try {
+    return await network;
+  } catch (error) {
+    return offlineResponse(event.request);
+  }
+}
+
+async function offlineResponse(request) {
+  if (request.mode === 'navigate') {
+    const home = await caches.match('/', { cacheName: PAGES_CACHE });
+    if (home) {
+      return home;
+    }
+  }
+  return new Response('<h1 dir="rtl">⚠️ لا يوجد اتصال بالخادم</h1>', {
+    status: 503,
+    headers: { 'Content-Type': 'text/html; charset=utf-8' }
+  });
+}
+
 // Install event
 self.addEventListener('install', event => {
   event.waitUntil(
     caches.open(CACHE_NAME)
-      .then(cache => cache.addAll(urlsToCache))
+      .then(cache => cache.addAll(PRECACHE_URLS))
+      .then(() => self.skipWaiting())
   );
 });
 
-// Fetch event
+// Fetch event: الملفات الثابتة من الذاكرة أولاً، والصفحات المحددة محفوظة مع التحديث،
+// وطلبات الكتابة عبر الطابور، وكل ما عدا ذلك من الشبكة مباشرة
 self.addEventListener('fetch', event => {
-  event.respondWith(
-    caches.match(event.request)
-      .then(response => response || fetch(event.request))
-  );
+  const request = event.request;
+  const url = new URL(request.url);
+  if (url.origin !== location.origin) {
+    return;
+  }
+
+  if (request.method === 'POST' && QUEUED_WRITES.some(pattern => pattern.test(url.pathname))) {
+    event.respondWith(handleWrite(request));
+    return;
+  }
+  if (request.method !== 'GET') {
+    return;
+  }
+  if (url.pathname.startsWith('/static/')) {
+    event.respondWith(
+      caches.match(request)
+        .then(response => response || fetch(request))
+    );
+    return;
+  }
+  if (PAGE_PATTERNS.some(pattern => pattern.test(url.pathname))) {
+    event.respondWith(staleWhileRevalidate(event));
+  }
+});
+
+// Background sync (إذا دعمه المتصفح)
+self.addEventListener('sync', event => {
+  if (event.tag === 'outbox') {
+    event.waitUntil(flushOutbox());
+  }
+});
+
+// الصفحات ترسل flush-outbox عند عودة الاتصال
+self.addEventListener('message', event => {
+  if (event.data && event.data.type === 'flush-outbox') {
+    event.waitUntil(flushOutbox());
+  }
 });
 
 // Activate event
@@ -30,11 +251,12 @@ self.addEventListener('activate', event => {
     caches.keys().then(cacheNames => {
       return Promise.all(
         cacheNames.map(cacheName => {
-          if (cacheName !== CACHE_NAME) {
+          if (cacheName !== CACHE_NAME && cacheName !== PAGES_CACHE) {
             return caches.delete(cacheName);
           }
         })
       );
-    })
+    }).then(() => self.clients.claim())
+      .then(() => flushOutbox())
   );
 });
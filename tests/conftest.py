@@ -0,0 +1,59 @@
+"""
+Shared fixtures: the app against a temporary database
+تهيئة مشتركة: التطبيق على قاعدة بيانات مؤقتة لكل اختبار
+"""
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import app as medical_app
+
+@pytest.fixture
+def app_module(tmp_path, monkeypatch):
+    """وحدة التطبيق بعد تهيئة قاعدة بيانات جديدة، مع تفريغ الذاكرات بين الاختبارات"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(medical_app, 'DATABASE', str(tmp_path / 'medical_records.db'))
+    medical_app.init_db()
+    medical_app.fragment_cache.clear()
+    medical_app.digits_index.invalidate()
+    yield medical_app
+    medical_app.close_pools()
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+@pytest.fixture
+def db(app_module):
+    """اتصال مباشر بقاعدة البيانات المؤقتة لفحص الجداول"""
+    conn = app_module._connect()
+    yield conn
+    conn.close()
+
+# جداول تحدثها المشغلات ويعيد rebuild_derived بناءها، دون أعمدة أرقام النسخ
+DERIVED_TABLES = {
+    'patient_balances': 'patient_id, total_charges, total_paid, total_debt, visit_count, last_visit_date',
+    'patients_fts': 'rowid, name, phone, national_id, email',
+    'name_trigrams': '*',
+    'dashboard_totals': 'total_patients, total_visits, total_revenue, total_collected',
+    'daily_stats': '*',
+    'revenue_daily': '*',
+}
+
+@pytest.fixture
+def derived_snapshot(db):
+    """دالة تعيد محتوى الجداول المشتقة، دون صفوف الإيرادات الصفرية التي تتركها المشغلات"""
+    def snapshot():
+        tables = {}
+        for table, columns in DERIVED_TABLES.items():
+            rows = {tuple(row) for row in db.execute(f'SELECT {columns} FROM {table}')}
+            if table == 'revenue_daily':
+                rows = {row for row in rows if any(row[2:])}
+            tables[table] = rows
+        return tables
+    return snapshot
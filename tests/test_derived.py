@@ -0,0 +1,68 @@
+"""
+Trigger-maintained derived tables
+الجداول المشتقة التي تحدثها المشغلات: الأرصدة وفهرس البحث ولوحة التحكم
+"""
+
+import pytest
+
+@pytest.fixture
+def clinic(client):
+    """مريضان بزيارات ودفعات وموعد عبر مسارات التطبيق"""
+    first = client.post('/patient/new', json={'name': 'إبراهيم أحمد', 'phone': '0791234567',
+                                              'national_id': '9901234567'}).get_json()['patient_id']
+    second = client.post('/patient/new', json={'name': 'فاطمة علي'}).get_json()['patient_id']
+    client.post('/doctor/new', json={'name': 'د. سامي'})
+    visits = [
+        client.post(f'/visit/new/{first}', json={'doctor_id': 1, 'total_cost': 100,
+                                                 'paid_amount': 40}).get_json()['visit_id'],
+        client.post(f'/visit/new/{first}', json={'total_cost': 60}).get_json()['visit_id'],
+        client.post(f'/visit/new/{second}', json={'doctor_id': 1, 'total_cost': 80,
+                                                  'paid_amount': 80}).get_json()['visit_id'],
+    ]
+    client.post(f'/payment/add/{visits[0]}', json={'amount': 10})
+    client.post(f'/appointment/new/{second}', json={'appointment_date': '2030-01-01',
+                                                    'appointment_time': '10:00'})
+    return first, second, visits
+
+def test_balances_follow_visits_and_payments(client, db, clinic):
+    first, second, _ = clinic
+    balances = {row['patient_id']: row for row in db.execute('SELECT * FROM patient_balances')}
+    assert (balances[first]['total_charges'], balances[first]['total_paid'],
+            balances[first]['total_debt'], balances[first]['visit_count']) == (160, 50, 110, 2)
+    assert balances[second]['total_debt'] == 0
+
+    client.post('/payments/batch', json={'payments': [{'patient_id': first, 'amount': 110}]})
+    assert db.execute('SELECT total_debt FROM patient_balances WHERE patient_id = ?',
+                      (first,)).fetchone()[0] == 0
+
+def test_search_index_follows_patient_changes(client, db, clinic):
+    first, _, _ = clinic
+    # البحث يوحد الهمزات، وتعديل الاسم مباشرة في الجدول يحدث الفهرس
+    assert [row['id'] for row in client.get('/search?q=ابراهيم').get_json()] == [first]
+    db.execute("UPDATE patients SET name = 'خالد التميمي' WHERE id = ?", (first,))
+    db.commit()
+    assert client.get('/search?q=ابراهيم').get_json() == []
+    assert [row['id'] for row in client.get('/search?q=التميمي').get_json()] == [first]
+
+    client.post(f'/patient/{first}/delete')
+    assert db.execute('SELECT COUNT(*) FROM patients_fts WHERE rowid = ?', (first,)).fetchone()[0] == 0
+
+def test_dashboard_counters(client, clinic):
+    stats = client.get('/api/dashboard-stats').get_json()
+    assert (stats['total_patients'], stats['total_visits']) == (2, 3)
+    assert (stats['total_revenue'], stats['total_collected'], stats['total_debt']) == (240, 130, 110)
+
+def test_triggers_match_full_rebuild(app_module, client, db, clinic, derived_snapshot):
+    first, _, visits = clinic
+    # تعديلات لا تمر بمسارات التطبيق: المشغلات وحدها تحدث الجداول المشتقة
+    db.execute('UPDATE visits SET total_cost = 150 WHERE id = ?', (visits[1],))
+    db.execute("UPDATE payments SET amount = 5, payment_date = '2024-01-02 09:00:00' "
+               "WHERE id = (SELECT MAX(id) FROM payments)")
+    db.execute('UPDATE visits SET paid_amount = paid_amount - 5 WHERE id = ?', (visits[0],))
+    db.commit()
+    client.post(f'/patient/{first}/delete')
+
+    maintained = derived_snapshot()
+    app_module.rebuild_derived(db.cursor())
+    db.commit()
+    assert maintained == derived_snapshot()
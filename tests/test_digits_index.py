@@ -0,0 +1,78 @@
+"""
+In-memory phone / national-ID index
+فهرس الأرقام في الذاكرة: البحث بالبداية والنهاية، والكتابة أثناء التحميل
+"""
+
+import threading
+
+import pytest
+
+@pytest.fixture
+def patients(client):
+    phones = ['0791234567', '٠٧٨٥٥٥١٢٣٤', '0771239999']
+    return [client.post('/patient/new', json={'name': f'مريض {i}', 'phone': phone}).get_json()['patient_id']
+            for i, phone in enumerate(phones)]
+
+@pytest.fixture
+def index(app_module, monkeypatch):
+    index = app_module.DigitsIndex()
+    monkeypatch.setattr(app_module, 'digits_index', index)
+    return index
+
+def test_prefix_and_suffix_lookup(db, index, patients):
+    index.load(db.cursor())
+    assert index.lookup('0791', 10) == [patients[0]]
+    assert index.lookup('0785', 10) == [patients[1]]
+    # النهاية: آخر أرقام الهاتف
+    assert index.lookup('1234', 10) == [patients[1]]
+    assert index.lookup('4567', 10) == [patients[0]]
+
+def test_routes_keep_index_current(client, db, index, patients):
+    index.load(db.cursor())
+    patient_id = client.post('/patient/new', json={'name': 'جديد', 'phone': '0799000111'}).get_json()['patient_id']
+    assert index.lookup('0799000', 10) == [patient_id]
+    client.post(f'/patient/{patients[0]}/delete')
+    assert index.lookup('0791', 10) == []
+
+@pytest.fixture
+def paused_load(app_module, index):
+    """تحميل في خيط خلفي يتوقف بعد قراءة جدول المرضى وقبل استبدال القوائم حتى يستأنف"""
+    built = threading.Event()
+    release = threading.Event()
+    build = index._build
+
+    def paused_build(cursor):
+        result = build(cursor)
+        built.set()
+        release.wait(10)
+        return result
+
+    index._build = paused_build
+    conn = app_module._connect(readonly=True)
+    loader = threading.Thread(target=index.load, args=(conn.cursor(),))
+
+    def resume():
+        release.set()
+        loader.join(10)
+
+    loader.start()
+    assert built.wait(10)
+    yield resume
+    resume()
+    conn.close()
+
+def test_writes_during_load_are_replayed(client, index, patients, paused_load):
+    """مريض يضاف بعد أن قرأ التحميل جدول المرضى يظهر بعد انتهائه، والمحذوف يختفي"""
+    added = client.post('/patient/new', json={'name': 'أثناء التحميل',
+                                              'phone': '0799888777'}).get_json()['patient_id']
+    client.post(f'/patient/{patients[2]}/delete')
+    paused_load()
+
+    assert index.snapshot()['loaded']
+    assert index.lookup('0799888', 10) == [added]
+    assert index.lookup('0771', 10) == []
+
+def test_invalidate_during_load_forces_reload(index, patients, paused_load):
+    index.invalidate()
+    paused_load()
+    assert not index.snapshot()['loaded']
@@ -0,0 +1,48 @@
+"""
+Idempotency-Key handling for write requests
+مفاتيح منع التكرار: إعادة النتيجة المحفوظة، والمفتاح المستخدم لطلب آخر، والطلب المرفوض
+"""
+
+import pytest
+
+@pytest.fixture
+def visit(client):
+    patient_id = client.post('/patient/new', json={'name': 'سارة يوسف'}).get_json()['patient_id']
+    return client.post(f'/visit/new/{patient_id}', json={'total_cost': 100}).get_json()['visit_id']
+
+def post_payments(client, key, **entry):
+    return client.post('/payments/batch', json={'payments': [entry]}, headers={'Idempotency-Key': key})
+
+def paid(db, visit_id):
+    return db.execute('SELECT paid_amount FROM visits WHERE id = ?', (visit_id,)).fetchone()[0]
+
+def test_repeated_request_is_replayed(client, db, visit):
+    first = post_payments(client, 'key-1', visit_id=visit, amount=40)
+    second = post_payments(client, 'key-1', visit_id=visit, amount=40)
+    assert first.status_code == second.status_code == 200
+    assert 'Idempotent-Replayed' not in first.headers
+    assert second.headers['Idempotent-Replayed'] == 'true'
+    assert second.get_json() == first.get_json()
+    assert paid(db, visit) == 40
+    assert db.execute('SELECT COUNT(*) FROM payments WHERE visit_id = ?', (visit,)).fetchone()[0] == 1
+
+def test_key_reused_for_different_request(client, db, visit):
+    post_payments(client, 'key-1', visit_id=visit, amount=40)
+    response = post_payments(client, 'key-1', visit_id=visit, amount=10)
+    assert response.status_code == 422
+    assert response.get_json()['success'] is False
+    assert paid(db, visit) == 40
+
+def test_rejected_request_leaves_key_reusable(client, db, visit):
+    response = post_payments(client, 'key-1', visit_id=visit, amount=500)
+    assert response.status_code == 400
+    assert db.execute("SELECT COUNT(*) FROM idempotency_keys WHERE key = 'key-1'").fetchone()[0] == 0
+
+    response = post_payments(client, 'key-1', visit_id=visit, amount=50)
+    assert response.status_code == 200
+    assert 'Idempotent-Replayed' not in response.headers
+    assert paid(db, visit) == 50
+
+def test_invalid_key_is_refused(client, visit):
+    response = post_payments(client, 'x' * 200, visit_id=visit, amount=10)
+    assert response.status_code == 400
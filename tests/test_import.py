@@ -0,0 +1,82 @@
+"""
+Bulk import of patients, visits and payments
+الاستيراد الجماعي: الصفوف المرفوضة والمفاتيح الخارجية والجداول المشتقة
+"""
+
+import io
+import json
+
+import pytest
+
+def upload(client, kind, text, name='data.csv', **form):
+    data = {'file': (io.BytesIO(text.encode('utf-8')), name), **form}
+    return client.post(f'/import/{kind}', data=data, content_type='multipart/form-data')
+
+def jsonl(*rows):
+    return ''.join(json.dumps(row, ensure_ascii=False) + '\n' for row in rows)
+
+@pytest.fixture
+def imported(client):
+    """مريضان وثلاث زيارات مستوردة بمفاتيح خارجية"""
+    report = upload(client, 'patients', 'patient_key,name,phone\n'
+                                        'p1,سارة يوسف,0791112223\n'
+                                        'p2,,0790000000\n'
+                                        'p3,خالد علي,\n').get_json()
+    assert (report['imported'], report['rejected']) == (2, 1)
+    assert report['rejects'][0]['line'] == 3
+    report = upload(client, 'visits', jsonl(
+        {'visit_key': 'v1', 'patient_key': 'p1', 'total_cost': 100, 'paid_amount': 30,
+         'visit_date': '2024-03-01T10:00'},
+        {'visit_key': 'v2', 'patient_key': 'p3', 'total_cost': 50},
+        {'visit_key': 'v3', 'patient_key': 'missing', 'total_cost': 20},
+        {'visit_key': 'v4', 'patient_key': 'p1', 'total_cost': -5},
+    ), name='visits.jsonl').get_json()
+    assert (report['imported'], report['rejected']) == (2, 2)
+    return report
+
+def test_rejects_and_keys(db, imported):
+    assert [row[0] for row in db.execute('SELECT name FROM patients ORDER BY id')] == ['سارة يوسف', 'خالد علي']
+    assert db.execute("SELECT COUNT(*) FROM import_keys WHERE kind = 'visit'").fetchone()[0] == 2
+
+def test_visit_paid_amount_gets_initial_payment(db, imported):
+    rows = db.execute('''
+        SELECT v.paid_amount, p.amount, p.payment_date
+        FROM visits v JOIN payments p ON p.visit_id = v.id
+    ''').fetchall()
+    assert [tuple(row) for row in rows] == [(30, 30, '2024-03-01 10:00:00')]
+
+def test_payments_cannot_exceed_remaining_debt(client, db, imported):
+    report = upload(client, 'payments', 'visit_key,amount\n'
+                                        'v1,50\n'
+                                        'v1,30\n'
+                                        'v1,20\n'
+                                        'v2,0\n').get_json()
+    assert (report['imported'], report['rejected']) == (2, 2)
+    assert db.execute("SELECT total_debt FROM patient_balances b JOIN patients p ON p.id = b.patient_id "
+                      "WHERE p.name = 'سارة يوسف'").fetchone()[0] == 0
+
+def test_dry_run_keeps_nothing(client, db):
+    report = upload(client, 'patients', 'name\nمريض تجريبي\n', dry_run='1').get_json()
+    assert report['imported'] == 1
+    assert db.execute('SELECT COUNT(*) FROM patients').fetchone()[0] == 0
+
+def test_small_import_keeps_triggers_live(app_module, db, imported, derived_snapshot):
+    assert imported['deferred'] is False
+    maintained = derived_snapshot()
+    app_module.rebuild_derived(db.cursor())
+    db.commit()
+    assert maintained == derived_snapshot()
+
+def test_large_import_rebuilds_derived_tables(app_module, db, derived_snapshot):
+    schema = 'SELECT type, name FROM sqlite_master WHERE type IN (\'index\', \'trigger\') ORDER BY name'
+    before = db.execute(schema).fetchall()
+    rows = [(line, {'name': f'مريض {line}', 'phone': f'07{line:08d}'}, None) for line in range(1, 51)]
+    report = app_module.BulkImporter(db, 'patients', defer_rows=10, batch_size=20).run(iter(rows))
+    assert (report['imported'], report['deferred']) == (50, True)
+    assert db.execute(schema).fetchall() == before
+
+    maintained = derived_snapshot()
+    assert len(maintained['patients_fts']) == 50
+    app_module.rebuild_derived(db.cursor())
+    db.commit()
+    assert maintained == derived_snapshot()
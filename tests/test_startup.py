@@ -0,0 +1,61 @@
+"""
+Startup tests for the embedded Android server
+اختبارات تشغيل الخادم المدمج: الجاهزية عبر /healthz وانتهاء المهلة
+"""
+
+import os
+import socket
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'android'))
+sys.path.insert(0, ROOT)
+
+import app as medical_app
+from startup import EmbeddedServer, wait_for_health
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    """خادم مدمج على منفذ عشوائي وقاعدة بيانات مؤقتة"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('MEDICAL_COMPRESS', '0')
+    monkeypatch.setattr(medical_app, 'DATABASE', str(tmp_path / 'medical_records.db'))
+    server = EmbeddedServer(port=0, app_dir=ROOT).start()
+    yield server
+    server.shutdown()
+    medical_app.close_pools()
+
+def free_port():
+    """منفذ لا يستمع عليه أحد"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def test_embedded_server_becomes_healthy(server, tmp_path):
+    assert server.port != 0
+    wait_for_health(server.url, timeout=30)
+    assert server.error is None
+    assert server.ready.is_set()
+    assert (tmp_path / 'medical_records.db').exists()
+
+def test_wait_for_health_raises_when_nothing_listens():
+    with pytest.raises(TimeoutError):
+        wait_for_health(f'http://127.0.0.1:{free_port()}', timeout=0.3,
+                        initial_delay=0.05, max_delay=0.1)
+
+def test_healthz_unavailable_until_migrated(tmp_path, monkeypatch):
+    monkeypatch.setattr(medical_app, 'DATABASE', str(tmp_path / 'medical_records.db'))
+    client = medical_app.app.test_client()
+    try:
+        response = client.get('/healthz')
+        assert response.status_code == 503
+        assert response.get_json()['status'] == 'migrating'
+
+        medical_app.init_db()
+        response = client.get('/healthz')
+        assert response.status_code == 200
+        assert response.get_json()['schema_version'] == medical_app.SCHEMA_VERSION
+    finally:
+        medical_app.close_pools()